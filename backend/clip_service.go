@@ -2,10 +2,14 @@ package main
 
 import (
 	"bytes"
+	"encoding/base64"
 	"encoding/json"
 	"fmt"
 	"net/http"
+	"net/url"
 	"os"
+	"strconv"
+	"strings"
 	"time"
 )
 
@@ -48,7 +52,48 @@ func NewClipService() *ClipService {
 	}
 }
 
+// decodeImageData turns a base64 string or data URL into raw image bytes.
+func decodeImageData(imageData string) ([]byte, error) {
+	if strings.HasPrefix(imageData, "data:") {
+		if comma := strings.Index(imageData, ","); comma >= 0 {
+			imageData = imageData[comma+1:]
+		}
+	}
+	return base64.RawStdEncoding.DecodeString(strings.TrimRight(imageData, "="))
+}
+
+// postImageBytes sends raw image bytes to the binary analyze endpoint,
+// avoiding the base64-in-JSON overhead on the way to the CLIP service.
+func (cs *ClipService) postImageBytes(image []byte, query url.Values) (*ClipAnalysisResponse, error) {
+	endpoint := cs.baseURL + "/analyze-binary"
+	if len(query) > 0 {
+		endpoint += "?" + query.Encode()
+	}
+
+	resp, err := cs.client.Post(endpoint, "application/octet-stream", bytes.NewReader(image))
+	if err != nil {
+		return nil, fmt.Errorf("failed to call CLIP service: %v", err)
+	}
+	defer resp.Body.Close()
+
+	if resp.StatusCode != http.StatusOK {
+		return nil, fmt.Errorf("CLIP service returned status %d", resp.StatusCode)
+	}
+
+	var result ClipAnalysisResponse
+	if err := json.NewDecoder(resp.Body).Decode(&result); err != nil {
+		return nil, fmt.Errorf("failed to decode response: %v", err)
+	}
+
+	return &result, nil
+}
+
 func (cs *ClipService) AnalyzeImage(imageData string) (*ClipAnalysisResponse, error) {
+	if image, err := decodeImageData(imageData); err == nil {
+		return cs.postImageBytes(image, nil)
+	}
+
+	// Let the CLIP service handle data we could not decode, as before
 	reqBody := ClipAnalysisRequest{
 		ImageData: imageData,
 	}
@@ -81,6 +126,20 @@ func (cs *ClipService) AnalyzeImage(imageData string) (*ClipAnalysisResponse, er
 }
 
 func (cs *ClipService) ReExamineImage(imageData string, excludeIDs []int, focusIDs []int, searchType string) (*ClipAnalysisResponse, error) {
+	if image, err := decodeImageData(imageData); err == nil {
+		query := url.Values{}
+		if searchType != "" {
+			query.Set("search_type", searchType)
+		}
+		for _, id := range excludeIDs {
+			query.Add("exclude_ids", strconv.Itoa(id))
+		}
+		for _, id := range focusIDs {
+			query.Add("focus_ids", strconv.Itoa(id))
+		}
+		return cs.postImageBytes(image, query)
+	}
+
 	reqBody := map[string]interface{}{
 		"image_data":  imageData,
 		"exclude_ids": excludeIDs,
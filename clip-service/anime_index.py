@@ -0,0 +1,139 @@
+import threading
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+# Characters whose media AniList didn't return are not grouped under an anime
+UNKNOWN_ANIME = "Unknown"
+
+
+class AnimeIndex:
+    """One centroid vector per anime, aggregated from its characters
+
+    Each character contributes its primary image vector to the anime in its
+    metadata. Sums and counts are kept per anime (in float64, so repeated
+    adds and removes don't drift), making an add or remove O(dimension). When
+    ``title_weight`` is set, an anime's centroid is blended with a CLIP text
+    embedding of its title once one has been provided via ``set_titles``.
+    Centroids are packed into one matrix on the first search after a change.
+    """
+
+    def __init__(self, title_weight: float = 0.0):
+        self.title_weight = min(max(title_weight, 0.0), 1.0)
+        self._lock = threading.Lock()
+        self._members: Dict[int, Tuple[str, np.ndarray]] = {}
+        self._sums: Dict[str, np.ndarray] = {}
+        self._counts: Dict[str, int] = {}
+        self._title_vectors: Dict[str, np.ndarray] = {}
+        self._packed = None
+        self.searches = 0
+
+    def fork(self) -> "AnimeIndex":
+        """An empty index that reuses this one's title embeddings"""
+        index = AnimeIndex(self.title_weight)
+        index._title_vectors = dict(self._title_vectors)
+        return index
+
+    def count(self) -> int:
+        return len(self._counts)
+
+    def add(self, ids: Sequence[int], vectors, metadatas: Sequence[dict]):
+        """Add characters; a character already present moves to its new vector and anime"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(vectors):
+            return
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            for anilist_id, vector, metadata in zip(ids, vectors, metadatas):
+                self._remove_locked(int(anilist_id))
+                title = metadata.get("anime") or UNKNOWN_ANIME
+                if title == UNKNOWN_ANIME:
+                    continue
+                self._members[int(anilist_id)] = (title, vector)
+                if title in self._sums:
+                    self._sums[title] = self._sums[title] + vector
+                    self._counts[title] += 1
+                else:
+                    self._sums[title] = vector.astype(np.float64)
+                    self._counts[title] = 1
+            self._packed = None
+
+    def remove(self, ids: Iterable[int]):
+        with self._lock:
+            for anilist_id in ids:
+                self._remove_locked(int(anilist_id))
+            self._packed = None
+
+    def _remove_locked(self, anilist_id: int):
+        member = self._members.pop(anilist_id, None)
+        if member is None:
+            return
+        title, vector = member
+        self._counts[title] -= 1
+        if self._counts[title]:
+            self._sums[title] = self._sums[title] - vector
+        else:
+            del self._counts[title], self._sums[title]
+
+    def missing_titles(self) -> List[str]:
+        """Titles still without a text embedding (empty when titles are not blended in)"""
+        if not self.title_weight:
+            return []
+        return [title for title in self._counts if title not in self._title_vectors]
+
+    def set_titles(self, titles: Sequence[str], vectors):
+        with self._lock:
+            for title, vector in zip(titles, np.asarray(vectors, dtype=np.float64)):
+                self._title_vectors[title] = vector / max(np.linalg.norm(vector), 1e-12)
+            self._packed = None
+
+    def _pack(self):
+        packed = self._packed
+        if packed is not None:
+            return packed
+        with self._lock:
+            titles = sorted(self._counts)
+            if not titles:
+                packed = (titles, np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64))
+            else:
+                centroids = np.stack([self._sums[title] / self._counts[title] for title in titles])
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+                if self.title_weight:
+                    for row, title in enumerate(titles):
+                        text = self._title_vectors.get(title)
+                        if text is not None:
+                            centroids[row] = (1 - self.title_weight) * centroids[row] + self.title_weight * text
+                    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+                counts = np.asarray([self._counts[title] for title in titles])
+                packed = (titles, centroids.astype(np.float32), counts)
+            self._packed = packed
+        return packed
+
+    def search(self, queries: np.ndarray, n_results: int) -> List[List[dict]]:
+        """Best ``n_results`` anime per query, as {"title", "confidence", "characters"} dicts"""
+        titles, centroids, counts = self._pack()
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        self.searches += len(queries)
+        if not titles or n_results <= 0:
+            return [[] for _ in queries]
+
+        scores = queries @ centroids.T
+        n = min(n_results, len(titles))
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+        return [
+            [
+                {"title": titles[col], "confidence": max(0.0, float(scores[row, col])), "characters": int(counts[col])}
+                for col in top[row]
+            ]
+            for row in range(len(queries))
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "anime": len(self._counts),
+            "characters": len(self._members),
+            "title_vectors": len(self._title_vectors),
+            "title_weight": self.title_weight,
+            "searches": self.searches,
+        }
@@ -0,0 +1,176 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence
+
+
+class QueueFullError(Exception):
+    """Raised when the admission queue cannot take another request"""
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches and runs them through one call
+
+    Batches are handed to ``executor`` so the forward pass never runs on the
+    event loop. ``max_queue_size`` bounds how many requests may wait; once it
+    is reached ``submit`` raises ``QueueFullError`` instead of queueing.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], Sequence[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        executor: Optional[Executor] = None,
+        workers: int = 1,
+        max_queue_size: int = 0,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.executor = executor
+        self.workers = max(1, workers)
+        self.max_queue_size = max(0, max_queue_size)
+        self.queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+        # Stats
+        self.in_flight = 0
+        self.rejected = 0
+        self.batches_run = 0
+        self.items_processed = 0
+        self.max_batch_seen = 0
+        self.batch_size_counts = {}
+        self.last_batch_ms = 0.0
+
+    def start(self):
+        if not self._workers:
+            self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._workers = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+
+    def is_full(self) -> bool:
+        return self.queue is not None and self.queue.full()
+
+    async def submit(self, item: Any) -> Any:
+        """Queue a single item and wait for its result"""
+        if not self._workers:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError(f"Inference queue is full ({self.max_queue_size} waiting)")
+        return await future
+
+    async def _collect(self) -> List[tuple]:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Drop requests whose callers already went away
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            self.in_flight += 1
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.process_batch, [item for item, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.in_flight -= 1
+            self._record(len(batch), started)
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _record(self, size: int, started: float):
+        self.batches_run += 1
+        self.items_processed += size
+        self.max_batch_seen = max(self.max_batch_seen, size)
+        self.batch_size_counts[size] = self.batch_size_counts.get(size, 0) + 1
+        self.last_batch_ms = (time.perf_counter() - started) * 1000
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_capacity": self.max_queue_size or None,
+            "in_flight_batches": self.in_flight,
+            "workers": self.workers,
+            "rejected": self.rejected,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches_run": self.batches_run,
+            "items_processed": self.items_processed,
+            "avg_batch_size": round(self.items_processed / self.batches_run, 2) if self.batches_run else 0.0,
+            "max_batch_seen": self.max_batch_seen,
+            "batch_size_counts": dict(sorted(self.batch_size_counts.items())),
+            "last_batch_ms": round(self.last_batch_ms, 2),
+        }
+
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers with the same key
+
+    The first caller for a key starts ``fn`` as a task; callers arriving while
+    it runs await the same task instead of repeating the work. A caller that
+    goes away doesn't cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Future):
+        self._calls.pop(key, None)
+        # Retrieve the exception in case every caller had already gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,144 @@
+"""Compare Chroma collection.query against the in-memory search indexes
+
+Builds normalized 512-d embeddings at each size, loads them into an in-memory
+Chroma collection, ExactSearchIndex (float32 and float16) and two-stage
+indexes (compressed candidate pass plus exact rerank), then times single and
+batched top-k queries and reports recall@k against exact float32 search:
+
+    python bench_search.py --sizes 1000 10000 100000 --queries 200
+    python bench_search.py --sizes 100000 --two-stage pca:32 pca:64 int8 --candidates 100 200 400
+
+Synthetic embeddings have ``--intrinsic-dim`` directions of variance, like real
+CLIP embeddings; isotropic noise (``--intrinsic-dim 0``) is a worst case for
+PCA. ``--embeddings`` benchmarks a real matrix, e.g. a snapshot's ``.npy``.
+"""
+import argparse
+import time
+
+import chromadb
+import numpy as np
+
+from search_index import ExactSearchIndex, TwoStageSearchIndex
+
+
+def random_embeddings(rng: np.random.Generator, n: int, dim: int, intrinsic_dim: int = 0) -> np.ndarray:
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    if intrinsic_dim:
+        # Most variance in a few directions (decaying), plus a little noise
+        mixing = rng.standard_normal((intrinsic_dim, dim), dtype=np.float32)
+        weights = (1.0 / np.sqrt(np.arange(1, intrinsic_dim + 1))).astype(np.float32)
+        latent = rng.standard_normal((n, intrinsic_dim), dtype=np.float32) * weights
+        vectors = latent @ mixing + 0.1 * vectors
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def fake_metadata(i: int) -> dict:
+    return {
+        'anilist_id': i,
+        'name': f"Character {i}",
+        'anime': f"Anime {i % 500}",
+        'description': "A synthetic character used for benchmarking",
+        'image_url': f"https://example.com/{i}.jpg",
+    }
+
+
+def time_queries(search, queries: np.ndarray, k: int, batch_size: int) -> list:
+    latencies = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        started = time.perf_counter()
+        search(batch, k)
+        latencies.append((time.perf_counter() - started) * 1000 / len(batch))
+    return latencies
+
+
+def summarize(latencies: list) -> str:
+    values = np.asarray(latencies)
+    return (f"mean {values.mean():7.3f}ms  p50 {np.percentile(values, 50):7.3f}ms  "
+            f"p95 {np.percentile(values, 95):7.3f}ms")
+
+
+def recall(expected: list, actual: list) -> float:
+    hits = sum(len(set(e) & set(a)) for e, a in zip(expected, actual))
+    return hits / max(1, sum(len(e) for e in expected))
+
+
+def run(size: int, args, rng: np.random.Generator, source: np.ndarray = None):
+    if source is not None:
+        picked = rng.choice(len(source), size=min(size, len(source)) + args.queries, replace=False)
+        data = source[picked] / np.linalg.norm(source[picked], axis=1, keepdims=True)
+        embeddings, queries = data[:-args.queries], data[-args.queries:]
+        size = len(embeddings)
+    else:
+        data = random_embeddings(rng, size + args.queries, args.dim, args.intrinsic_dim)
+        embeddings, queries = data[:size], data[size:]
+    ids = [str(i) for i in range(size)]
+    metadatas = [fake_metadata(i) for i in range(size)]
+
+    print(f"\n== {size} vectors ==")
+    client = chromadb.EphemeralClient()
+    collection = client.create_collection(f"bench_{size}", metadata={"hnsw:space": "cosine"})
+    started = time.perf_counter()
+    for start in range(0, size, 5000):
+        collection.add(
+            ids=ids[start:start + 5000],
+            embeddings=embeddings[start:start + 5000].tolist(),
+            metadatas=metadatas[start:start + 5000]
+        )
+    print(f"chroma build        {time.perf_counter() - started:8.2f}s")
+
+    def chroma_search(batch, k):
+        return collection.query(query_embeddings=batch.tolist(), n_results=k)
+
+    backends = [("chroma", chroma_search)]
+    indexes = {}
+    for dtype in ("float32", "float16"):
+        started = time.perf_counter()
+        index = ExactSearchIndex(dimension=embeddings.shape[1], dtype=dtype)
+        index.add(ids, embeddings, metadatas)
+        indexes[dtype] = index
+        print(f"numpy-{dtype} build {time.perf_counter() - started:8.2f}s  "
+              f"({index.stats()['matrix_bytes'] / 1e6:.1f} MB)")
+        backends.append((f"numpy-{dtype}", index.search))
+
+    for spec in args.two_stage:
+        compression, _, dimension = spec.partition(':')
+        for candidates in args.candidates:
+            started = time.perf_counter()
+            index = TwoStageSearchIndex(dimension=embeddings.shape[1], compression=compression,
+                                        compressed_dimension=int(dimension or 64), candidates=candidates)
+            index.add(ids, embeddings, metadatas)
+            stats = index.stats()
+            print(f"{spec}/{candidates} build {time.perf_counter() - started:8.2f}s  "
+                  f"({stats['compressed_bytes'] / 1e6:.1f} MB codes)")
+            backends.append((f"{spec}/{candidates}", index.search))
+
+    # Exact float32 results are the ground truth for recall
+    truth = indexes["float32"].search(queries, args.k)['ids']
+    for name, search in backends:
+        for batch_size in (1, args.batch):
+            latencies = time_queries(search, queries, args.k, batch_size)
+            print(f"{name:16s} batch {batch_size:3d}  {summarize(latencies)}")
+        print(f"{name:16s} recall@{args.k} {recall(truth, search(queries, args.k)['ids']):.3f}")
+    client.delete_collection(f"bench_{size}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--intrinsic-dim', type=int, default=64)
+    parser.add_argument('--embeddings', help=".npy matrix to sample rows from instead of synthetic data")
+    parser.add_argument('--two-stage', nargs='*', default=['pca:64', 'int8'],
+                        help="compressions to try, as pca:<dims> or int8")
+    parser.add_argument('--candidates', type=int, nargs='+', default=[200])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    source = np.load(args.embeddings, mmap_mode='r') if args.embeddings else None
+    for size in args.sizes:
+        run(size, args, rng, source)
@@ -0,0 +1,408 @@
+"""Load and latency benchmark for the hybrid CLIP service
+
+Starts the service against a tiny randomly initialized CLIP vision model (so
+nothing is downloaded) and a fake_anilist.py character set, then drives
+/analyze and /re-examine with synthetic images of mixed sizes and formats at
+each concurrency level, in-process through an ASGI client and over real HTTP
+to a uvicorn subprocess:
+
+    python bench_service.py --characters 200 --requests 200 --concurrency 1 8 32
+    python bench_service.py --transport http --model openai/clip-vit-base-patch32
+    python bench_service.py --transport http --workers 4
+
+With ``--workers`` above 1 the HTTP service runs pre-forked under gunicorn
+(gunicorn.conf.py); readiness then waits for every worker to load the
+writer's index, each run's requests per worker are read from /workers, and
+the per-worker memory (rss and pss) is reported after the runs. Requests then
+go over a new connection each, since a kept-alive connection would pin them
+all to the worker that accepted it. Stage timings are per process,
+so they are skipped for multi-worker runs. The HTTP service is then stopped
+with SIGTERM and its log checked for a clean shutdown: a worker killed by a
+signal or aborting in native code on the way out is reported as unclean.
+
+Reports p50/p95/p99 latency, throughput and failures per endpoint, transport
+and concurrency, plus the service's own per-image stage timings over each run
+(base64, decode, preprocess, model, search, response). Whatever the stages
+don't cover (queueing, routing, validation, JSON serialization, transport) is
+shown as ``unattributed``. Service settings such as SEARCH_BACKEND or
+BATCH_MAX_SIZE are read from the environment as usual. The embedding cache
+is disabled unless ``--cache`` is given, so repeated images still pay for
+inference.
+
+Needs httpx (``pip install httpx``), which only the benchmark uses, so it is
+not in requirements.txt.
+"""
+import argparse
+import asyncio
+import base64
+import importlib.util
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fake_anilist import create_app as create_fake_anilist  # noqa: E402
+
+# Lines gunicorn, uvicorn or the C++ runtime log when a process dies instead of exiting
+UNCLEAN_SHUTDOWN = ("was sent SIG", "terminate called", "Segmentation fault", "exited with code")
+
+STAGES = ("base64", "decode", "preprocess", "model", "search", "response")
+ENDPOINTS = ("/analyze", "/re-examine")
+
+
+def save_tiny_model(path: str):
+    """A randomly initialized CLIP vision tower small enough to run anywhere"""
+    import torch
+    from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModelWithProjection
+
+    torch.manual_seed(0)
+    config = CLIPVisionConfig(
+        hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+        image_size=224, patch_size=32, projection_dim=512,
+    )
+    CLIPVisionModelWithProjection(config).eval().save_pretrained(path)
+    CLIPImageProcessor().save_pretrained(path)
+
+
+def synthetic_image(rng: random.Random, size: tuple, fmt: str) -> bytes:
+    # Gradient plus shapes and a little noise, so codecs see photo-like content
+    width, height = size
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    tint = np.array([rng.random() for _ in range(3)], dtype=np.float32)
+    pixels = (x * tint + y * (1 - tint)) % 256
+    pixels += np.random.default_rng(rng.randrange(1 << 30)).normal(0, 6, pixels.shape)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        box = (x0, y0, x0 + rng.randrange(width // 2 + 1), y0 + rng.randrange(height // 2 + 1))
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)(box, fill=colour)
+
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **({'quality': 85} if fmt in ('JPEG', 'WEBP') else {}))
+    return buffer.getvalue()
+
+
+def build_payloads(args) -> dict:
+    """Pre-serialized request bodies per endpoint, cycling through every size and format"""
+    rng = random.Random(args.seed)
+    images = [
+        synthetic_image(rng, size, fmt)
+        for _ in range(args.variants)
+        for size in args.image_sizes
+        for fmt in args.formats
+    ]
+    rng.shuffle(images)
+    print(f"{len(images)} synthetic images, {min(map(len, images)) / 1024:.0f}-"
+          f"{max(map(len, images)) / 1024:.0f} KB ({', '.join(args.formats)})")
+
+    encoded = [base64.b64encode(image).decode() for image in images]
+    character_ids = range(1, args.characters + 1)
+    payloads = {"/analyze": [json.dumps({"image_data": data}).encode() for data in encoded], "/re-examine": []}
+    for i, data in enumerate(encoded):
+        # Alternate the two re-examine modes
+        if i % 2:
+            options = {"search_type": "focus", "focus_ids": rng.sample(character_ids, min(5, args.characters))}
+        else:
+            options = {"search_type": "exclude", "exclude_ids": rng.sample(character_ids, min(3, args.characters))}
+        payloads["/re-examine"].append(json.dumps({"image_data": data, **options}).encode())
+    return payloads
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def service_env(args, workdir: str, anilist_url: str) -> dict:
+    env = {
+        "CLIP_MODEL_NAME": args.model or os.path.join(args.workdir, "tiny-clip"),
+        "CLIP_MODEL_DIR": os.path.join(workdir, "models", "clip-vision"),
+        "ANILIST_URL": anilist_url,
+        "ANILIST_MAX_PAGES": str(args.characters // 50 + 1),
+        "EMBEDDING_CACHE_MB": os.environ.get("EMBEDDING_CACHE_MB", "64") if args.cache else "0",
+    }
+    # Crawl the local fake as fast as it will go unless told otherwise
+    for name, value in (("ANILIST_RATE_LIMIT", "100"), ("INGEST_RATE_LIMIT", "1000")):
+        env[name] = os.environ.get(name, value)
+    return env
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float):
+    """Ready means warmed up, characters indexed with no ingestion running, and the queue not saturated
+
+    A reused --workdir starts with its characters already stored and runs no
+    ingestion at all, so this doesn't wait for one.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            stats = (await client.get("/stats")).json()
+            if (stats["search"] and stats["search"]["count"] > 0 and stats["ingestion"]["state"] != "running"
+                    and (await client.get("/health/ready")).status_code == 200):
+                health = (await client.get("/health")).json()
+                print(f"Service ready: {health['characters_count']} characters, startup {health['startup']}")
+                return
+        except (httpx.TransportError, ValueError, KeyError, TypeError):
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"Service not ready after {timeout:.0f}s")
+
+
+async def wait_for_workers(client: httpx.AsyncClient, workers: int, timeout: float):
+    """Every pre-forked worker warmed up and on the index generation the writer published"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            state = (await client.get("/workers")).json()
+            loaded = [worker for worker in state["workers"] if worker.get("model_loaded")]
+            if (len(loaded) >= workers and state["generation"]
+                    and all(worker.get("generation") == state["generation"] for worker in loaded)
+                    and (await client.get("/health/ready")).status_code == 200):
+                print(f"{len(loaded)} workers ready on generation {state['generation']}, writer {state['writer']}")
+                return
+        except (httpx.TransportError, ValueError, KeyError):
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"{workers} workers not ready after {timeout:.0f}s")
+
+
+async def stage_totals(client: httpx.AsyncClient) -> dict:
+    stages = (await client.get("/stats")).json()["stages"]
+    return {name: (stage["count"], stage["total_ms"]) for name, stage in stages.items()}
+
+
+async def worker_requests(client: httpx.AsyncClient, timeout: float = 60) -> dict:
+    """Requests served so far by each worker, once every worker has reported since this call"""
+    since = time.time()
+    deadline = time.monotonic() + timeout
+    while True:
+        workers = (await client.get("/workers")).json()["workers"]
+        if all(worker["reported_at"] >= since for worker in workers) or time.monotonic() > deadline:
+            return {worker["pid"]: worker["requests"] for worker in workers}
+        await asyncio.sleep(0.2)
+
+
+async def run_load(client: httpx.AsyncClient, endpoint: str, payloads: list, total: int, concurrency: int) -> dict:
+    latencies = []
+    failures = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, failures
+        while next_request < total:
+            body = payloads[next_request % len(payloads)]
+            next_request += 1
+            started = time.perf_counter()
+            try:
+                response = await client.post(endpoint, content=body, headers={"content-type": "application/json"})
+                ok = response.status_code == 200 and response.json().get("success")
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - started) * 1000)
+            failures += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": total,
+        "failed": failures,
+        "throughput_rps": total / elapsed,
+        "mean_ms": float(np.mean(latencies)),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
+
+
+def stage_breakdown(before: dict, after: dict, mean_ms: float) -> dict:
+    """Per-image milliseconds per stage over one run"""
+    breakdown = {}
+    for name in STAGES + tuple(sorted(set(after) - set(STAGES))):
+        count, total_ms = after.get(name, (0, 0.0))
+        start_count, start_ms = before.get(name, (0, 0.0))
+        if count > start_count:
+            breakdown[name] = (total_ms - start_ms) / (count - start_count)
+    breakdown["unattributed"] = mean_ms - sum(breakdown.get(name, 0.0) for name in STAGES)
+    return breakdown
+
+
+async def benchmark(client: httpx.AsyncClient, transport: str, args, payloads: dict, workers: int = 1) -> list:
+    await wait_until_ready(client, args.startup_timeout)
+    if workers > 1:
+        await wait_for_workers(client, workers, args.startup_timeout)
+    await run_load(client, "/analyze", payloads["/analyze"], args.warmup, 1)
+
+    results = []
+    print(f"\n== {transport} ==")
+    for endpoint in args.endpoints:
+        for concurrency in args.concurrency:
+            # Each worker keeps its own stage timings, and /stats only shows the one that answered
+            before = await stage_totals(client) if workers == 1 else await worker_requests(client)
+            result = await run_load(client, endpoint, payloads[endpoint], args.requests, concurrency)
+            stages = stage_breakdown(before, await stage_totals(client), result["mean_ms"]) if workers == 1 else {}
+            served = {}
+            if workers > 1:
+                # Includes the few /workers polls themselves
+                served = {pid: count - before.get(pid, 0) for pid, count in (await worker_requests(client)).items()}
+            results.append({"transport": transport, "endpoint": endpoint, "concurrency": concurrency,
+                            **result, "stages_ms": stages, "worker_requests": served})
+            print(f"{endpoint:12s} conc {concurrency:4d}  {result['requests']} req  {result['failed']} failed  "
+                  f"{result['throughput_rps']:7.1f} req/s  p50 {result['p50_ms']:8.2f}ms  "
+                  f"p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms")
+            if stages:
+                print(" " * 12 + "  per image: " + "  ".join(f"{name} {ms:.2f}ms" for name, ms in stages.items()))
+            if served:
+                print(" " * 12 + "  per worker: " + "  ".join(f"{pid} {count}" for pid, count in sorted(served.items())))
+    if workers > 1:
+        state = (await client.get("/workers")).json()
+        for worker in state["workers"]:
+            print(f"worker {worker['pid']:>7} {worker['role']:6s}  {worker['requests']:6d} req  "
+                  f"rss {worker['rss_mb']:8.1f}MB  pss {worker.get('pss_mb', 0):8.1f}MB")
+        total = state["total"]
+        print(f"{total['workers']} workers: rss {total['rss_mb']:.1f}MB summed, pss {total['pss_mb']:.1f}MB actually used")
+        results.append({"transport": transport, "workers": state})
+    return results
+
+
+async def run_asgi(args, payloads: dict, anilist_url: str) -> list:
+    workdir = os.path.join(args.workdir, "asgi")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.update(service_env(args, workdir, anilist_url))
+    # The service resolves ./chroma_db and friends against the working directory
+    os.chdir(workdir)
+
+    spec = importlib.util.spec_from_file_location("main_hybrid", os.path.join(HERE, "main-hybrid.py"))
+    service = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(service)
+
+    await service.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            return await benchmark(client, "asgi", args, payloads)
+    finally:
+        await service.app.router.shutdown()
+
+
+async def run_http(args, payloads: dict, anilist_url: str) -> list:
+    workdir = os.path.join(args.workdir, "http")
+    os.makedirs(workdir, exist_ok=True)
+    port = free_port()
+    env = {**os.environ, **service_env(args, workdir, anilist_url)}
+    if args.workers > 1:
+        command = [
+            sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"),
+            "--pythonpath", HERE, "--bind", f"127.0.0.1:{port}", "main-hybrid:app",
+        ]
+        env["WEB_CONCURRENCY"] = str(args.workers)
+    else:
+        command = [
+            sys.executable, "-m", "uvicorn", "main-hybrid:app", "--app-dir", HERE,
+            "--host", "127.0.0.1", "--port", str(port), "--no-access-log",
+        ]
+    log_path = os.path.join(workdir, "service.log")
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        # A kept-alive connection stays with the worker that accepted it, so with several
+        # workers every request opens its own and they are spread across the workers
+        limits = httpx.Limits(max_connections=max(args.concurrency),
+                              max_keepalive_connections=0 if args.workers > 1 else None)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None, limits=limits) as client:
+            results = await benchmark(client, "http", args, payloads, args.workers)
+    finally:
+        server.terminate()
+        server.wait()
+    return results + [{"transport": "http", "shutdown": check_shutdown(log_path, server.returncode)}]
+
+
+def check_shutdown(log_path: str, returncode: int) -> dict:
+    """Whether the service exited cleanly on SIGTERM, with the log lines saying otherwise"""
+    with open(log_path, errors="replace") as f:
+        problems = [line.rstrip() for line in f if any(marker in line for marker in UNCLEAN_SHUTDOWN)]
+    clean = returncode == 0 and not problems
+    print(f"Shutdown: {'clean' if clean else 'UNCLEAN'} (exit code {returncode})")
+    for line in problems:
+        print(f"  {line}")
+    return {"clean": clean, "returncode": returncode, "problems": problems}
+
+
+async def main(args):
+    if not args.model:
+        save_tiny_model(os.path.join(args.workdir, "tiny-clip"))
+    payloads = build_payloads(args)
+
+    # The fake AniList runs on this event loop; the service crawls it on startup
+    runner = web.AppRunner(create_fake_anilist(args.characters))
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    anilist_url = f"http://127.0.0.1:{port}/graphql"
+
+    results = []
+    try:
+        # HTTP first: the in-process run changes directory and environment
+        if "http" in args.transport:
+            results += await run_http(args, payloads, anilist_url)
+        if "asgi" in args.transport:
+            results += await run_asgi(args, payloads, anilist_url)
+    finally:
+        await runner.cleanup()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+def image_size(value: str) -> tuple:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transport', nargs='+', choices=['asgi', 'http'], default=['asgi', 'http'])
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help="requests per endpoint and concurrency level")
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--characters', type=int, default=200, help="size of the fake AniList character set")
+    parser.add_argument('--image-sizes', type=image_size, nargs='+',
+                        default=[(64, 64), (320, 240), (640, 480), (1280, 720), (1920, 1080), (3000, 2000)])
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'PNG', 'WEBP'])
+    parser.add_argument('--variants', type=int, default=2, help="images per size and format")
+    parser.add_argument('--model', default=None, help="CLIP model name or path (default: tiny random weights)")
+    parser.add_argument('--cache', action='store_true', help="leave the embedding cache enabled")
+    parser.add_argument('--workdir', default=None, help="service data directory (default: a temporary one)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="pre-forked gunicorn workers for the HTTP run (default: one uvicorn process)")
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--output', default=None, help="also write the results as JSON")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="clip-bench-"))
+    asyncio.run(main(args))
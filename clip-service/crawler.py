@@ -0,0 +1,327 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Iterable, Optional, Set, Tuple
+
+import aiohttp
+
+from ingestion import TokenBucket
+
+CHARACTERS_QUERY = '''
+query ($page: Int, $perPage: Int) {
+    Page(page: $page, perPage: $perPage) {
+        pageInfo {
+            currentPage
+            hasNextPage
+        }
+        characters(sort: FAVOURITES_DESC) {
+            id
+            name {
+                full
+                native
+            }
+            image {
+                large
+                medium
+            }
+            description
+            media(sort: POPULARITY_DESC, perPage: 3) {
+                nodes {
+                    title {
+                        romaji
+                        english
+                    }
+                    type
+                    coverImage {
+                        large
+                    }
+                }
+            }
+        }
+    }
+}
+'''
+
+
+def retry_after_seconds(value: Optional[str], default: float) -> float:
+    """Seconds to wait from a Retry-After header, which is either seconds or an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class CrawlCheckpoint:
+    """On-disk record of where the crawl is and which characters are stored
+
+    ``next_page`` is the first page that still has characters which were
+    neither stored nor given up on, so resuming from it never loses work.
+    ``page_cap`` is the page limit a crawl was completed under (None when it
+    reached AniList's last page), so raising the limit resumes the crawl.
+
+    Failures are kept with the page they were on and how often they failed;
+    a character that failed fewer than ``max_attempts`` times (a download
+    timing out, say) is tried again when the crawl resumes.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.next_page = 1
+        self.complete = False
+        self.page_cap: Optional[int] = None
+        self.ingested_ids: Set[int] = set()
+        # character id -> (failed attempts, page it was on)
+        self.failures: Dict[int, Tuple[int, int]] = {}
+        self.updated_at = None
+
+    @property
+    def failed_ids(self) -> Set[int]:
+        return set(self.failures)
+
+    def retryable(self) -> Dict[int, int]:
+        """Page of each failed character that still gets another attempt"""
+        return {char_id: page for char_id, (attempts, page) in self.failures.items() if attempts < self.max_attempts}
+
+    def resume_page(self) -> int:
+        return min([self.next_page, *self.retryable().values()])
+
+    @classmethod
+    def load(cls, path: str, max_attempts: int = 3) -> "CrawlCheckpoint":
+        checkpoint = cls(path, max_attempts)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                checkpoint.next_page = data.get('next_page', 1)
+                checkpoint.complete = data.get('complete', False)
+                checkpoint.page_cap = data.get('page_cap')
+                checkpoint.ingested_ids = set(data.get('ingested_ids', []))
+                checkpoint.failures = {int(char_id): tuple(failure)
+                                       for char_id, failure in data.get('failures', {}).items()}
+                # Checkpoints from before failures were retried only list the ids
+                for char_id in data.get('failed_ids', []):
+                    checkpoint.failures.setdefault(char_id, (1, 1))
+                checkpoint.updated_at = data.get('updated_at')
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable crawl checkpoint {path}: {e}")
+        return checkpoint
+
+    def save(self):
+        self.updated_at = time.time()
+        data = {
+            'next_page': self.next_page,
+            'complete': self.complete,
+            'page_cap': self.page_cap,
+            'ingested_ids': sorted(self.ingested_ids),
+            'failures': {str(char_id): list(failure) for char_id, failure in sorted(self.failures.items())},
+            'updated_at': self.updated_at,
+        }
+        # Write then rename so a crash never leaves a truncated checkpoint
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def finished(self, max_pages: Optional[int] = None) -> bool:
+        """Whether a crawl limited to ``max_pages`` pages has nothing left to do"""
+        if not self.complete or self.retryable():
+            return False
+        return self.page_cap is None or (max_pages is not None and max_pages <= self.page_cap)
+
+    def to_dict(self) -> dict:
+        return {
+            'next_page': self.next_page,
+            'complete': self.complete,
+            'page_cap': self.page_cap,
+            'ingested': len(self.ingested_ids),
+            'failed': len(self.failures),
+            'retrying': len(self.retryable()),
+            'updated_at': self.updated_at,
+        }
+
+
+class AniListCrawler:
+    """Walks AniList character pages, checkpointing progress as it goes
+
+    Characters already in ``checkpoint.ingested_ids`` are skipped. Callers
+    report each character as stored or failed through ``mark_stored`` and
+    ``mark_failed``; the page cursor only moves past a page once all of its
+    characters are accounted for. A resumed crawl starts from the earliest
+    page with a failure still worth retrying.
+
+    The checkpoint is written at most every ``save_interval`` seconds while
+    characters are reported, and when the crawl completes; ``flush`` writes
+    anything still unsaved. Progress lost to a crash in between only costs
+    the vectors' lookup on the next resume, since stored vectors aren't
+    downloaded again.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        checkpoint: CrawlCheckpoint,
+        url: str = 'https://graphql.anilist.co',
+        per_page: int = 50,
+        max_pages: Optional[int] = None,
+        requests_per_second: float = 0.5,
+        max_retries: int = 5,
+        request_timeout: float = 30.0,
+        save_interval: float = 5.0,
+    ):
+        self.session = session
+        self.checkpoint = checkpoint
+        self.url = url
+        self.per_page = per_page
+        self.max_pages = max_pages
+        self.bucket = TokenBucket(requests_per_second, capacity=1)
+        self.max_retries = max_retries
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout)
+        self.pages_fetched = 0
+        self.skipped = 0
+        self._pending: Dict[int, Set[int]] = {}
+        self._last_page = checkpoint.next_page - 1
+        self._exhausted = False
+        self.capped = False
+        self.save_interval = save_interval
+        self._saved_at = 0.0
+        self._unsaved = False
+
+    async def fetch_page(self, page: int) -> dict:
+        """Fetch one page, backing off when AniList rate limits us or can't be reached"""
+        payload = {'query': CHARACTERS_QUERY, 'variables': {'page': page, 'perPage': self.per_page}}
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                async with self.session.post(self.url, json=payload, timeout=self.timeout) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        return data['data']['Page']
+                    if response.status != 429 and response.status < 500:
+                        raise RuntimeError(f"AniList returned {response.status} for page {page}")
+                    delay = retry_after_seconds(response.headers.get('Retry-After'), 2 ** attempt)
+                    problem = f"returned {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = 2 ** attempt
+                problem = f"request failed ({str(e) or type(e).__name__})"
+            print(f"AniList {problem} for page {page}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+        raise RuntimeError(f"Giving up on page {page} after {self.max_retries} retries")
+
+    async def pages(self, start: int = 1) -> AsyncIterator[Tuple[int, dict]]:
+        """Yield ``(page, data)`` from ``start`` until the last or ``max_pages`` page"""
+        page = start
+        self.capped = False
+        if self.max_pages is not None and start > self.max_pages:
+            return
+        while True:
+            data = await self.fetch_page(page)
+            self.pages_fetched += 1
+            # Stopping at max_pages counts as the end, or every later start would crawl again
+            self.capped = self._is_cap(page) and bool(data.get('pageInfo', {}).get('hasNextPage'))
+            yield page, data
+            if not data.get('pageInfo', {}).get('hasNextPage') or self._is_cap(page):
+                return
+            page += 1
+
+    def _is_cap(self, page: int) -> bool:
+        return self.max_pages is not None and page >= self.max_pages
+
+    async def catalog(self) -> AsyncIterator[dict]:
+        """Yield every character, ignoring and not touching the checkpoint"""
+        async for _, data in self.pages():
+            for char in data.get('characters') or []:
+                yield char
+
+    async def characters(self) -> AsyncIterator[dict]:
+        """Yield characters that still need ingesting, page by page"""
+        checkpoint = self.checkpoint
+        if checkpoint.finished(self.max_pages):
+            return
+        # The page cap was raised since the crawl completed
+        checkpoint.complete = False
+        start = checkpoint.resume_page()
+        if self.max_pages is not None and start > self.max_pages:
+            # Every page under a lowered cap is done already
+            checkpoint.complete = True
+            checkpoint.page_cap = self.max_pages
+            checkpoint.save()
+            return
+
+        retry = set(checkpoint.retryable())
+        async for page, data in self.pages(start):
+            self._last_page = max(page, self._last_page)
+            todo = []
+            for char in data.get('characters') or []:
+                if char['id'] in checkpoint.ingested_ids or (char['id'] in checkpoint.failures and char['id'] not in retry):
+                    self.skipped += 1
+                    continue
+                todo.append(char)
+            self._pending[page] = {char['id'] for char in todo}
+            self._exhausted = not data.get('pageInfo', {}).get('hasNextPage') or self._is_cap(page)
+            self._advance()
+
+            for char in todo:
+                yield char
+
+    def mark_stored(self, ids: Iterable[int]):
+        ids = set(ids)
+        self.checkpoint.ingested_ids.update(ids)
+        for char_id in ids:
+            self.checkpoint.failures.pop(char_id, None)
+        self._resolve(ids)
+
+    def mark_failed(self, ids: Iterable[int]):
+        ids = set(ids)
+        failures = self.checkpoint.failures
+        for char_id in ids:
+            page = next((p for p, pending in self._pending.items() if char_id in pending), self._last_page)
+            attempts = failures[char_id][0] if char_id in failures else 0
+            failures[char_id] = (attempts + 1, page)
+        self._resolve(ids)
+
+    def _resolve(self, ids: Set[int]):
+        for pending in self._pending.values():
+            pending -= ids
+        self._advance()
+
+    def _advance(self):
+        # Drop finished pages; the cursor is the oldest page with work left
+        for page in [p for p, pending in self._pending.items() if not pending]:
+            del self._pending[page]
+        self.checkpoint.next_page = min(self._pending) if self._pending else self._last_page + 1
+        # Only complete once the last page is fetched and all of it is accounted for
+        if self._exhausted and not self._pending:
+            self.checkpoint.complete = True
+            self.checkpoint.page_cap = self.max_pages if self.capped else None
+        self._unsaved = True
+        if self.checkpoint.complete or time.monotonic() - self._saved_at >= self.save_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the checkpoint if anything changed since it was last written"""
+        if self._unsaved:
+            self.checkpoint.save()
+            self._saved_at = time.monotonic()
+            self._unsaved = False
+
+    def to_dict(self) -> dict:
+        return {
+            'pages_fetched': self.pages_fetched,
+            'skipped': self.skipped,
+            'pages_in_flight': len(self._pending),
+            **self.checkpoint.to_dict(),
+        }
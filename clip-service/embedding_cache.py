@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """LRU cache of image embeddings keyed by a hash of the image bytes
+
+    The in-memory tier is bounded by ``max_bytes`` of embedding data and
+    entries expire after ``ttl_seconds``. When ``disk_dir`` is set, entries
+    are also written there as ``.npy`` files and memory misses fall back to
+    disk, so the cache survives restarts and can be shared between workers.
+    Embeddings of different models don't mix: disk entries live under a
+    ``namespace`` subdirectory naming the model and backend that made them.
+
+    ``get`` and ``put`` may block on disk. On the event loop use
+    ``get_async`` and ``put_async``, which only touch memory on the loop,
+    read the disk tier on a thread and write it in the background.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 3600, disk_dir: Optional[str] = None,
+                 namespace: str = "default"):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.namespace = namespace
+        self.disk_dir = os.path.join(disk_dir, namespace) if disk_dir else None
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        embedding = self._get_memory(key)
+        if embedding is None:
+            embedding = self._found_on_disk(key, self._read_disk(key))
+        return embedding
+
+    async def get_async(self, key: str) -> Optional[np.ndarray]:
+        embedding = self._get_memory(key)
+        if embedding is None:
+            disk = None
+            if self.disk_dir:
+                disk = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+            embedding = self._found_on_disk(key, disk)
+        return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._insert(key, embedding)
+        self._write_disk(key, embedding)
+
+    def put_async(self, key: str, embedding: np.ndarray):
+        """``put`` from the event loop; the disk write runs in the background"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._insert(key, embedding)
+        if self.disk_dir:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, embedding)
+
+    def _get_memory(self, key: str) -> Optional[np.ndarray]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            embedding, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            self._remove(key)
+        return None
+
+    def _found_on_disk(self, key: str, embedding: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._insert(key, embedding)
+        return embedding
+
+    def _insert(self, key: str, embedding: np.ndarray):
+        if key in self._entries:
+            self._remove(key)
+        if embedding.nbytes > self.max_bytes:
+            return
+        self._entries[key] = (embedding, time.monotonic() + self.ttl)
+        self.current_bytes += embedding.nbytes
+        while self.current_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        embedding, _ = self._entries.pop(key)
+        self.current_bytes -= embedding.nbytes
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+
+    def _read_disk(self, key: str) -> Optional[np.ndarray]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, embedding: np.ndarray):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers never load a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, embedding)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write cached embedding {key}: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            "disk_dir": self.disk_dir,
+            "namespace": self.namespace,
+        }
@@ -0,0 +1,213 @@
+"""Export the CLIP vision tower to ONNX and check it against PyTorch
+
+Only the vision encoder and projection are exported (the text tower is
+never used for image lookups), with embeddings normalized inside the graph.
+``--model`` takes a hub name or a saved artifact such as CLIP_MODEL_DIR:
+
+    python export_onnx.py export --model openai/clip-vit-base-patch32 --out models --quantize
+
+``--quantize`` also writes a dynamically quantized int8 copy. ``check``
+encodes stored character images with fp32 PyTorch and each ONNX model,
+and reports embedding similarity, top-k neighbour agreement over the
+stored character set, per-image latency and resident memory:
+
+    python export_onnx.py check --out models --limit 200 --k 5
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
+
+from preprocess import ImagePreprocessor, load_image
+from search_index import ExactSearchIndex, top_k
+
+FP32_FILE = "clip-vision.onnx"
+INT8_FILE = "clip-vision-int8.onnx"
+
+
+class VisionTower(torch.nn.Module):
+    """``CLIPVisionModelWithProjection`` image embeddings plus normalization"""
+
+    def __init__(self, model: CLIPVisionModelWithProjection):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values):
+        pooled = self.vision_model(pixel_values=pixel_values).pooler_output
+        embeddings = self.visual_projection(pooled)
+        return embeddings / embeddings.norm(dim=-1, keepdim=True)
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def export(args):
+    os.makedirs(args.out, exist_ok=True)
+    model = CLIPVisionModelWithProjection.from_pretrained(args.model).eval()
+    processor = CLIPImageProcessor.from_pretrained(args.model)
+    tower = VisionTower(model).eval()
+    size = processor.crop_size['height']
+    path = os.path.join(args.out, FP32_FILE)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            tower,
+            (torch.zeros(1, 3, size, size),),
+            path,
+            input_names=["pixel_values"],
+            output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=args.opset,
+        )
+    # The service reads resize and normalization settings from here
+    processor.save_pretrained(args.out)
+    print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+    if args.quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = os.path.join(args.out, INT8_FILE)
+        # Only the transformer matmuls; the patch embedding conv stays fp32
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+        print(f"Wrote {int8_path} ({os.path.getsize(int8_path) / 1e6:.1f} MB)")
+
+
+def load_collection(args):
+    import chromadb
+
+    name = args.collection
+    if not name:
+        try:
+            with open(os.path.join(args.chroma_path, 'active_collection')) as f:
+                name = f.read().strip()
+        except OSError:
+            name = None
+    client = chromadb.PersistentClient(path=args.chroma_path)
+    return client.get_collection(name or "anime_characters")
+
+
+def fetch_images(index: ExactSearchIndex, limit: int):
+    import requests
+
+    row_ids, columns = index._data[1:3]
+    rows, images, seen = [], [], set()
+    for row in range(len(row_ids)):
+        if len(rows) >= limit:
+            break
+        # Characters with several vectors share one reference image
+        if columns['anilist_id'][row] in seen:
+            continue
+        seen.add(columns['anilist_id'][row])
+        try:
+            response = requests.get(columns['image_url'][row], timeout=10)
+            response.raise_for_status()
+            images.append(load_image(response.content))
+            rows.append(row)
+        except Exception as e:
+            print(f"Skipping {row_ids[row]}: {e}")
+    return np.asarray(rows), images
+
+
+def neighbours(index: ExactSearchIndex, queries: np.ndarray, rows: np.ndarray, k: int) -> list:
+    scores = index.scores(queries)
+    # Each query image is in the index itself; ignore that trivial match
+    anilist_ids = index._data[2]['anilist_id']
+    scores[anilist_ids[None, :] == anilist_ids[rows][:, None]] = -np.inf
+    return [top_k(row_scores, k) for row_scores in scores]
+
+
+def encode_all(encode, batches: list) -> np.ndarray:
+    return np.concatenate([np.asarray(encode(batch)) for batch in batches])
+
+
+def time_encoder(encode, pixel_values: torch.Tensor, batch_size: int, repeats: int) -> float:
+    batch = pixel_values[:batch_size]
+    encode(batch)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        encode(batch)
+    return (time.perf_counter() - started) * 1000 / (repeats * len(batch))
+
+
+def check(args):
+    from onnx_backend import OnnxImageEncoder
+
+    index = ExactSearchIndex.from_collection(load_collection(args))
+    print(f"Loaded {index.count()} stored characters")
+    rows, images = fetch_images(index, args.limit)
+    if not images:
+        print("No character images could be fetched")
+        return
+
+    processor = CLIPImageProcessor.from_pretrained(args.model)
+    preprocessor = ImagePreprocessor.from_processor(processor)
+    batches = [preprocessor(images[i:i + args.batch]).clone() for i in range(0, len(images), args.batch)]
+
+    before = rss_mb()
+    model = CLIPVisionModelWithProjection.from_pretrained(args.model).eval()
+    print(f"torch-fp32 loaded, +{rss_mb() - before:.0f} MB RSS")
+
+    def torch_encode(pixel_values):
+        with torch.no_grad():
+            features = model(pixel_values=pixel_values).image_embeds
+            return (features / features.norm(dim=-1, keepdim=True)).numpy()
+
+    encoders = [("torch-fp32", torch_encode)]
+    for label, filename in (("onnx-fp32", FP32_FILE), ("onnx-int8", INT8_FILE)):
+        path = os.path.join(args.out, filename)
+        if os.path.exists(path):
+            before = rss_mb()
+            session = OnnxImageEncoder(path, threads=torch.get_num_threads())
+            print(f"{label} loaded, +{rss_mb() - before:.0f} MB RSS")
+            encoders.append((label, lambda pixel_values, s=session: s(pixel_values.numpy())))
+
+    baseline = encode_all(torch_encode, batches)
+    expected = neighbours(index, baseline, rows, args.k)
+    print(f"\n{len(images)} query images, top-{args.k} neighbours (self match excluded)")
+    for label, encode in encoders:
+        embeddings = encode_all(encode, batches)
+        cosine = np.sum(embeddings * baseline, axis=1)
+        actual = neighbours(index, embeddings, rows, args.k)
+        top1 = np.mean([e[0] == a[0] for e, a in zip(expected, actual)])
+        overlap = np.mean([len(set(e) & set(a)) / len(e) for e, a in zip(expected, actual)])
+        single = time_encoder(encode, batches[0], 1, args.repeats)
+        batched = time_encoder(encode, batches[0], args.batch, args.repeats)
+        print(f"{label:11s} cosine mean {cosine.mean():.5f} min {cosine.min():.5f}  "
+              f"top-1 {top1:.3f}  top-{args.k} overlap {overlap:.3f}  "
+              f"{single:7.2f}ms/img batch 1  {batched:7.2f}ms/img batch {len(batches[0])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help="export the vision tower")
+    export_parser.add_argument('--model', default="openai/clip-vit-base-patch32")
+    export_parser.add_argument('--out', default="models")
+    export_parser.add_argument('--opset', type=int, default=14)
+    export_parser.add_argument('--quantize', action='store_true', help="also write a dynamic int8 model")
+
+    check_parser = commands.add_parser('check', help="compare the ONNX models against fp32 PyTorch")
+    check_parser.add_argument('--model', default="openai/clip-vit-base-patch32")
+    check_parser.add_argument('--out', default="models")
+    check_parser.add_argument('--chroma-path', default="./chroma_db")
+    check_parser.add_argument('--collection', default=None, help="defaults to the active collection")
+    check_parser.add_argument('--limit', type=int, default=200, help="query images to fetch")
+    check_parser.add_argument('--k', type=int, default=5)
+    check_parser.add_argument('--batch', type=int, default=16)
+    check_parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args)
+    else:
+        check(args)
@@ -0,0 +1,95 @@
+"""Local stand-in for the AniList GraphQL API and its image CDN
+
+Serves deterministic synthetic characters so crawling and ingestion can be
+exercised offline:
+
+    python fake_anilist.py --characters 2000 --port 8099
+    ANILIST_URL=http://localhost:8099/graphql python main-hybrid.py
+"""
+import argparse
+import io
+import math
+
+from aiohttp import web
+from PIL import Image
+
+ANIME_TITLES = ["Naruto", "Dragon Ball", "One Piece", "Bleach", "Death Note", "Demon Slayer", "Fullmetal Alchemist"]
+
+
+def make_character(character_id: int, base_url: str) -> dict:
+    title_index = character_id % len(ANIME_TITLES)
+    title = ANIME_TITLES[title_index]
+    return {
+        'id': character_id,
+        'name': {'full': f"Character {character_id}", 'native': None},
+        'image': {
+            'large': f"{base_url}/images/{character_id}.jpg",
+            'medium': f"{base_url}/images/{character_id}.jpg?size=medium",
+        },
+        'description': f"Synthetic character {character_id}<br>from {title}",
+        'media': {'nodes': [{
+            'title': {'romaji': title, 'english': title},
+            'type': 'ANIME',
+            'coverImage': {'large': f"{base_url}/covers/{title_index}.jpg"},
+        }]},
+    }
+
+
+def make_image(character_id: int, size: int) -> bytes:
+    # A colour gradient per character keeps embeddings distinct
+    r = (character_id * 67) % 256
+    g = (character_id * 131) % 256
+    b = (character_id * 29) % 256
+    image = Image.new('RGB', (size, size), (r, g, b))
+    stripe = Image.new('RGB', (size // 4, size), (255 - r, 255 - g, 255 - b))
+    image.paste(stripe, (int(size * (character_id % 4) / 4), 0))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def create_app(total_characters: int) -> web.Application:
+    app = web.Application()
+
+    async def graphql(request: web.Request) -> web.Response:
+        body = await request.json()
+        variables = body.get('variables') or {}
+        page = int(variables.get('page', 1))
+        per_page = int(variables.get('perPage', 50))
+        base_url = f"{request.scheme}://{request.host}"
+
+        first = (page - 1) * per_page + 1
+        last = min(first + per_page - 1, total_characters)
+        characters = [make_character(i, base_url) for i in range(first, last + 1)]
+        return web.json_response({'data': {'Page': {
+            'pageInfo': {
+                'currentPage': page,
+                'hasNextPage': page < math.ceil(total_characters / per_page),
+            },
+            'characters': characters,
+        }}})
+
+    async def image(request: web.Request) -> web.Response:
+        character_id = int(request.match_info['character_id'])
+        if character_id > total_characters:
+            raise web.HTTPNotFound()
+        size = 230 if request.query.get('size') == 'medium' else 460
+        return web.Response(body=make_image(character_id, size), content_type='image/jpeg')
+
+    async def cover(request: web.Request) -> web.Response:
+        title_index = int(request.match_info['title_index'])
+        return web.Response(body=make_image(10000 + title_index, 460), content_type='image/jpeg')
+
+    app.router.add_post('/graphql', graphql)
+    app.router.add_get('/images/{character_id}.jpg', image)
+    app.router.add_get('/covers/{title_index}.jpg', cover)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--characters', type=int, default=1000)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8099)
+    args = parser.parse_args()
+    web.run_app(create_app(args.characters), host=args.host, port=args.port)
@@ -0,0 +1,22 @@
+# Pre-forked multi-worker serving:
+#   gunicorn -c gunicorn.conf.py main-hybrid:app   (main:app inside the Docker image)
+# The app is imported once in the master, which loads the CPU torch model there so
+# every forked worker shares its weights copy-on-write instead of loading its own.
+# Anything that starts native threads (torch's thread pools, chromadb, onnxruntime)
+# is left to the workers: a worker inheriting them aborts on exit. bench_service.py
+# --workers N checks the service log for a clean shutdown.
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+# Read by the app when gunicorn imports it
+os.environ.setdefault("SERVE_PREFORK", "true")
+os.environ.setdefault("SERVE_WORKERS", str(workers))
+# Workers map one shared snapshot of the index; chroma would keep an HNSW index per worker
+os.environ.setdefault("SEARCH_BACKEND", "numpy")
+
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+bind = os.getenv("BIND", "0.0.0.0:8001")
+# Startup loads the index and may run the first ingestion in the writer
+timeout = int(os.getenv("WORKER_TIMEOUT", "600"))
+graceful_timeout = 30
@@ -0,0 +1,309 @@
+import asyncio
+import hashlib
+import io
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, List, Optional, Union
+
+import aiohttp
+import numpy as np
+from PIL import Image
+
+
+class TokenBucket:
+    """Async token bucket limiting how fast requests are started"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class IngestionProgress:
+    """Counters for a running (or the last finished) ingestion"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = "idle"
+        self.queued = 0
+        self.downloaded = 0
+        self.decoded = 0
+        self.encoded = 0
+        self.reused = 0
+        self.stored = 0
+        self.failed = 0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self) -> dict:
+        elapsed = None
+        if self.started_at:
+            elapsed = round((self.finished_at or time.time()) - self.started_at, 2)
+        return {
+            "state": self.state,
+            "queued": self.queued,
+            "downloaded": self.downloaded,
+            "decoded": self.decoded,
+            "encoded": self.encoded,
+            "reused": self.reused,
+            "stored": self.stored,
+            "failed": self.failed,
+            "error": self.error,
+            "elapsed_seconds": elapsed,
+        }
+
+
+def decode_image_bytes(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+
+class IngestionPipeline:
+    """Streams items through download -> decode -> batched encode -> chunked store
+
+    Each item is a dict with ``id``, ``image_url`` and ``metadata``, or with
+    ``text`` instead of ``image_url`` for a text prompt, which skips the
+    download and is encoded with ``encode_text_batch``. Downloads
+    share one pooled ``aiohttp`` session, are limited to ``concurrency`` at a
+    time and started no faster than ``requests_per_second``. Decoded images are
+    encoded ``encode_batch_size`` at a time with ``encode_batch`` and the results
+    are written ``store_chunk_size`` at a time with ``store_batch``; both run on
+    ``executor`` so the event loop keeps serving requests.
+
+    An image URL is downloaded and encoded once per run: later items with the
+    same URL (every character of an anime shares its cover) reuse the first
+    one's embedding, for up to ``shared_urls`` recent URLs.
+
+    The SHA-1 of each downloaded image is recorded as ``content_hash`` in the
+    item's metadata. ``on_stored`` is called with the items of every chunk once it is written
+    and ``on_failed`` with items that could not be downloaded or encoded.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        encode_batch: Callable[[List[Image.Image]], np.ndarray],
+        store_batch: Callable[[List[str], List[List[float]], List[Dict[str, Any]]], None],
+        executor: Optional[Executor] = None,
+        concurrency: int = 8,
+        requests_per_second: float = 10.0,
+        encode_batch_size: int = 16,
+        store_chunk_size: int = 64,
+        download_timeout: float = 10.0,
+        progress: Optional[IngestionProgress] = None,
+        on_stored: Optional[Callable[[List[dict]], None]] = None,
+        on_failed: Optional[Callable[[List[dict]], None]] = None,
+        decode: Callable[[bytes], Image.Image] = decode_image_bytes,
+        encode_text_batch: Optional[Callable[[List[str]], np.ndarray]] = None,
+        shared_urls: int = 4096,
+    ):
+        self.session = session
+        self.encode_batch = encode_batch
+        self.store_batch = store_batch
+        self.executor = executor
+        self.concurrency = max(1, concurrency)
+        self.bucket = TokenBucket(requests_per_second)
+        self.encode_batch_size = max(1, encode_batch_size)
+        self.store_chunk_size = max(1, store_chunk_size)
+        self.timeout = aiohttp.ClientTimeout(total=download_timeout)
+        self.progress = progress or IngestionProgress()
+        self.on_stored = on_stored
+        self.on_failed = on_failed
+        self.decode = decode
+        self.encode_text_batch = encode_text_batch
+        self.shared_urls = max(0, shared_urls)
+        # URL -> future of (embedding, content hash), or None if that fetch failed
+        self._shared: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+
+    async def run(self, items: Union[Iterable[dict], AsyncIterable[dict]]) -> int:
+        """Ingest all items and return how many were stored"""
+        progress = self.progress
+        progress.reset()
+        progress.state = "running"
+        progress.started_at = time.time()
+        self._shared = OrderedDict()
+
+        # Bounded queues give backpressure between the stages
+        download_queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        encode_queue: asyncio.Queue = asyncio.Queue(maxsize=self.encode_batch_size * 2)
+
+        async def feed():
+            if hasattr(items, '__aiter__'):
+                async for item in items:
+                    progress.queued += 1
+                    await download_queue.put(item)
+            else:
+                for item in items:
+                    progress.queued += 1
+                    await download_queue.put(item)
+
+            for _ in downloaders:
+                await download_queue.put(None)
+            await asyncio.gather(*downloaders)
+            await encode_queue.put(None)
+
+        downloaders = [asyncio.create_task(self._download_worker(download_queue, encode_queue))
+                       for _ in range(self.concurrency)]
+        encoder = asyncio.create_task(self._encode_worker(encode_queue))
+        stages = [asyncio.create_task(feed())] + downloaders + [encoder]
+
+        try:
+            # A failed stage (say, store_batch raising) would leave the others blocked on its
+            # queue forever, so the first failure ends the run
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+            progress.state = "done"
+        except BaseException as e:
+            for task in stages:
+                task.cancel()
+            progress.state = "failed"
+            progress.error = str(e) or type(e).__name__
+            raise
+        finally:
+            progress.finished_at = time.time()
+
+        return progress.stored
+
+    async def _download_worker(self, download_queue: asyncio.Queue, encode_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await download_queue.get()
+            if item is None:
+                return
+            if 'text' in item:
+                await encode_queue.put((item, item['text']))
+                continue
+            shared = await self._claim(item['image_url'])
+            if shared is not None:
+                embedding, content_hash = shared
+                item['metadata']['content_hash'] = content_hash
+                self.progress.reused += 1
+                await encode_queue.put((item, embedding))
+                continue
+            try:
+                await self.bucket.acquire()
+                async with self.session.get(item['image_url'], timeout=self.timeout) as response:
+                    if response.status != 200:
+                        raise ValueError(f"HTTP {response.status}")
+                    data = await response.read()
+                self.progress.downloaded += 1
+                item['metadata']['content_hash'] = hashlib.sha1(data).hexdigest()
+
+                image = await loop.run_in_executor(None, self.decode, data)
+                self.progress.decoded += 1
+            except Exception as e:
+                print(f"Failed to fetch image for {item['id']} from {item['image_url']}: {e}")
+                self._release(item['image_url'], None)
+                self._failed([item])
+                continue
+            await encode_queue.put((item, image))
+
+    async def _claim(self, url: str) -> Optional[tuple]:
+        """(embedding, content hash) of an earlier item with this URL, or None if this item fetches it"""
+        if not self.shared_urls:
+            return None
+        while True:
+            shared = self._shared.get(url)
+            if shared is None:
+                self._shared[url] = asyncio.get_running_loop().create_future()
+                self._trim_shared()
+                return None
+            result = await shared
+            if result is not None:
+                return result
+            # That fetch failed and gave the URL up, so the next waiter tries it
+
+    def _release(self, url: str, result: Optional[tuple]):
+        shared = self._shared.get(url)
+        if shared is not None and not shared.done():
+            shared.set_result(result)
+        if result is None:
+            self._shared.pop(url, None)
+
+    def _trim_shared(self):
+        # Only finished entries are dropped; pending ones still have waiters
+        while len(self._shared) > self.shared_urls:
+            oldest = next((url for url, shared in self._shared.items() if shared.done()), None)
+            if oldest is None:
+                return
+            del self._shared[oldest]
+
+    async def _encode_worker(self, encode_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        pending: List[tuple] = []
+        finished = False
+
+        while not finished:
+            batch = []
+            entry = await encode_queue.get()
+            while entry is not None:
+                batch.append(entry)
+                if len(batch) >= self.encode_batch_size or encode_queue.empty():
+                    break
+                entry = await encode_queue.get()
+            finished = entry is None
+
+            # Items whose image was already encoded for another item arrive with its embedding
+            pending.extend(entry for entry in batch if isinstance(entry[1], np.ndarray))
+            images = [entry for entry in batch if 'text' not in entry[0] and not isinstance(entry[1], np.ndarray)]
+            texts = [entry for entry in batch if 'text' in entry[0]]
+            for group, encode, kind in ((images, self.encode_batch, "images"), (texts, self.encode_text_batch, "prompts")):
+                if not group:
+                    continue
+                try:
+                    embeddings = await loop.run_in_executor(
+                        self.executor, encode, [payload for _, payload in group]
+                    )
+                except Exception as e:
+                    print(f"Failed to encode batch of {len(group)} {kind}: {e}")
+                    for item, _ in group:
+                        if 'image_url' in item:
+                            self._release(item['image_url'], None)
+                    self._failed([item for item, _ in group])
+                else:
+                    self.progress.encoded += len(group)
+                    for (item, _), embedding in zip(group, embeddings):
+                        if 'image_url' in item:
+                            self._release(item['image_url'], (embedding, item['metadata'].get('content_hash')))
+                        pending.append((item, embedding))
+
+            while len(pending) >= self.store_chunk_size or (finished and pending):
+                chunk, pending = pending[:self.store_chunk_size], pending[self.store_chunk_size:]
+                await self._store(chunk)
+
+    async def _store(self, chunk: List[tuple]):
+        ids = [str(item['id']) for item, _ in chunk]
+        embeddings = [embedding.tolist() for _, embedding in chunk]
+        metadatas = [item['metadata'] for item, _ in chunk]
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.store_batch, ids, embeddings, metadatas
+        )
+        self.progress.stored += len(chunk)
+        print(f"Stored {self.progress.stored} vectors so far")
+        if self.on_stored:
+            self.on_stored([item for item, _ in chunk])
+
+    def _failed(self, items: List[dict]):
+        self.progress.failed += len(items)
+        if self.on_failed:
+            self.on_failed(items)
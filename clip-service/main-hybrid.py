@@ -1,30 +1,220 @@
 import os
 import io
 import base64
+import functools
+import hashlib
 import json
+import time
+from collections import Counter
+from contextlib import nullcontext
 from typing import List, Optional
 import numpy as np
 from PIL import Image
 import torch
-from transformers import CLIPProcessor, CLIPModel
-import chromadb
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from transformers import CLIPImageProcessor, CLIPTextModelWithProjection, CLIPTokenizer, CLIPVisionModelWithProjection
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 import uvicorn
-import requests
 import asyncio
 import aiohttp
 import random
+from concurrent.futures import ThreadPoolExecutor
+from batching import MicroBatcher, QueueFullError, SingleFlight
+from ingestion import IngestionPipeline, IngestionProgress
+from crawler import AniListCrawler, CrawlCheckpoint
+from embedding_cache import EmbeddingCache
+from search_index import ExactSearchIndex, create_search_backend
+from preprocess import ImagePreprocessor, StageTimings, load_image
+from metrics import Histogram, MetricsWriter
+from profiling import RequestProfiler
+from records import CharacterRecordCache, dumps, encode_analysis
+from neighbor_graph import NeighborGraph
+from anime_index import AnimeIndex
+from prompt_cache import PromptEmbeddingCache, prompt_key
+from workers import CountRequests, RequestCounter, WorkerRegistry, WriterLock
 
 app = FastAPI(title="Anime CLIP Service - Hybrid")
 
+# Micro-batching settings for uploaded image encoding
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+# Histogram buckets for the batch sizes reported on /metrics
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Inference worker pool and admission control
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "64"))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "2"))
+
+# CLIP weights: the vision tower is loaded from CLIP_MODEL_DIR when it holds a saved
+# artifact, otherwise from CLIP_MODEL_NAME and then saved there for the next start
+CLIP_MODEL_NAME = os.getenv("CLIP_MODEL_NAME", "openai/clip-vit-base-patch32")
+CLIP_MODEL_DIR = os.getenv("CLIP_MODEL_DIR", "./models/clip-vision")
+
+# Text tower, only loaded when text prompt vectors are indexed
+CLIP_TEXT_MODEL_DIR = os.getenv("CLIP_TEXT_MODEL_DIR", "./models/clip-text")
+
+# Image encoder: "torch" runs the vision tower in PyTorch, "onnx" runs the one
+# exported by export_onnx.py (point ONNX_MODEL_PATH at clip-vision-int8.onnx for int8)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "./models/clip-vision.onnx")
+
+# Dummy batches run through the model before reporting ready, and the queue
+# fill fraction at which the readiness probe fails so traffic is shed
+WARMUP_ITERATIONS = int(os.getenv("WARMUP_ITERATIONS", "2"))
+READY_QUEUE_THRESHOLD = float(os.getenv("READY_QUEUE_THRESHOLD", "0.8"))
+
+# Largest body accepted by /analyze-binary, and the most pixels we decode
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "20"))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(4096 * 4096)))
+
+# Slow-request profiling: "off", "header" (only requests sent with X-Profile: 1) or
+# "sample" (header, plus PROFILE_SAMPLE_RATE of other analyze calls, kept only when
+# slower than PROFILE_THRESHOLD_MS). Profiles are zips in a PROFILE_DIR ring buffer.
+PROFILING = os.getenv("PROFILING", "off")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", "500"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+PROFILE_TORCH = os.getenv("PROFILE_TORCH", "true").lower() == "true"
+PROFILED_PATHS = ("/analyze", "/analyze-binary", "/re-examine", "/search-text")
+
+# /analyze-batch: images per encode/search pass, and per-request item and body limits
+ANALYZE_BATCH_SIZE = int(os.getenv("ANALYZE_BATCH_SIZE", "16"))
+ANALYZE_BATCH_MAX_ITEMS = int(os.getenv("ANALYZE_BATCH_MAX_ITEMS", "1000"))
+ANALYZE_BATCH_MAX_MB = float(os.getenv("ANALYZE_BATCH_MAX_MB", "200"))
+
+# Character database ingestion
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "8"))
+INGEST_RATE_LIMIT = float(os.getenv("INGEST_RATE_LIMIT", "10"))
+INGEST_ENCODE_BATCH = int(os.getenv("INGEST_ENCODE_BATCH", "16"))
+INGEST_ADD_CHUNK = int(os.getenv("INGEST_ADD_CHUNK", "64"))
+
+# AniList crawl (point ANILIST_URL at fake_anilist.py for local runs)
+ANILIST_URL = os.getenv("ANILIST_URL", "https://graphql.anilist.co")
+ANILIST_PER_PAGE = int(os.getenv("ANILIST_PER_PAGE", "50"))
+ANILIST_MAX_PAGES = int(os.getenv("ANILIST_MAX_PAGES", "200"))
+ANILIST_RATE_LIMIT = float(os.getenv("ANILIST_RATE_LIMIT", "0.5"))
+CRAWL_CHECKPOINT_PATH = os.getenv("CRAWL_CHECKPOINT_PATH", "./chroma_db/crawl_checkpoint.json")
+# A character whose image failed is retried when the crawl resumes, until it has failed this often
+CRAWL_MAX_ATTEMPTS = int(os.getenv("CRAWL_MAX_ATTEMPTS", "3"))
+
+# Embedding cache for repeated uploads (EMBEDDING_CACHE_DIR enables the disk tier)
+EMBEDDING_CACHE_MB = float(os.getenv("EMBEDDING_CACHE_MB", "64"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR") or None
+# The disk tier outlives the process, so its entries are kept apart per encoder: switching
+# INFERENCE_BACKEND, the ONNX model (fp32 or int8) or the CLIP weights starts an empty one
+EMBEDDING_CACHE_NAMESPACE = f"{INFERENCE_BACKEND}-" + hashlib.sha1((
+    ONNX_MODEL_PATH if INFERENCE_BACKEND == "onnx" else f"{CLIP_MODEL_NAME}:{os.path.abspath(CLIP_MODEL_DIR)}"
+).encode()).hexdigest()[:12]
+
+# Vector search backend: "chroma" queries the collection, "numpy" searches an in-memory
+# copy, "two_stage" scores compressed codes ("pca" or "int8") and reranks the best
+# TWO_STAGE_CANDIDATES rows at full precision. gunicorn.conf.py defaults it to "numpy"
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "chroma")
+SEARCH_DTYPE = os.getenv("SEARCH_DTYPE", "float32")
+TWO_STAGE_COMPRESSION = os.getenv("TWO_STAGE_COMPRESSION", "pca")
+TWO_STAGE_DIMENSION = int(os.getenv("TWO_STAGE_DIMENSION", "64"))
+TWO_STAGE_CANDIDATES = int(os.getenv("TWO_STAGE_CANDIDATES", "200"))
+# Vectors indexed per character: the "large" image always, plus any of "medium",
+# "cover" (media cover images), "name" and "description" (CLIP text prompts).
+# A character's vector scores are combined with SCORE_AGGREGATION ("max" or "mean")
+INDEX_VECTOR_KINDS = ["large"] + [
+    kind.strip() for kind in os.getenv("INDEX_VECTOR_KINDS", "large").split(",")
+    if kind.strip() and kind.strip() != "large"
+]
+SCORE_AGGREGATION = os.getenv("SCORE_AGGREGATION", "max")
+TEXT_VECTOR_KINDS = ("name", "description")
+# Memory-mapped snapshots the numpy backend and the neighbour graph start from (empty disables them)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "./chroma_db/snapshot")
+# Nearest characters kept per character for search_type="neighbors" re-examines (0 disables)
+NEIGHBOR_GRAPH_K = int(os.getenv("NEIGHBOR_GRAPH_K", "32"))
+# Anime recommended per analysis, ranked against per-anime centroids of character vectors (0 disables)
+ANIME_RECOMMENDATIONS = int(os.getenv("ANIME_RECOMMENDATIONS", "5"))
+# Share of each anime centroid taken from a CLIP text embedding of its title (0 uses images only;
+# anything else loads the text tower)
+ANIME_TITLE_WEIGHT = float(os.getenv("ANIME_TITLE_WEIGHT", "0"))
+
+# Text queries (/search-text) are opt-in, since they load the text tower into every replica. Queries
+# are encoded as TEXT_QUERY_TEMPLATE, recent ones are kept in an LRU of TEXT_CACHE_ENTRIES, and
+# character names and anime titles are precomputed as they are ingested when TEXT_PRECOMPUTE is on
+TEXT_SEARCH = os.getenv("TEXT_SEARCH", "false").lower() == "true"
+TEXT_QUERY_TEMPLATE = os.getenv("TEXT_QUERY_TEMPLATE", "a picture of {}")
+TEXT_CACHE_ENTRIES = int(os.getenv("TEXT_CACHE_ENTRIES", "10000"))
+TEXT_PRECOMPUTE = os.getenv("TEXT_PRECOMPUTE", "true").lower() == "true"
+# Text scores images lower than images do, so matches are kept from a lower confidence
+TEXT_MIN_CONFIDENCE = float(os.getenv("TEXT_MIN_CONFIDENCE", "0.1"))
+
+# Pre-fork serving (gunicorn -c gunicorn.conf.py, which sets SERVE_PREFORK and SERVE_WORKERS): the
+# master loads the weights once and workers share them copy-on-write. One worker, elected by a file
+# lock in WORKER_STATE_DIR, does all ingestion and refreshes; the others map its search index and
+# neighbour graph snapshots whenever it publishes, checking every WORKER_SYNC_SECONDS
+SERVE_PREFORK = os.getenv("SERVE_PREFORK", "false").lower() == "true"
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "1"))
+WORKER_STATE_DIR = os.getenv("WORKER_STATE_DIR", "./chroma_db/workers")
+WORKER_SYNC_SECONDS = float(os.getenv("WORKER_SYNC_SECONDS", "5"))
+# A refresh deletes the old collection once every worker has switched to the new one, or after this
+# long: a few sync intervals plus twice the time the writer took to load the new index
+RETIRE_SYNC_INTERVALS = int(os.getenv("RETIRE_SYNC_INTERVALS", "3"))
+
+# Refreshes build a shadow collection and then point this file at it
+COLLECTION_NAME = "anime_characters"
+ACTIVE_COLLECTION_PATH = os.getenv("ACTIVE_COLLECTION_PATH", "./chroma_db/active_collection")
+
 # Global variables
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model = None
+onnx_encoder = None
+text_model = None
+tokenizer = None
 processor = None
+preprocessor = None
+stage_timings = StageTimings()
+character_records = CharacterRecordCache()
 chroma_client = None
 collection = None
+search_backend = None
+neighbor_graph = None
+anime_index = None
 model_loaded = False
+warmed_up = False
+image_batcher = None
+text_batcher = None
+inference_executor = None
+http_session = None
+ingestion_progress = IngestionProgress()
+crawler = None
+# Created on the serving loop in startup_event (on Python 3.9 a Lock binds to the loop current when it is made)
+ingestion_lock = None
+embedding_cache = EmbeddingCache(
+    max_bytes=int(EMBEDDING_CACHE_MB * 1024 * 1024),
+    ttl_seconds=EMBEDDING_CACHE_TTL,
+    disk_dir=EMBEDDING_CACHE_DIR,
+    namespace=EMBEDDING_CACHE_NAMESPACE
+)
+startup_started = None
+startup_phases = {}
+fallback_responses = Counter()
+analysis_flights = SingleFlight()
+prompt_cache = PromptEmbeddingCache(TEXT_CACHE_ENTRIES)
+text_flights = SingleFlight()
+served_requests = RequestCounter()
+worker_registry = None
+writer_lock = None
+# Without pre-forking the one process is the writer
+is_writer = True
+loaded_generation = None
+models_preloaded = False
+request_profiler = RequestProfiler(
+    PROFILE_DIR,
+    threshold_ms=PROFILE_THRESHOLD_MS,
+    interval_ms=PROFILE_INTERVAL_MS,
+    max_files=PROFILE_MAX_FILES,
+    torch_traces=PROFILE_TORCH
+) if PROFILING != "off" else None
 
 # Sample characters for immediate functionality
 SAMPLE_CHARACTERS = [
@@ -97,295 +287,1453 @@ class Character(BaseModel):
     image_url: str
     confidence: float = 0.0
 
+class AnimeRecommendation(BaseModel):
+    title: str
+    confidence: float
+    characters: int  # characters the anime's centroid is built from
+
 class AnalysisResponse(BaseModel):
     success: bool
     character: Optional[Character] = None
     suggestions: List[Character] = []
     error: Optional[str] = None
+    anime_recommendations: List[AnimeRecommendation] = []
 
 class ReExamineRequest(BaseModel):
     image_data: str
     exclude_ids: List[int] = []
     focus_ids: List[int] = []
-    search_type: str = "normal"  # "normal", "exclude", "focus"
+    search_type: str = "normal"  # "normal", "exclude", "focus", "neighbors"
+
+class TextSearchRequest(BaseModel):
+    query: str
+    exclude_ids: List[int] = []
+
+class BatchAnalysisItem(BaseModel):
+    """One line of an NDJSON /analyze-batch body"""
+    id: Optional[str] = None
+    image_data: str
+    exclude_ids: List[int] = []
+    focus_ids: List[int] = []
+    search_type: str = "normal"
+
+class BatchAnalysisResult(AnalysisResponse):
+    """One line of the /analyze-batch response, tagged with the item's position"""
+    index: int
+    id: Optional[str] = None
 
 @app.on_event("startup")
 async def startup_event():
-    global model, processor, chroma_client, collection, model_loaded
+    global model, processor, chroma_client, collection, search_backend, neighbor_graph, anime_index, model_loaded, image_batcher, text_batcher, inference_executor, http_session, startup_started
+    global worker_registry, writer_lock, is_writer, loaded_generation, ingestion_lock
     
     print("Starting Anime CLIP Service...")
     print("Phase 1: Basic functionality with sample data")
+    startup_started = time.perf_counter()
+    ingestion_lock = asyncio.Lock()
+    
+    # Only one pre-forked worker may write; it is whichever takes the lock first
+    worker_registry = WorkerRegistry(WORKER_STATE_DIR)
+    if SERVE_PREFORK:
+        writer_lock = WriterLock(os.path.join(WORKER_STATE_DIR, "writer.lock"))
+        is_writer = writer_lock.acquire()
+        loaded_generation = worker_registry.generation()
+        print(f"Worker {os.getpid()} is the {'writer' if is_writer else 'reader'} "
+              f"(writer: {writer_lock.owner()}, {SERVE_WORKERS} workers)")
+        if SEARCH_BACKEND == "chroma":
+            print("SEARCH_BACKEND=chroma keeps a separate index per worker; numpy or two_stage share one mapped snapshot")
     
-    # Initialize ChromaDB
+    # Initialize ChromaDB. It loads onnxruntime, whose native threads don't survive a fork, so
+    # it is imported here in each worker rather than with the module in the pre-fork master
+    import chromadb
+    started = time.perf_counter()
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
-    collection = chroma_client.get_or_create_collection(
-        name="anime_characters",
-        metadata={"hnsw:space": "cosine"}
-    )
+    collection = await open_active_collection()
+    if is_writer:
+        drop_stale_collections()
+    record_startup_phase("chroma", started)
+    started = time.perf_counter()
+    search_backend = build_search_backend(collection)
+    record_startup_phase("search_index", started, backend=search_backend.name, count=search_backend.count())
+    print(f"Search backend: {search_backend.name} over {search_backend.count()} characters")
+    if NEIGHBOR_GRAPH_K > 0 or ANIME_RECOMMENDATIONS > 0:
+        started = time.perf_counter()
+        # The graph is mapped from its snapshot when that is current, or built in the background below
+        neighbor_graph = load_neighbor_graph(collection)
+        _, anime_index = build_character_indexes(search_backend, collection, with_graph=False)
+        record_startup_phase(
+            "character_indexes", started,
+            neighbor_graph=neighbor_graph.count() if neighbor_graph else None,
+            anime=anime_index.count() if anime_index else None
+        )
+    # Readers that started first built their own index; have them switch to the writer's snapshot
+    publish_generation()
     
     print(f"Sample characters ready: {len(SAMPLE_CHARACTERS)}")
     
-    # Start loading CLIP model in background
+    # One pooled HTTP session for AniList queries and image downloads
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=INGEST_CONCURRENCY)
+    )
+    
+    # Split the CPU cores between inference threads (of every worker) so they don't oversubscribe
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // (INFERENCE_WORKERS * SERVE_WORKERS)))
+    inference_executor = ThreadPoolExecutor(
+        max_workers=INFERENCE_WORKERS,
+        thread_name_prefix="clip-inference"
+    )
+    
+    # Uploaded images are encoded in batches on the inference pool
+    image_batcher = MicroBatcher(
+        encode_images,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        executor=inference_executor,
+        workers=INFERENCE_WORKERS,
+        max_queue_size=INFERENCE_QUEUE_SIZE
+    )
+    image_batcher.start()
+    print(f"Image batcher ready (max batch {BATCH_MAX_SIZE}, max wait {BATCH_MAX_WAIT_MS}ms, "
+          f"{INFERENCE_WORKERS} workers x {torch.get_num_threads()} threads, queue {INFERENCE_QUEUE_SIZE})")
+    if TEXT_SEARCH:
+        # Text queries share the inference pool, batched the same way
+        text_batcher = MicroBatcher(
+            encode_texts,
+            max_batch_size=BATCH_MAX_SIZE,
+            max_wait_ms=BATCH_MAX_WAIT_MS,
+            executor=inference_executor,
+            workers=INFERENCE_WORKERS,
+            max_queue_size=INFERENCE_QUEUE_SIZE
+        )
+        text_batcher.start()
+    
+    # Start loading CLIP model in background. Readers never build the graph; they map the writer's
+    if NEIGHBOR_GRAPH_K > 0 and neighbor_graph is None and is_writer:
+        asyncio.create_task(build_neighbor_graph())
     asyncio.create_task(load_clip_model())
+    asyncio.create_task(sync_worker())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if image_batcher:
+        await image_batcher.stop()
+    if text_batcher:
+        await text_batcher.stop()
+    if inference_executor:
+        inference_executor.shutdown(wait=False)
+    if http_session:
+        await http_session.close()
 
 async def load_clip_model():
-    global model, processor, model_loaded
+    global model, onnx_encoder, text_model, tokenizer, processor, preprocessor, model_loaded, warmed_up
     
     try:
-        print("Phase 2: Loading CLIP model (this may take 5-10 minutes)...")
-        model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        model.to(device)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        if models_preloaded:
+            source = startup_phases["model"]["source"]
+            print(f"CLIP model preloaded by the pre-fork master from {source}")
+        elif INFERENCE_BACKEND == "onnx":
+            print(f"Phase 2: Loading ONNX vision encoder from {ONNX_MODEL_PATH}...")
+            # Imported per worker, like chromadb, to keep onnxruntime out of the pre-fork master
+            from onnx_backend import OnnxImageEncoder
+            onnx_encoder = await loop.run_in_executor(
+                None, lambda: OnnxImageEncoder(ONNX_MODEL_PATH, threads=torch.get_num_threads())
+            )
+            # export_onnx.py saves the image processor config next to the model
+            processor = CLIPImageProcessor.from_pretrained(os.path.dirname(ONNX_MODEL_PATH) or ".")
+            source = ONNX_MODEL_PATH
+            print("ONNX vision encoder loaded successfully on cpu")
+        else:
+            print("Phase 2: Loading CLIP vision model...")
+            # Loading off the event loop keeps /health and sample responses live
+            model, processor, source = await loop.run_in_executor(
+                None, load_model_artifact, CLIPVisionModelWithProjection, CLIPImageProcessor, CLIP_MODEL_DIR
+            )
+            model.to(device)
+            print(f"CLIP model loaded successfully on {device} from {source}")
+        if not models_preloaded:
+            await loop.run_in_executor(None, load_text_tower)
+        if text_model is not None:
+            await loop.run_in_executor(inference_executor, embed_anime_titles, anime_index)
+        preprocessor = ImagePreprocessor.from_processor(processor)
+        if not models_preloaded:
+            record_startup_phase("model", started, backend=INFERENCE_BACKEND, source=source)
+        
+        # Pay first-call allocation and kernel selection before real traffic arrives
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            loop.run_in_executor(inference_executor, warm_up) for _ in range(INFERENCE_WORKERS)
+        ])
+        stage_timings.reset()
+        warmed_up = True
+        record_startup_phase("warmup", started, iterations=WARMUP_ITERATIONS)
         model_loaded = True
-        print(f"CLIP model loaded successfully on {device}")
+        startup_phases["ready_seconds"] = round(time.perf_counter() - startup_started, 3)
         
-        # Check if we need to populate the database
-        if collection.count() == 0:
-            print("Phase 3: Populating character database with real data...")
-            await populate_character_database()
+        # Populate the database if it is empty or an earlier crawl was interrupted
+        checkpoint = CrawlCheckpoint.load(CRAWL_CHECKPOINT_PATH, CRAWL_MAX_ATTEMPTS)
+        if is_writer and (collection.count() == 0 or not checkpoint.finished(ANILIST_MAX_PAGES)):
+            print(f"Phase 3: Populating character database with real data (from page {checkpoint.next_page})...")
+            started = time.perf_counter()
+            async with ingestion_lock:
+                await populate_character_database(checkpoint)
+                await save_search_snapshot()
+                await save_graph_snapshot(neighbor_graph, collection)
+                publish_generation()
+            record_startup_phase("populate", started, count=collection.count())
         
         print(f"Real character database ready with {collection.count()} characters")
         
+        # Characters stored by an earlier run still need their names and titles in the prompt table
+        started = time.perf_counter()
+        precomputed = await precompute_stored_prompts(search_backend, collection)
+        if precomputed:
+            record_startup_phase("text_prompts", started, count=precomputed)
+        
     except Exception as e:
         print(f"Failed to load CLIP model: {e}")
         print("Continuing with sample data...")
 
-async def get_popular_anime_characters():
-    """Fetch popular anime characters from AniList API"""
-    query = '''
-    query {
-        Page(page: 1, perPage: 50) {
-            characters(sort: FAVOURITES_DESC) {
-                id
-                name {
-                    full
-                    native
-                }
-                image {
-                    large
-                    medium
-                }
-                description
-                media(sort: POPULARITY_DESC, perPage: 3) {
-                    nodes {
-                        title {
-                            romaji
-                            english
-                        }
-                        type
-                    }
-                }
-            }
-        }
-    }
-    '''
-    
-    url = 'https://graphql.anilist.co'
-    
+def load_text_tower():
+    """Load the CLIP text tower if anything needs it
+
+    Text vectors in the index (or anime title blending) require it; text
+    search alone can do without it.
+    """
+    global text_model, tokenizer
+    text_required = (any(kind in TEXT_VECTOR_KINDS for kind in INDEX_VECTOR_KINDS)
+                     or (ANIME_RECOMMENDATIONS > 0 and ANIME_TITLE_WEIGHT > 0))
+    if not (text_required or TEXT_SEARCH):
+        return
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json={'query': query}) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data['data']['Page']['characters']
-                else:
-                    print(f"Failed to fetch characters: {response.status}")
-                    return []
+        text_model, tokenizer, text_source = load_model_artifact(
+            CLIPTextModelWithProjection, CLIPTokenizer, CLIP_TEXT_MODEL_DIR
+        )
     except Exception as e:
-        print(f"Error fetching characters: {e}")
-        return []
+        if text_required:
+            raise
+        print(f"Could not load CLIP text model, /search-text is unavailable: {e}")
+        return
+    text_model.to(device)
+    print(f"CLIP text model loaded from {text_source}")
 
-def encode_image_from_url(image_url: str) -> Optional[np.ndarray]:
-    """Download and encode image from URL using CLIP"""
-    if not model_loaded:
+def preload_models():
+    """Load the torch towers in the pre-fork master, before workers are forked
+
+    Workers inherit the weights and, since inference never writes to them,
+    share their pages instead of each loading a copy. Nothing here touches
+    torch's thread pools (or imports chromadb or onnxruntime): a forked child
+    can't use native threads its parent started, so each worker sets up its
+    own in startup_event.
+    """
+    global model, processor, models_preloaded
+    started = time.perf_counter()
+    print("Pre-fork: loading CLIP model once for all workers...")
+    model, processor, source = load_model_artifact(CLIPVisionModelWithProjection, CLIPImageProcessor, CLIP_MODEL_DIR)
+    load_text_tower()
+    record_startup_phase("model", started, backend=INFERENCE_BACKEND, source=source, preloaded=True)
+    models_preloaded = True
+
+def load_model_artifact(model_class, processor_class, artifact_dir: str):
+    """Load one CLIP tower and its processor, without the other tower
+
+    A saved artifact in ``artifact_dir`` is preferred. Otherwise the weights
+    come from CLIP_MODEL_NAME and are written to ``artifact_dir`` as
+    safetensors, so the next start skips the download and the unused weights.
+    """
+    source = artifact_dir if os.path.exists(os.path.join(artifact_dir, "config.json")) else CLIP_MODEL_NAME
+    tower = model_class.from_pretrained(source).eval()
+    tower_processor = processor_class.from_pretrained(source)
+    if source != artifact_dir and artifact_dir:
+        try:
+            tower.save_pretrained(artifact_dir, safe_serialization=True)
+            tower_processor.save_pretrained(artifact_dir)
+            print(f"Saved {model_class.__name__} artifact to {artifact_dir}")
+        except OSError as e:
+            print(f"Could not save {model_class.__name__} artifact: {e}")
+    return tower, tower_processor, source
+
+def warm_up():
+    """Encode dummy batches at the sizes serving and ingestion use, then run one query"""
+    sizes = sorted({1, BATCH_MAX_SIZE, INGEST_ENCODE_BATCH})
+    images = [Image.new('RGB', (320, 240), (i * 37 % 256, 96, 160)) for i in range(max(sizes))]
+    embeddings = None
+    for _ in range(WARMUP_ITERATIONS):
+        for size in sizes:
+            embeddings = encode_images(images[:size])
+    if embeddings is not None and search_backend.count() > 0:
+        search_backend.search(embeddings[:1], 5)
+
+def record_startup_phase(phase: str, started: float, **details):
+    startup_phases[phase] = {"seconds": round(time.perf_counter() - started, 3), **details}
+
+async def save_search_snapshot():
+    """Persist the in-memory index so the next start can map it instead of rebuilding"""
+    if SNAPSHOT_DIR and isinstance(search_backend, ExactSearchIndex):
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, search_backend.save_snapshot, SNAPSHOT_DIR, collection.name
+            )
+        except OSError as e:
+            print(f"Failed to write search snapshot: {e}")
+
+def graph_snapshot_key(target_collection) -> dict:
+    # The same identity the search snapshot is matched on
+    return {'source': target_collection.name, 'count': target_collection.count(), 'dtype': SEARCH_DTYPE}
+
+def load_neighbor_graph(target_collection) -> Optional[NeighborGraph]:
+    """The graph saved for this collection as it is now, memory-mapped, if there is one"""
+    if NEIGHBOR_GRAPH_K <= 0 or not SNAPSHOT_DIR:
         return None
-        
-    try:
-        response = requests.get(image_url, timeout=10)
-        if response.status_code == 200:
-            image = Image.open(io.BytesIO(response.content)).convert('RGB')
-            inputs = processor(images=image, return_tensors="pt").to(device)
-            
-            with torch.no_grad():
-                image_features = model.get_image_features(**inputs)
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-            
-            return image_features.cpu().numpy().flatten()
-    except Exception as e:
-        print(f"Failed to encode image from {image_url}: {e}")
+    return NeighborGraph.from_snapshot(SNAPSHOT_DIR, graph_snapshot_key(target_collection), NEIGHBOR_GRAPH_K)
+
+async def save_graph_snapshot(graph: Optional[NeighborGraph], target_collection):
+    """Persist the neighbour graph so the next start can map it instead of rebuilding"""
+    if SNAPSHOT_DIR and graph is not None and is_writer:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, graph.save_snapshot, SNAPSHOT_DIR, graph_snapshot_key(target_collection)
+            )
+        except OSError as e:
+            print(f"Failed to write neighbour graph snapshot: {e}")
+
+async def build_neighbor_graph():
+    """Build the graph off the event loop; neighbour re-examines use a full search until it is ready
+
+    The ingestion lock is held throughout, so ingestion and refreshes, which
+    update the graph, wait for it instead of updating a graph still missing rows.
+    """
+    global neighbor_graph
+    async with ingestion_lock:
+        started = time.perf_counter()
+        backend, target = search_backend, collection
+        graph, _ = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: build_character_indexes(backend, target, with_anime=False)
+        )
+        if collection is not target:
+            # A reader switched to a newer collection meanwhile, which brought its own graph
+            return
+        neighbor_graph = graph
+        record_startup_phase("neighbor_graph", started, count=graph.count())
+        print(f"Neighbour graph built over {graph.count()} characters")
+        await save_graph_snapshot(graph, target)
+        # Readers map the saved graph when they next reload
+        publish_generation()
+
+async def open_active_collection():
+    """The collection to serve; only the writer ever creates it
+
+    On an empty database pre-forked readers would race the writer to create
+    it, or catch it half-created, so a reader waits until the writer has
+    published an index. If the writer exits first, the reader takes over.
+    """
+    global is_writer, loaded_generation
+    while not is_writer:
+        generation = worker_registry.generation()
+        if generation:
+            try:
+                latest = chroma_client.get_collection(name=read_active_collection_name())
+                loaded_generation = generation
+                return latest
+            except ValueError:
+                pass
+        if writer_lock.acquire():
+            is_writer = True
+            print(f"Worker {os.getpid()} took over as the writer")
+        else:
+            await asyncio.sleep(min(WORKER_SYNC_SECONDS, 0.5))
+    return chroma_client.get_or_create_collection(
+        name=read_active_collection_name(),
+        metadata={"hnsw:space": "cosine"}
+    )
+
+def publish_generation() -> Optional[str]:
+    """Tell reader workers the writer changed the index (a no-op without pre-forking)"""
+    global loaded_generation
+    if SERVE_PREFORK and is_writer:
+        loaded_generation = worker_registry.publish()
+        return loaded_generation
     return None
 
-async def populate_character_database():
-    """Populate ChromaDB with anime characters and their image embeddings"""
+async def sync_worker():
+    """Report this worker's stats; as a pre-forked reader, also follow the writer
+
+    A reader reloads whenever the writer publishes, passes on refresh
+    requests, and takes over as writer if the writer exits.
+    """
+    global is_writer, loaded_generation
+    while True:
+        try:
+            worker_registry.report(
+                served_requests.count,
+                role="writer" if is_writer else "reader",
+                model_loaded=model_loaded,
+                vectors=search_backend.count() if search_backend else 0,
+                generation=loaded_generation
+            )
+            if SERVE_PREFORK and not is_writer and writer_lock.acquire():
+                is_writer = True
+                print(f"Worker {os.getpid()} took over as the writer")
+                if NEIGHBOR_GRAPH_K > 0 and neighbor_graph is None:
+                    asyncio.create_task(build_neighbor_graph())
+            if SERVE_PREFORK and is_writer:
+                # Leave the request in place while an update is running
+                if model_loaded and not ingestion_lock.locked() and worker_registry.take_refresh_request():
+                    await start_refresh()
+            elif SERVE_PREFORK:
+                generation = worker_registry.generation()
+                if generation and generation != loaded_generation:
+                    await reload_published_index()
+                    loaded_generation = generation
+        except Exception as e:
+            print(f"Worker sync failed: {e}")
+        await asyncio.sleep(WORKER_SYNC_SECONDS)
+
+async def reload_published_index():
+    """Switch a reader worker to the collection and snapshots the writer last published
+
+    The search index and neighbour graph are memory-mapped from the writer's
+    snapshots, so every worker shares one copy of them. Until the writer has
+    saved a graph for this collection, neighbour re-examines use a full search.
+    """
+    global collection, search_backend, neighbor_graph, anime_index
+    loop = asyncio.get_running_loop()
+    latest = await loop.run_in_executor(None, lambda: chroma_client.get_collection(name=read_active_collection_name()))
+    backend = await loop.run_in_executor(None, build_search_backend, latest)
+    graph, anime = neighbor_graph, anime_index
+    if NEIGHBOR_GRAPH_K > 0 or ANIME_RECOMMENDATIONS > 0:
+        graph = load_neighbor_graph(latest)
+        _, anime = await loop.run_in_executor(
+            None, lambda: build_character_indexes(backend, latest, anime_index, with_graph=False)
+        )
+    collection, search_backend, neighbor_graph, anime_index = latest, backend, graph, anime
+    character_records.clear()
+    mapped = f", neighbour graph of {graph.count()}" if graph is not None else ""
+    print(f"Worker {os.getpid()} reloaded {latest.name}: {backend.count()} vectors{mapped}")
+    if text_model is not None:
+        await loop.run_in_executor(inference_executor, embed_anime_titles, anime)
+        await precompute_stored_prompts(backend, latest)
+
+def encode_images(images: List[Image.Image]) -> np.ndarray:
+    """Encode a batch of images with one CLIP forward pass"""
+    if onnx_encoder is not None:
+        with stage_timings.time("preprocess", len(images)):
+            pixel_values = preprocessor(images).numpy()
+        with stage_timings.time("model", len(images)):
+            return onnx_encoder(pixel_values)
+    
+    with stage_timings.time("preprocess", len(images)):
+        pixel_values = preprocessor(images).to(device)
+    
+    with stage_timings.time("model", len(images)), torch.no_grad(), forward_profile():
+        image_features = model(pixel_values=pixel_values).image_embeds
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    
+    return image_features.cpu().numpy()
+
+def forward_profile():
+    """Torch profiler around a forward pass while a request is being profiled"""
+    if request_profiler is not None and request_profiler.active():
+        return request_profiler.torch_profile()
+    return nullcontext()
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Encode a batch of text prompts into the image embedding space"""
+    with stage_timings.time("text_model", len(texts)), torch.no_grad():
+        inputs = tokenizer(
+            texts, padding=True, truncation=True,
+            max_length=text_model.config.max_position_embeddings, return_tensors="pt"
+        ).to(device)
+        text_features = text_model(**inputs).text_embeds
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    
+    return text_features.cpu().numpy()
+
+def decode_image(image_bytes: bytes) -> Image.Image:
+    """Decode to RGB at no more than the resolution CLIP needs"""
+    with stage_timings.time("decode"):
+        return load_image(image_bytes, max_pixels=MAX_IMAGE_PIXELS)
+
+def character_metadata(char: dict) -> dict:
+    """Build the stored metadata for an AniList character"""
+    # Get primary anime
+    primary_anime = "Unknown"
+    if char.get('media', {}).get('nodes'):
+        anime_node = char['media']['nodes'][0]
+        primary_anime = (anime_node.get('title', {}).get('english') or 
+                       anime_node.get('title', {}).get('romaji') or 
+                       "Unknown")
+    
+    return {
+        'name': char['name']['full'] or char['name']['native'] or f"Character {char['id']}",
+        'anime': primary_anime,
+        'description': char.get('description', '').replace('<br>', ' ')[:200] if char.get('description') else '',
+        'image_url': char['image']['large'],
+        'image_hash': source_hash(char['image']['large']),
+        'anilist_id': char['id']
+    }
+
+def source_hash(source: str) -> str:
+    """Hash of the image URL or prompt a vector was built from"""
+    return hashlib.sha1(source.encode()).hexdigest()
+
+def vector_id(anilist_id: int, kind: str) -> str:
+    # The primary image keeps the bare anilist ID used before multi-vector indexes
+    return str(anilist_id) if kind == "large" else f"{anilist_id}:{kind}"
+
+def character_id(vector_id: str) -> int:
+    return int(vector_id.split(':', 1)[0])
+
+def character_vectors(char: dict) -> List[dict]:
+    """Ingestion items for each configured vector of a character, primary image first"""
+    metadata = character_metadata(char)
+    sources = [("large", "image_url", char['image']['large'])]
+    medium = char['image'].get('medium')
+    if "medium" in INDEX_VECTOR_KINDS and medium and medium != char['image']['large']:
+        sources.append(("medium", "image_url", medium))
+    if "cover" in INDEX_VECTOR_KINDS:
+        for i, node in enumerate(char.get('media', {}).get('nodes') or []):
+            cover = (node.get('coverImage') or {}).get('large')
+            if cover:
+                sources.append((f"cover{i}", "image_url", cover))
+    if "name" in INDEX_VECTOR_KINDS:
+        sources.append(("name", "text", f"a picture of {metadata['name']} from {metadata['anime']}"))
+    if "description" in INDEX_VECTOR_KINDS and metadata['description']:
+        sources.append(("description", "text", f"{metadata['name']}: {metadata['description']}"))
+    
+    return [
+        {
+            'id': vector_id(char['id'], kind),
+            field: source,
+            'metadata': {**metadata, 'vector_kind': kind, 'source_hash': source_hash(source)}
+        }
+        for kind, field, source in sources
+    ]
+
+def build_search_backend(target_collection):
+    return create_search_backend(
+        SEARCH_BACKEND,
+        target_collection,
+        SEARCH_DTYPE,
+        SNAPSHOT_DIR,
+        SCORE_AGGREGATION,
+        max_vectors_per_character(),
+        # Reader workers map the writer's snapshots and never write their own
+        write_snapshot=is_writer,
+        compression=TWO_STAGE_COMPRESSION,
+        compressed_dimension=TWO_STAGE_DIMENSION,
+        candidates=TWO_STAGE_CANDIDATES
+    )
+
+def stored_pages(backend, target_collection, page_size: int = 5000, embeddings: bool = True):
+    """(ids, embeddings, metadatas) pages of every stored vector
+
+    Read from the in-memory index when there is one, which is faster than the
+    collection and, in a reader worker, the only copy guaranteed to be current.
+    """
+    if isinstance(backend, ExactSearchIndex):
+        yield from backend.pages(page_size)
+        return
+    include = ["embeddings", "metadatas"] if embeddings else ["metadatas"]
+    offset = 0
+    while True:
+        page = target_collection.get(include=include, limit=page_size, offset=offset)
+        if not page['ids']:
+            return
+        yield page['ids'], page.get('embeddings'), page['metadatas']
+        offset += len(page['ids'])
+
+def build_character_indexes(
+    backend,
+    target_collection,
+    previous_anime: Optional[AnimeIndex] = None,
+    with_graph: bool = True,
+    with_anime: bool = True
+):
+    """The neighbour graph and anime index over every stored character's primary image
+
+    Either is None when disabled or not asked for. The vectors are read once, a
+    page at a time. A previous anime index lends its title embeddings.
+    """
+    graph = NeighborGraph(NEIGHBOR_GRAPH_K) if NEIGHBOR_GRAPH_K > 0 and with_graph else None
+    anime = None
+    if ANIME_RECOMMENDATIONS > 0 and with_anime:
+        anime = previous_anime.fork() if previous_anime is not None else AnimeIndex(ANIME_TITLE_WEIGHT)
+    if graph is None and anime is None:
+        return graph, anime
+    for ids, embeddings, metadatas in stored_pages(backend, target_collection):
+        primary = primary_vectors(ids, embeddings, metadatas)
+        for index in (graph, anime):
+            if index is not None:
+                index.add(*primary)
+    return graph, anime
+
+def character_prompts(metadatas: List[dict]) -> List[str]:
+    """Text queries worth precomputing for these characters: their names and anime titles"""
+    prompts = []
+    for metadata in metadatas:
+        prompts.append(metadata.get('name'))
+        if metadata.get('anime') not in (None, "Unknown"):
+            prompts.append(metadata['anime'])
+    return prompts
+
+def precompute_prompts(metadatas: List[dict]) -> int:
+    """Encode the names and titles of these characters not in the prompt table yet"""
+    if not TEXT_SEARCH or not TEXT_PRECOMPUTE or text_model is None:
+        return 0
+    prompts = prompt_cache.missing(character_prompts(metadatas))
+    for start in range(0, len(prompts), INGEST_ENCODE_BATCH):
+        precompute_prompt_batch(prompts[start:start + INGEST_ENCODE_BATCH])
+    return len(prompts)
+
+def precompute_prompt_batch(prompts: List[str]):
+    prompt_cache.precompute(prompts, encode_texts([TEXT_QUERY_TEMPLATE.format(prompt) for prompt in prompts]))
+
+async def precompute_stored_prompts(backend, target_collection) -> int:
+    """Precompute prompts for every stored character
+
+    Each batch is its own inference-pool job, so queries keep getting served in between.
+    """
+    if not TEXT_SEARCH or not TEXT_PRECOMPUTE or text_model is None:
+        return 0
+    loop = asyncio.get_running_loop()
+    pages = stored_pages(backend, target_collection, embeddings=False)
+    precomputed = 0
+    while True:
+        page = await loop.run_in_executor(None, next, pages, None)
+        if page is None:
+            return precomputed
+        ids, _, metadatas = page
+        metadatas = [metadata for item_id, metadata in zip(ids, metadatas) if ':' not in item_id]
+        prompts = prompt_cache.missing(character_prompts(metadatas))
+        for start in range(0, len(prompts), INGEST_ENCODE_BATCH):
+            await loop.run_in_executor(inference_executor, precompute_prompt_batch, prompts[start:start + INGEST_ENCODE_BATCH])
+        precomputed += len(prompts)
+
+def embed_anime_titles(index: Optional[AnimeIndex]):
+    """Encode the titles the anime index has no text embedding for yet (needs the text tower)"""
+    if index is None or text_model is None:
+        return
+    titles = index.missing_titles()
+    for start in range(0, len(titles), INGEST_ENCODE_BATCH):
+        chunk = titles[start:start + INGEST_ENCODE_BATCH]
+        index.set_titles(chunk, encode_texts([f"characters from the anime {title}" for title in chunk]))
+
+def primary_vectors(ids: List[str], embeddings, metadatas: List[dict]):
+    """The (anilist IDs, vectors, metadatas) of the primary image vectors among ``ids``"""
+    rows = [i for i, item_id in enumerate(ids) if ':' not in item_id]
+    return [int(ids[i]) for i in rows], [embeddings[i] for i in rows], [metadatas[i] for i in rows]
+
+def max_vectors_per_character() -> int:
+    # AniList returns up to three media per character, each with a cover
+    return sum({"large": 1, "medium": 1, "cover": 3}.get(kind, 1) for kind in INDEX_VECTOR_KINDS)
+
+def read_active_collection_name() -> str:
+    try:
+        with open(ACTIVE_COLLECTION_PATH) as f:
+            return f.read().strip() or COLLECTION_NAME
+    except OSError:
+        return COLLECTION_NAME
+
+def write_active_collection_name(name: str):
+    tmp_path = ACTIVE_COLLECTION_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+    os.replace(tmp_path, ACTIVE_COLLECTION_PATH)
+
+def drop_stale_collections():
+    """Delete shadow collections left behind by an interrupted refresh"""
+    for stale in chroma_client.list_collections():
+        if stale.name.startswith(COLLECTION_NAME) and stale.name != collection.name:
+            print(f"Dropping stale collection {stale.name}")
+            chroma_client.delete_collection(stale.name)
+
+def store_characters(ids: List[str], embeddings: List[List[float]], metadatas: List[dict]):
+    # Upsert, since a resumed crawl may re-store vectors of a half-stored character
+    collection.upsert(
+        embeddings=embeddings,
+        metadatas=metadatas,
+        ids=ids
+    )
+    # An in-memory index has to be kept in step with the collection
+    if isinstance(search_backend, ExactSearchIndex):
+        search_backend.add(ids, embeddings, metadatas)
+    primary = primary_vectors(ids, embeddings, metadatas)
+    if neighbor_graph is not None:
+        neighbor_graph.add(*primary)
+    if anime_index is not None:
+        anime_index.add(*primary)
+        # Ingestion stores from the inference pool, so new titles can be encoded right here
+        embed_anime_titles(anime_index)
+    precompute_prompts(primary[2])
+    # Re-stored characters may have new names or descriptions
+    character_records.discard({character_id(item_id) for item_id in ids})
+
+async def populate_character_database(checkpoint: Optional[CrawlCheckpoint] = None):
+    """Crawl AniList and add every character not yet in ChromaDB, resuming from the checkpoint"""
+    global crawler
     if not model_loaded:
         return
-        
-    characters = await get_popular_anime_characters()
     
-    embeddings = []
-    metadatas = []
-    ids = []
+    checkpoint = checkpoint or CrawlCheckpoint.load(CRAWL_CHECKPOINT_PATH, CRAWL_MAX_ATTEMPTS)
+    # Vectors already stored are never downloaded or encoded again. A character only counts
+    # as ingested once all of its vectors are, so a crash mid-character resumes its missing ones
+    stored_ids = set(await asyncio.get_running_loop().run_in_executor(
+        None, lambda: collection.get(include=[])['ids']
+    ))
     
-    for char in characters:
-        if not char.get('image', {}).get('large'):
-            continue
-            
-        # Get primary anime
-        primary_anime = "Unknown"
-        if char.get('media', {}).get('nodes'):
-            anime_node = char['media']['nodes'][0]
-            primary_anime = (anime_node.get('title', {}).get('english') or 
-                           anime_node.get('title', {}).get('romaji') or 
-                           "Unknown")
+    crawler = AniListCrawler(
+        http_session,
+        checkpoint,
+        url=ANILIST_URL,
+        per_page=ANILIST_PER_PAGE,
+        max_pages=ANILIST_MAX_PAGES,
+        requests_per_second=ANILIST_RATE_LIMIT
+    )
+    
+    # A character is resolved once each of its vectors is stored or failed, and
+    # counts as stored if any of them made it in
+    remaining = {}
+    any_stored = set()
+    
+    def resolve(items: List[dict], stored: bool):
+        done, failed = [], []
+        for item in items:
+            char_id = character_id(item['id'])
+            if stored:
+                any_stored.add(char_id)
+            remaining[char_id].discard(item['id'])
+            if not remaining[char_id]:
+                del remaining[char_id]
+                (done if char_id in any_stored else failed).append(char_id)
+                any_stored.discard(char_id)
+        if done:
+            crawler.mark_stored(done)
+        if failed:
+            crawler.mark_failed(failed)
+    
+    async def items():
+        async for char in crawler.characters():
+            if not char.get('image', {}).get('large'):
+                crawler.mark_failed([char['id']])
+                continue
+            vectors = character_vectors(char)
+            missing = [item for item in vectors if item['id'] not in stored_ids]
+            if not missing:
+                crawler.mark_stored([char['id']])
+                continue
+            if len(missing) < len(vectors):
+                any_stored.add(char['id'])
+            remaining[char['id']] = {item['id'] for item in missing}
+            for item in missing:
+                yield item
+    
+    pipeline = IngestionPipeline(
+        http_session,
+        encode_images,
+        store_characters,
+        executor=inference_executor,
+        concurrency=INGEST_CONCURRENCY,
+        requests_per_second=INGEST_RATE_LIMIT,
+        encode_batch_size=INGEST_ENCODE_BATCH,
+        store_chunk_size=INGEST_ADD_CHUNK,
+        progress=ingestion_progress,
+        decode=decode_image,
+        encode_text_batch=encode_texts,
+        on_stored=lambda done: resolve(done, True),
+        on_failed=lambda failed: resolve(failed, False)
+    )
+    try:
+        stored = await pipeline.run(items())
+    finally:
+        crawler.flush()
+    print(f"Added {stored} vectors to database ({crawler.skipped} characters already stored, "
+          f"crawl {'complete' if checkpoint.complete else f'paused at page {checkpoint.next_page}'})")
+
+async def refresh_character_database():
+    """Re-crawl AniList and rebuild the index as a diff against what is stored
+
+    Each vector is diffed on its own: unchanged vectors keep their embeddings,
+    new ones and ones whose image URL or prompt changed are encoded, and
+    vectors of characters (or kinds) no longer in the catalog are dropped. The result is built in a shadow collection and
+    swapped in only once complete, so queries never see a partial index.
+    """
+    global collection, search_backend, neighbor_graph, anime_index, crawler
+    loop = asyncio.get_running_loop()
+    live = collection
+    
+    print("Refresh: fetching current catalog...")
+    crawler = AniListCrawler(
+        http_session,
+        CrawlCheckpoint(CRAWL_CHECKPOINT_PATH, CRAWL_MAX_ATTEMPTS),
+        url=ANILIST_URL,
+        per_page=ANILIST_PER_PAGE,
+        max_pages=ANILIST_MAX_PAGES,
+        requests_per_second=ANILIST_RATE_LIMIT
+    )
+    catalog = {}
+    async for char in crawler.catalog():
+        if char.get('image', {}).get('large'):
+            catalog[char['id']] = char
+    if not catalog:
+        print("Refresh: catalog came back empty, keeping the current index")
+        return
+    
+    stored = await loop.run_in_executor(
+        None, lambda: live.get(include=["embeddings", "metadatas"])
+    )
+    existing = {
+        stored_id: (embedding, metadata)
+        for stored_id, embedding, metadata in zip(stored['ids'], stored['embeddings'], stored['metadatas'])
+    }
+    
+    unchanged, to_encode, wanted = [], [], set()
+    for char in catalog.values():
+        for item in character_vectors(char):
+            wanted.add(item['id'])
+            metadata = item['metadata']
+            old = existing.get(item['id'])
+            # Entries from before multi-vector indexes only carry the image URL hash
+            old_hash = old and (old[1].get('source_hash') or old[1].get('image_hash') or source_hash(old[1]['image_url']))
+            if old_hash == metadata['source_hash']:
+                if 'content_hash' in old[1]:
+                    metadata['content_hash'] = old[1]['content_hash']
+                unchanged.append((item['id'], old[0], metadata))
+            else:
+                to_encode.append(item)
+    removed = set(existing) - wanted
+    print(f"Refresh: {len(unchanged)} vectors unchanged, {len(to_encode)} new or changed, {len(removed)} removed")
+    
+    shadow = chroma_client.create_collection(
+        name=f"{COLLECTION_NAME}_{int(time.time())}",
+        metadata={"hnsw:space": "cosine"}
+    )
+    
+    # The graph is patched rather than rebuilt: only re-encoded and removed characters are re-linked
+    shadow_graph = neighbor_graph.copy() if neighbor_graph is not None else None
+    # Anime centroids are cheap sums, so they are rebuilt from everything stored in the shadow
+    shadow_anime = anime_index.fork() if anime_index is not None else None
+    
+    def store_shadow(ids: List[str], embeddings: List[List[float]], metadatas: List[dict]):
+        shadow.add(embeddings=embeddings, metadatas=metadatas, ids=ids)
+        if shadow_anime is not None:
+            shadow_anime.add(*primary_vectors(ids, embeddings, metadatas))
+    
+    def store_encoded(ids: List[str], embeddings: List[List[float]], metadatas: List[dict]):
+        store_shadow(ids, embeddings, metadatas)
+        if shadow_graph is not None:
+            shadow_graph.add(*primary_vectors(ids, embeddings, metadatas))
+    
+    def update_graph():
+        shadow_graph.remove(character_id(item_id) for item_id in removed if ':' not in item_id)
+        # An unchanged image can still come with a new name or description
+        primary = [(int(item_id), metadata) for item_id, _, metadata in unchanged if ':' not in item_id]
+        shadow_graph.relabel([anilist_id for anilist_id, _ in primary], [metadata for _, metadata in primary])
+    
+    try:
+        if shadow_graph is not None:
+            await loop.run_in_executor(None, update_graph)
         
-        # Encode character image
-        embedding = encode_image_from_url(char['image']['large'])
-        if embedding is not None:
-            embeddings.append(embedding.tolist())
-            metadatas.append({
-                'name': char['name']['full'] or char['name']['native'] or f"Character {char['id']}",
-                'anime': primary_anime,
-                'description': char.get('description', '').replace('<br>', ' ')[:200] if char.get('description') else '',
-                'image_url': char['image']['large'],
-                'anilist_id': char['id']
-            })
-            ids.append(str(char['id']))
-            
-            # Add some delay to avoid rate limiting
-            await asyncio.sleep(0.2)
-    
-    if embeddings:
-        collection.add(
-            embeddings=embeddings,
-            metadatas=metadatas,
-            ids=ids
+        # Carry unchanged embeddings over without touching the model
+        for start in range(0, len(unchanged), INGEST_ADD_CHUNK):
+            chunk = unchanged[start:start + INGEST_ADD_CHUNK]
+            await loop.run_in_executor(
+                None,
+                store_shadow,
+                [item_id for item_id, _, _ in chunk],
+                [np.asarray(embedding, dtype=float).tolist() for _, embedding, _ in chunk],
+                [metadata for _, _, metadata in chunk]
+            )
+        
+        # Vectors whose new image failed keep their old embedding
+        failed = []
+        pipeline = IngestionPipeline(
+            http_session,
+            encode_images,
+            store_encoded,
+            executor=inference_executor,
+            concurrency=INGEST_CONCURRENCY,
+            requests_per_second=INGEST_RATE_LIMIT,
+            encode_batch_size=INGEST_ENCODE_BATCH,
+            store_chunk_size=INGEST_ADD_CHUNK,
+            progress=ingestion_progress,
+            decode=decode_image,
+            encode_text_batch=encode_texts,
+            on_failed=failed.extend
         )
-        print(f"Added {len(embeddings)} characters to database")
+        await pipeline.run(to_encode)
+        
+        kept = [item['id'] for item in failed if item['id'] in existing]
+        if kept:
+            await loop.run_in_executor(
+                None,
+                store_shadow,
+                kept,
+                [np.asarray(existing[item_id][0], dtype=float).tolist() for item_id in kept],
+                [existing[item_id][1] for item_id in kept]
+            )
+        await loop.run_in_executor(inference_executor, embed_anime_titles, shadow_anime)
+    except BaseException:
+        chroma_client.delete_collection(shadow.name)
+        raise
+    
+    # Publish: point new lookups at the shadow, then retire the old collection
+    started = time.perf_counter()
+    shadow_backend = await loop.run_in_executor(None, build_search_backend, shadow)
+    load_seconds = time.perf_counter() - started
+    write_active_collection_name(shadow.name)
+    collection = shadow
+    search_backend = shadow_backend
+    neighbor_graph = shadow_graph
+    anime_index = shadow_anime
+    character_records.clear()
+    print(f"Refresh: now serving {shadow.name} with {shadow.count()} vectors")
+    await save_graph_snapshot(shadow_graph, shadow)
+    generation = publish_generation()
+    await precompute_stored_prompts(shadow_backend, shadow)
+    
+    checkpoint = crawler.checkpoint
+    checkpoint.ingested_ids = {character_id(item_id) for item_id in shadow.get(include=[])['ids']}
+    checkpoint.next_page = crawler.pages_fetched + 1
+    checkpoint.complete = True
+    checkpoint.page_cap = ANILIST_MAX_PAGES if crawler.capped else None
+    checkpoint.save()
+    
+    # Readers query the old collection until they reload, so it goes once they have all switched
+    await wait_for_workers_on(generation, RETIRE_SYNC_INTERVALS * WORKER_SYNC_SECONDS + 2 * load_seconds)
+    # Give in-flight queries against the old collection a moment to finish
+    await asyncio.sleep(min(5, WORKER_SYNC_SECONDS))
+    chroma_client.delete_collection(live.name)
+    print(f"Refresh: retired {live.name}")
+
+async def wait_for_workers_on(generation: Optional[str], timeout: float) -> bool:
+    """Wait until every other worker reports ``generation``; False if some didn't within ``timeout``"""
+    if not generation:
+        return True
+    deadline = time.monotonic() + timeout
+    while True:
+        behind = worker_registry.behind(generation)
+        if not behind:
+            return True
+        if time.monotonic() >= deadline:
+            print(f"Refresh: workers {behind} still on an older index after {timeout:.0f}s, retiring it anyway")
+            return False
+        await asyncio.sleep(min(WORKER_SYNC_SECONDS, 0.5))
+
+def decode_base64_upload(base64_image: str) -> bytes:
+    """Decode a base64 (optionally data URL) upload into raw image bytes"""
+    # Remove data URL prefix if present
+    if base64_image.startswith('data:image'):
+        base64_image = base64_image.split(',')[1]
+    
+    # Fix padding if necessary
+    missing_padding = len(base64_image) % 4
+    if missing_padding:
+        base64_image += '=' * (4 - missing_padding)
+    
+    return base64.b64decode(base64_image)
+
+async def read_base64_upload(base64_image: str) -> bytes:
+    """Decode a JSON upload off the event loop; undecodable data yields no bytes"""
+    def decode():
+        with stage_timings.time("base64"):
+            return decode_base64_upload(base64_image)
+    
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, decode)
+    except Exception as e:
+        print(f"Error decoding uploaded image: {e}")
+        return b""
+
+async def read_binary_upload(chunks, max_mb: float = MAX_UPLOAD_MB, label: str = "Image") -> bytes:
+    """Collect a streamed upload, refusing bodies over ``max_mb``"""
+    limit = int(max_mb * 1024 * 1024)
+    parts = []
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail=f"{label} larger than {max_mb}MB")
+        parts.append(chunk)
+    return b"".join(parts)
 
-def encode_uploaded_image(base64_image: str) -> Optional[np.ndarray]:
-    """Encode uploaded image using CLIP"""
+async def iter_upload_file(upload, chunk_size: int = 1024 * 1024):
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+async def encode_uploaded_image(image_bytes: bytes, cache_key: Optional[str] = None) -> Optional[np.ndarray]:
+    """Encode uploaded image using CLIP, batched with other concurrent uploads
+
+    Embeddings are cached by image content, so resubmitting the same photo
+    (e.g. from /re-examine) skips decoding and the forward pass entirely.
+    """
     if not model_loaded:
         return None
         
     try:
-        # Remove data URL prefix if present
-        if base64_image.startswith('data:image'):
-            base64_image = base64_image.split(',')[1]
-        
-        # Fix padding if necessary
-        missing_padding = len(base64_image) % 4
-        if missing_padding:
-            base64_image += '=' * (4 - missing_padding)
+        loop = asyncio.get_running_loop()
+        if cache_key is None:
+            cache_key = await loop.run_in_executor(None, EmbeddingCache.key_for, image_bytes)
+        cached = await embedding_cache.get_async(cache_key)
+        if cached is not None:
+            return cached
         
-        # Decode and process image
-        image_bytes = base64.b64decode(base64_image)
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        inputs = processor(images=image, return_tensors="pt").to(device)
+        # Reject before decoding if there is no room to queue the forward pass
+        if image_batcher.is_full():
+            image_batcher.rejected += 1
+            raise QueueFullError("Inference queue is full")
         
-        with torch.no_grad():
-            image_features = model.get_image_features(**inputs)
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        
-        return image_features.cpu().numpy().flatten()
+        # Decode off the event loop, then hand the image to the batcher
+        image = await loop.run_in_executor(None, decode_image, image_bytes)
+        embedding = await image_batcher.submit(image)
+        embedding_cache.put_async(cache_key, embedding)
+        return embedding
+    except QueueFullError:
+        raise
     except Exception as e:
         print(f"Error encoding uploaded image: {e}")
         return None
 
+async def encode_text_query(query: str) -> np.ndarray:
+    """Embed a text query: precomputed or recently seen prompts skip the text tower
+
+    Concurrent identical queries share one encode, and different ones are
+    batched into one forward pass.
+    """
+    cached = prompt_cache.get(query)
+    if cached is not None:
+        return cached
+    
+    async def encode():
+        embedding = await text_batcher.submit(TEXT_QUERY_TEMPLATE.format(query))
+        prompt_cache.put(query, embedding)
+        return embedding
+    
+    return await text_flights.run(prompt_key(query), encode)
+
+def overloaded_error(e: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+async def profile_requests(request: Request, call_next):
+    """Profile analyze calls asked for with X-Profile: 1, or sampled in "sample" mode"""
+    forced = request.headers.get("x-profile") == "1"
+    if request.url.path not in PROFILED_PATHS or not (
+        forced or (PROFILING == "sample" and random.random() < PROFILE_SAMPLE_RATE)
+    ):
+        return await call_next(request)
+    
+    session = request_profiler.start(request.url.path, forced)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        name = await asyncio.get_running_loop().run_in_executor(
+            None, request_profiler.finish, session, status_code
+        )
+    if name:
+        print(f"Saved profile {name} for {request.url.path}")
+        response.headers["X-Profile-Id"] = name
+    return response
+
+# Only installed when enabled, so requests pay nothing otherwise
+if request_profiler is not None:
+    app.middleware("http")(profile_requests)
+app.add_middleware(CountRequests, counter=served_requests)
+
 @app.post("/analyze", response_model=AnalysisResponse)
 async def analyze_image(request: ImageAnalysisRequest):
-    return await _analyze_image_internal(request.image_data)
+    try:
+        image_bytes = await read_base64_upload(request.image_data)
+        return await _analyze_image_internal(image_bytes)
+    except QueueFullError as e:
+        raise overloaded_error(e)
+
+@app.post("/analyze-binary", response_model=AnalysisResponse)
+async def analyze_image_binary(
+    request: Request,
+    search_type: str = "normal",
+    exclude_ids: List[int] = Query([]),
+    focus_ids: List[int] = Query([])
+):
+    """Analyze raw image bytes without base64/JSON wrapping
+
+    Send the image as the body (application/octet-stream or image/*) or as the
+    "image" field of a multipart form. Re-examine options go in the query
+    string, e.g. ?search_type=exclude&exclude_ids=1&exclude_ids=2.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail='Expected an "image" file field')
+        image_bytes = await read_binary_upload(iter_upload_file(upload))
+    else:
+        image_bytes = await read_binary_upload(request.stream())
+    
+    try:
+        return await _analyze_image_internal(
+            image_bytes,
+            exclude_ids=exclude_ids,
+            focus_ids=focus_ids,
+            search_type=search_type
+        )
+    except QueueFullError as e:
+        raise overloaded_error(e)
 
 @app.post("/re-examine", response_model=AnalysisResponse)
 async def re_examine_image(request: ReExamineRequest):
-    return await _analyze_image_internal(
-        request.image_data, 
-        exclude_ids=request.exclude_ids,
-        focus_ids=request.focus_ids,
-        search_type=request.search_type
+    try:
+        image_bytes = await read_base64_upload(request.image_data)
+        return await _analyze_image_internal(
+            image_bytes, 
+            exclude_ids=request.exclude_ids,
+            focus_ids=request.focus_ids,
+            search_type=request.search_type
+        )
+    except QueueFullError as e:
+        raise overloaded_error(e)
+
+@app.post("/search-text", response_model=AnalysisResponse)
+async def search_text(request: TextSearchRequest):
+    """Find characters (and anime) matching a description, e.g. "orange-haired swordsman"
+
+    The query is embedded with the CLIP text tower and searched against the
+    same character index as uploads.
+    """
+    query = request.query.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Query is empty")
+    if not TEXT_SEARCH:
+        raise HTTPException(status_code=404, detail="Text search is disabled (set TEXT_SEARCH=true)")
+    backend = search_backend
+    anime = anime_index
+    if text_model is None or backend.count() == 0:
+        raise HTTPException(
+            status_code=503,
+            detail="Text model or character index not ready",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+    
+    try:
+        embedding = await encode_text_query(query)
+    except QueueFullError as e:
+        raise overloaded_error(e)
+    except Exception as e:
+        print(f"Error encoding text query: {e}")
+        return AnalysisResponse(success=False, error=str(e))
+    exclude = request.exclude_ids or None
+    results = await asyncio.get_running_loop().run_in_executor(
+        None,
+        lambda: search_characters(backend, embedding[None, :], 10, None, exclude, anime)
     )
+    return Response(
+        content=search_response(
+            results['metadatas'][0], results['distances'][0], exclude=exclude,
+            min_confidence=TEXT_MIN_CONFIDENCE, anime_recommendations=results['anime'][0]
+        ),
+        media_type="application/json"
+    )
+
+@app.post("/analyze-batch")
+async def analyze_image_batch(
+    request: Request,
+    search_type: str = "normal",
+    exclude_ids: List[int] = Query([]),
+    focus_ids: List[int] = Query([])
+):
+    """Analyze many images in one request, streaming one NDJSON line per image
+
+    Send either a multipart form with any number of image files (re-examine
+    options for all of them go in the query string, as for /analyze-binary),
+    or an application/x-ndjson body with one object per line: image_data plus
+    optional id, search_type, exclude_ids and focus_ids. Images are decoded,
+    encoded and searched ANALYZE_BATCH_SIZE at a time, and each sub-batch's
+    results are written as soon as it finishes, in input order. A bad image
+    only fails its own line (success=false with an error).
+    
+    Images go through the same admission queue as /analyze: while it is full
+    the request gets 503 with Retry-After, and once results are streaming an
+    image the queue turns away fails its own line.
+    """
+    # Bulk scoring never falls back to sample characters
+    backend = search_backend
+    anime = anime_index
+    if not model_loaded or backend.count() == 0:
+        raise HTTPException(
+            status_code=503,
+            detail="Model or character index not ready",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+    if image_batcher.is_full():
+        image_batcher.rejected += 1
+        raise overloaded_error(QueueFullError("Inference queue is full"))
+    
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        items = await read_multipart_batch(request, search_type, exclude_ids, focus_ids)
+    else:
+        items = await read_ndjson_batch(request)
+    
+    # The first sub-batch runs before the response starts, so a full queue can still be a 503
+    try:
+        first = await analyze_sub_batch(backend, anime, items[:ANALYZE_BATCH_SIZE], admit=True)
+    except QueueFullError as e:
+        raise overloaded_error(e)
+    
+    async def stream_results():
+        failed = 0
+        for start in range(0, len(items), ANALYZE_BATCH_SIZE):
+            results = first if start == 0 else await analyze_sub_batch(backend, anime, items[start:start + ANALYZE_BATCH_SIZE])
+            for success, line in results:
+                failed += not success
+                yield line + b"\n"
+        print(f"Batch analysis: {len(items)} images, {failed} failed")
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+async def read_multipart_batch(request: Request, search_type: str, exclude_ids: List[int], focus_ids: List[int]) -> List[dict]:
+    """Every file field of the form becomes an item; files are read when their sub-batch runs"""
+    form = await request.form()
+    uploads = [upload for _, upload in form.multi_items() if not isinstance(upload, str)]
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Expected one or more image files")
+    if len(uploads) > ANALYZE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"More than {ANALYZE_BATCH_MAX_ITEMS} images")
+    
+    return [
+        {
+            "index": index,
+            "id": upload.filename,
+            "upload": upload,
+            "search_type": search_type,
+            "exclude_ids": exclude_ids,
+            "focus_ids": focus_ids
+        }
+        for index, upload in enumerate(uploads)
+    ]
+
+async def read_ndjson_batch(request: Request) -> List[dict]:
+    """Parse an NDJSON body; a malformed line becomes a failed item rather than a failed request"""
+    body = await read_binary_upload(request.stream(), ANALYZE_BATCH_MAX_MB, "Batch")
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        if len(items) == ANALYZE_BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"More than {ANALYZE_BATCH_MAX_ITEMS} images")
+        
+        index = len(items)
+        try:
+            items.append({"index": index, **BatchAnalysisItem.parse_raw(line).dict()})
+        except ValidationError as e:
+            items.append({"index": index, "id": None, "error": f"Invalid item: {e.errors()[0]['msg']}"})
+    
+    if not items:
+        raise HTTPException(status_code=400, detail="Expected one or more NDJSON items")
+    return items
+
+async def analyze_sub_batch(backend, anime: Optional[AnimeIndex], items: List[dict], admit: bool = False) -> List[tuple]:
+    """Decode, encode and search one slice of an /analyze-batch request
+
+    Returns (success, encoded BatchAnalysisResult) per item, in order. With
+    ``admit``, a full inference queue raises QueueFullError instead.
+    """
+    loop = asyncio.get_running_loop()
+    
+    async def load(item: dict):
+        """Return (cache key, cached embedding or decoded image) for one item"""
+        if item.get("error"):
+            raise ValueError(item["error"])
+        
+        if "upload" in item:
+            try:
+                image_bytes = await read_binary_upload(iter_upload_file(item.pop("upload")))
+            except HTTPException as e:
+                raise ValueError(e.detail)
+        else:
+            image_data = item.pop("image_data")
+            
+            def decode():
+                with stage_timings.time("base64"):
+                    return decode_base64_upload(image_data)
+            
+            try:
+                image_bytes = await loop.run_in_executor(None, decode)
+            except ValueError:
+                raise ValueError("Invalid base64 image data")
+        
+        cache_key = await loop.run_in_executor(None, EmbeddingCache.key_for, image_bytes)
+        cached = await embedding_cache.get_async(cache_key)
+        if cached is not None:
+            return cache_key, cached
+        try:
+            return cache_key, await loop.run_in_executor(None, decode_image, image_bytes)
+        except OSError:
+            raise ValueError("Could not decode image")
+    
+    loaded = await asyncio.gather(*(load(item) for item in items), return_exceptions=True)
+    
+    # One forward pass for every image that missed the cache
+    pending = [i for i, value in enumerate(loaded) if not isinstance(value, Exception) and isinstance(value[1], Image.Image)]
+    if pending:
+        embeddings = await encode_image_batch([loaded[i][1] for i in pending])
+        rejected = [e for e in embeddings if isinstance(e, QueueFullError)]
+        if admit and rejected:
+            raise rejected[0]
+        for i, embedding in zip(pending, embeddings):
+            if isinstance(embedding, Exception):
+                loaded[i] = embedding
+            else:
+                embedding_cache.put_async(loaded[i][0], embedding)
+                loaded[i] = (loaded[i][0], embedding)
+    
+    # Items sharing re-examine filters are searched together
+    groups = {}
+    for i, item in enumerate(items):
+        if isinstance(loaded[i], Exception):
+            continue
+        include = tuple(item["focus_ids"]) if item["search_type"] == "focus" and item["focus_ids"] else None
+        exclude = tuple(item["exclude_ids"]) if item["search_type"] in ("exclude", "neighbors") and item["exclude_ids"] else None
+        groups.setdefault((include, exclude), []).append(i)
+    
+    responses = {}
+    for (include, exclude), members in groups.items():
+        queries = np.stack([loaded[i][1] for i in members])
+        n_results = len(include) if include else 10
+        try:
+            results = await loop.run_in_executor(
+                None,
+                functools.partial(search_characters, backend, queries, n_results, include, exclude, anime)
+            )
+        except Exception as e:
+            print(f"Error searching batch: {e}")
+            for i in members:
+                loaded[i] = e
+            continue
+        for row, i in enumerate(members):
+            responses[i] = search_response(
+                results['metadatas'][row], results['distances'][row], include, exclude,
+                anime_recommendations=results['anime'][row], index=items[i]["index"], id=items[i]["id"]
+            )
+    
+    # Failed lines go through the same compact encoder as the successful ones
+    return [
+        (True, responses[i]) if i in responses else (False, dumps(BatchAnalysisResult(
+            index=item["index"], id=item["id"], success=False, error=str(loaded[i]) or type(loaded[i]).__name__
+        ).dict()))
+        for i, item in enumerate(items)
+    ]
+
+async def encode_image_batch(images: List[Image.Image]) -> list:
+    """Encode through the image batcher, returning an embedding or exception per image
+
+    Images the full queue turns away get QueueFullError. A failed forward pass
+    fails every image batched with it, so those are retried one at a time and
+    only the images that actually fail get an error.
+    """
+    embeddings = await asyncio.gather(*(image_batcher.submit(image) for image in images), return_exceptions=True)
+    failed = [i for i, e in enumerate(embeddings) if isinstance(e, Exception) and not isinstance(e, QueueFullError)]
+    if failed:
+        print(f"Batch encode failed, retrying {len(failed)} images one at a time: {embeddings[failed[0]]}")
+    for i in failed:
+        try:
+            embeddings[i] = await image_batcher.submit(images[i])
+        except Exception as e:
+            embeddings[i] = e
+    return embeddings
 
 async def _analyze_image_internal(
-    image_data: str, 
+    image_bytes: bytes, 
     exclude_ids: List[int] = None, 
     focus_ids: List[int] = None,
     search_type: str = "normal"
+):
+    """Analyze an upload, sharing the work between identical concurrent requests
+
+    Double submits and client retries carry the same image and options, so
+    they are keyed by content hash plus the filters that actually apply, and
+    wait on the first request's analysis instead of decoding and encoding again.
+    """
+    exclude_ids = exclude_ids or []
+    focus_ids = focus_ids or []
+    cache_key = await asyncio.get_running_loop().run_in_executor(None, EmbeddingCache.key_for, image_bytes)
+    include = tuple(sorted(set(focus_ids))) if search_type == "focus" and focus_ids else None
+    exclude = tuple(sorted(set(exclude_ids))) if search_type in ("exclude", "neighbors") and exclude_ids else None
+    
+    result = await analysis_flights.run(
+        (cache_key, include, exclude, search_type == "neighbors" and exclude is not None),
+        lambda: _run_analysis(image_bytes, cache_key, exclude_ids, focus_ids, search_type)
+    )
+    # Each caller gets its own response around the shared body
+    if isinstance(result, bytes):
+        return Response(content=result, media_type="application/json")
+    return result
+
+async def _run_analysis(
+    image_bytes: bytes,
+    cache_key: str,
+    exclude_ids: List[int],
+    focus_ids: List[int],
+    search_type: str
 ):
     try:
-        exclude_ids = exclude_ids or []
-        focus_ids = focus_ids or []
+        # Hold on to one backend for the whole request in case a refresh swaps it
+        backend = search_backend
+        anime = anime_index
         
-        if model_loaded and collection.count() > 0:
+        fallback_reason = "not_ready"
+        if model_loaded and backend.count() > 0:
             # Use real CLIP analysis
-            query_embedding = encode_uploaded_image(image_data)
+            query_embedding = await encode_uploaded_image(image_bytes, cache_key)
+            
+            fallback_reason = "encode_failed"
+            graph = neighbor_graph
+            if query_embedding is not None and search_type == "neighbors" and exclude_ids and graph and graph.count():
+                # Alternatives to the characters just shown are close to them, so only their graph
+                # neighbourhood is ranked against the (usually cached) query vector
+                with stage_timings.time("neighbors"):
+                    results = graph.search(query_embedding, exclude_ids, 10)
+                if results['metadatas'][0]:
+                    return search_response(
+                        results['metadatas'][0], results['distances'][0], exclude=exclude_ids,
+                        anime_recommendations=recommend_anime(anime, query_embedding[None, :])[0]
+                    )
             
             if query_embedding is not None:
-                # Determine search parameters based on search type
-                n_results = 50 if search_type in ["exclude", "focus"] else 10
+                # Filters are applied inside the search, so only the rows we return are scored
+                include = focus_ids if search_type == "focus" and focus_ids else None
+                exclude = exclude_ids if search_type in ("exclude", "neighbors") and exclude_ids else None
+                n_results = len(include) if include else 10
                 
-                # Search for similar characters
-                results = collection.query(
-                    query_embeddings=[query_embedding.tolist()],
-                    n_results=n_results
+                # Search for similar characters off the event loop
+                results = await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    lambda: search_characters(backend, query_embedding[None, :], n_results, include, exclude, anime)
                 )
                 
+                fallback_reason = "no_results"
                 if results['metadatas'] and results['metadatas'][0]:
-                    # Convert results to Character objects
-                    all_characters = []
-                    for i, metadata in enumerate(results['metadatas'][0]):
-                        distance = results['distances'][0][i]
-                        confidence = max(0, 1 - distance)  # Convert distance to confidence
-                        
-                        character = Character(
-                            id=metadata['anilist_id'],
-                            name=metadata['name'],
-                            anime=metadata['anime'],
-                            description=metadata['description'],
-                            image_url=metadata['image_url'],
-                            confidence=confidence
-                        )
-                        all_characters.append(character)
-                    
-                    # Apply filtering based on search type
-                    if search_type == "exclude" and exclude_ids:
-                        # Exclude specified characters and find new ones
-                        filtered_characters = [c for c in all_characters if c.id not in exclude_ids]
-                        # Lower confidence threshold for exclude searches to find more alternatives
-                        good_matches = [c for c in filtered_characters if c.confidence > 0.1][:5]
-                        print(f"Excluded {len(exclude_ids)} characters, found {len(good_matches)} alternatives")
-                    elif search_type == "focus" and focus_ids:
-                        # Focus only on specified characters, re-ranked by confidence
-                        focused_characters = [c for c in all_characters if c.id in focus_ids]
-                        good_matches = sorted(focused_characters, key=lambda x: x.confidence, reverse=True)[:5]
-                        print(f"Focused on {len(focus_ids)} characters, found {len(good_matches)} matches")
-                    else:
-                        # Normal search
-                        good_matches = [c for c in all_characters if c.confidence > 0.2][:5]
-                    
-                    best_match = good_matches[0] if good_matches else None
-                    suggestions = good_matches
-                    
-                    return AnalysisResponse(
-                        success=True,
-                        character=best_match,
-                        suggestions=suggestions
+                    return search_response(
+                        results['metadatas'][0], results['distances'][0], include, exclude,
+                        anime_recommendations=results['anime'][0]
                     )
         
         # Fallback to sample data with improved logic
+        fallback_responses[fallback_reason] += 1
         await asyncio.sleep(1)  # Simulate processing time
         
         # Use basic image analysis (size, format) to influence results
         try:
-            if image_data.startswith('data:image'):
-                image_data_clean = image_data.split(',')[1]
-            else:
-                image_data_clean = image_data
-            
-            # Fix padding if necessary
-            missing_padding = len(image_data_clean) % 4
-            if missing_padding:
-                image_data_clean += '=' * (4 - missing_padding)
-                
-            image_bytes = base64.b64decode(image_data_clean)
             image = Image.open(io.BytesIO(image_bytes))
             
             # Simple heuristics based on image properties
@@ -395,7 +1743,7 @@ async def _analyze_image_internal(
             # Apply filtering for fallback data too
             available_characters = SAMPLE_CHARACTERS.copy()
             
-            if search_type == "exclude" and exclude_ids:
+            if search_type in ("exclude", "neighbors") and exclude_ids:
                 available_characters = [c for c in available_characters if c["id"] not in exclude_ids]
                 print(f"Fallback: Excluded {len(exclude_ids)} characters, {len(available_characters)} remaining")
             elif search_type == "focus" and focus_ids:
@@ -450,12 +1798,62 @@ async def _analyze_image_internal(
                 suggestions=[character]
             )
         
+    except QueueFullError:
+        raise
     except Exception as e:
         return AnalysisResponse(
             success=False,
             error=str(e)
         )
 
+def search_characters(backend, queries: np.ndarray, n_results: int, include=None, exclude=None, anime=None) -> dict:
+    """Run a (possibly multi-query) character search, timed as the "search" stage
+
+    Given an anime index, the same queries are ranked against its centroids in
+    the same pass and the per-query recommendations returned as ``results['anime']``.
+    """
+    with stage_timings.time("search", len(queries)):
+        results = backend.search(queries, n_results, include_ids=include, exclude_ids=exclude)
+    results['anime'] = recommend_anime(anime, queries)
+    return results
+
+def recommend_anime(anime: Optional[AnimeIndex], queries: np.ndarray) -> List[List[dict]]:
+    if anime is None or not anime.count():
+        return [[] for _ in queries]
+    with stage_timings.time("anime_search", len(queries)):
+        return anime.search(queries, ANIME_RECOMMENDATIONS)
+
+def search_response(metadatas: List[dict], distances: List[float], include=None, exclude=None,
+                    min_confidence: Optional[float] = None, **extra) -> bytes:
+    """Encode one query's search hits as an AnalysisResponse JSON body
+
+    Characters come from pre-encoded records, so each row costs a dict lookup
+    and a float format instead of a pydantic model plus validation.
+    """
+    with stage_timings.time("response"):
+        # Convert distance to confidence
+        matches = [
+            (character_records.get(metadata), max(0, 1 - distance))
+            for metadata, distance in zip(metadatas, distances)
+        ]
+        
+        # Apply filtering based on search type
+        if min_confidence is not None:
+            good_matches = [m for m in matches if m[1] > min_confidence][:5]
+        elif exclude:
+            # Lower confidence threshold for exclude searches to find more alternatives
+            good_matches = [m for m in matches if m[1] > 0.1][:5]
+            print(f"Excluded {len(exclude)} characters, found {len(good_matches)} alternatives")
+        elif include:
+            # Results are already only the focused characters, ranked by confidence
+            good_matches = matches[:5]
+            print(f"Focused on {len(include)} characters, found {len(good_matches)} matches")
+        else:
+            # Normal search
+            good_matches = [m for m in matches if m[1] > 0.2][:5]
+        
+        return encode_analysis(good_matches, **extra)
+
 @app.get("/health")
 async def health_check():
     return {
@@ -463,23 +1861,221 @@ async def health_check():
         "model_device": device,
         "model_loaded": model_loaded,
         "characters_count": collection.count() if collection else len(SAMPLE_CHARACTERS),
+        "startup": startup_phases,
         "version": "hybrid"
     }
 
+@app.get("/health/live")
+async def liveness_check():
+    """Liveness: the process is up and the event loop is answering"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness_check(response: Response):
+    """Readiness: real inference is possible and the pod isn't saturated
+
+    Fails (503) until the model is loaded and warmed up and the index has
+    characters, and again whenever the inference queue fills past
+    READY_QUEUE_THRESHOLD so the pod drops out of rotation under overload.
+    """
+    batching = image_batcher.stats() if image_batcher else {}
+    capacity = batching.get("queue_capacity")
+    saturation = batching.get("queue_depth", 0) / capacity if capacity else 0.0
+    checks = {
+        "model_loaded": model_loaded,
+        "warmed_up": warmed_up,
+        "index_populated": bool(search_backend and search_backend.count() > 0),
+        "queue_ok": saturation < READY_QUEUE_THRESHOLD,
+    }
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = 503
+    return {
+        "ready": ready,
+        "checks": checks,
+        "queue_depth": batching.get("queue_depth", 0),
+        "queue_capacity": capacity,
+        "queue_saturation": round(saturation, 3),
+        "in_flight_batches": batching.get("in_flight_batches", 0)
+    }
+
+@app.get("/stats")
+async def stats():
+    """Runtime statistics for the inference pipeline"""
+    return {
+        "batching": image_batcher.stats() if image_batcher else None,
+        "ingestion": ingestion_progress.to_dict(),
+        "embedding_cache": embedding_cache.stats(),
+        "search": search_backend.stats() if search_backend else None,
+        "stages": stage_timings.stats(),
+        "fallback_responses": dict(fallback_responses),
+        "character_records": character_records.stats(),
+        "coalescing": analysis_flights.stats(),
+        "neighbor_graph": neighbor_graph.stats() if neighbor_graph else None,
+        "anime_index": anime_index.stats() if anime_index else None,
+        "text_search": {
+            "batching": text_batcher.stats() if text_batcher else None,
+            "prompt_cache": prompt_cache.stats(),
+            "coalescing": text_flights.stats(),
+        },
+        "inference": {
+            "backend": INFERENCE_BACKEND,
+            "onnx": onnx_encoder.stats() if onnx_encoder else None,
+            "rss_mb": round(process_rss_mb(), 1)
+        }
+    }
+
+def process_rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage latency histograms plus queue, cache and ingestion counters"""
+    writer = MetricsWriter(prefix="clip_")
+    
+    writer.histogram(
+        "stage_duration_seconds",
+        "Time per call of each pipeline stage (a batched forward pass is one call)",
+        [({"stage": stage}, histogram) for stage, histogram in sorted(stage_timings.histograms().items())]
+    )
+    writer.counter(
+        "stage_images_total",
+        "Images handled by each pipeline stage",
+        [({"stage": stage}, count) for stage, count in sorted(stage_timings.items().items())]
+    )
+    writer.counter(
+        "fallback_responses_total",
+        "Analyses answered with sample characters instead of a real search",
+        [({"reason": reason}, fallback_responses[reason]) for reason in ("not_ready", "encode_failed", "no_results")]
+    )
+    
+    flights = analysis_flights.stats()
+    writer.counter("analyses_total", "Analyses actually run (coalesced requests excluded)", flights["calls"])
+    writer.counter("coalesced_requests_total", "Requests that waited on an identical in-flight analysis", flights["coalesced"])
+    
+    cache = embedding_cache.stats()
+    writer.counter("embedding_cache_hits_total", "Embedding cache hits", [
+        ({"tier": "memory"}, cache["hits"]), ({"tier": "disk"}, cache["disk_hits"])
+    ])
+    writer.counter("embedding_cache_misses_total", "Embedding cache misses", cache["misses"])
+    writer.counter("embedding_cache_evictions_total", "Embedding cache evictions", cache["evictions"])
+    prompts = prompt_cache.stats()
+    writer.counter("text_prompt_cache_hits_total", "Text queries answered without the text tower", [
+        ({"table": "precomputed"}, prompts["precomputed_hits"]), ({"table": "recent"}, prompts["hits"])
+    ])
+    writer.counter("text_prompt_cache_misses_total", "Text queries in neither table (identical concurrent ones share an encode)", prompts["misses"])
+    writer.gauge("text_prompt_cache_entries", "Text query embeddings held", [
+        ({"table": "precomputed"}, prompts["precomputed"]), ({"table": "recent"}, prompts["entries"])
+    ])
+    writer.gauge("embedding_cache_bytes", "Embedding bytes held in memory", cache["bytes"])
+    
+    if image_batcher:
+        batching = image_batcher.stats()
+        writer.gauge("inference_queue_depth", "Uploads waiting for a forward pass", batching["queue_depth"])
+        writer.gauge("inference_queue_capacity", "Admission queue size (0 means unbounded)", batching["queue_capacity"] or 0)
+        writer.gauge("inference_in_flight_batches", "Batches currently in a forward pass", batching["in_flight_batches"])
+        writer.counter("inference_rejected_total", "Uploads refused because the queue was full", batching["rejected"])
+        writer.histogram("inference_batch_size", "Uploads per forward pass", [
+            ({}, Histogram.from_counts(image_batcher.batch_size_counts, BATCH_SIZE_BUCKETS))
+        ])
+    
+    progress = ingestion_progress.to_dict()
+    writer.counter(
+        "ingestion_items_total",
+        "Items through each ingestion step in the current or last run (resets when a run starts)",
+        [({"step": step}, progress[step]) for step in ("queued", "downloaded", "decoded", "encoded", "reused", "stored", "failed")]
+    )
+    writer.gauge("ingestion_running", "1 while an ingestion or refresh is running", int(progress["state"] == "running"))
+    
+    writer.gauge("model_loaded", "1 once the CLIP model is loaded and warmed up", int(model_loaded and warmed_up))
+    writer.gauge("index_vectors", "Vectors in the active search index", search_backend.count() if search_backend else 0)
+    writer.gauge("anime_index_titles", "Anime with a recommendation centroid", anime_index.count() if anime_index else 0)
+    
+    return Response(content=writer.render(), media_type=MetricsWriter.CONTENT_TYPE)
+
+@app.get("/profiles")
+async def list_profiles():
+    """Saved request profiles, newest first"""
+    if request_profiler is None:
+        return {"enabled": False, "profiles": []}
+    profiles = await asyncio.get_running_loop().run_in_executor(None, request_profiler.list)
+    return {"enabled": True, "mode": PROFILING, **request_profiler.stats(), "profiles": profiles}
+
+@app.get("/profiles/{name}")
+async def download_profile(name: str):
+    """One profile as a zip: request.json, stacks.folded, summary.txt and any torch traces"""
+    path = request_profiler.file_path(name) if request_profiler else None
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/zip", filename=name)
+
+@app.get("/workers")
+async def workers():
+    """Per-worker memory, role and throughput, plus totals across workers
+
+    Pre-forked workers share the model weights and the mapped index, so their
+    rss values overlap; the pss values add up to the memory actually used.
+    """
+    worker_registry.report(
+        served_requests.count,
+        role="writer" if is_writer else "reader",
+        model_loaded=model_loaded,
+        vectors=search_backend.count() if search_backend else 0,
+        generation=loaded_generation
+    )
+    stats = worker_registry.workers()
+    return {
+        "prefork": SERVE_PREFORK,
+        "served_by": os.getpid(),
+        "writer": writer_lock.owner() if writer_lock else os.getpid(),
+        "generation": worker_registry.generation(),
+        "workers": stats,
+        "total": {
+            "workers": len(stats),
+            "requests": sum(worker["requests"] for worker in stats),
+            "requests_per_second": round(sum(worker["requests_per_second"] for worker in stats), 2),
+            "rss_mb": round(sum(worker["rss_mb"] for worker in stats), 1),
+            "pss_mb": round(sum(worker.get("pss_mb", 0) for worker in stats), 1),
+        }
+    }
+
+@app.get("/ingestion-status")
+async def ingestion_status():
+    """Progress of the running (or last) character database ingestion"""
+    return {
+        **ingestion_progress.to_dict(),
+        "crawl": crawler.to_dict() if crawler else CrawlCheckpoint.load(CRAWL_CHECKPOINT_PATH, CRAWL_MAX_ATTEMPTS).to_dict()
+    }
+
 @app.post("/refresh-database")
 async def refresh_database():
     """Manually refresh the character database"""
     try:
+        if SERVE_PREFORK and not is_writer:
+            # Only the writer may change the database; it picks this up on its next sync
+            worker_registry.request_refresh()
+            return {
+                "success": True,
+                "message": f"Refresh requested from writer worker {writer_lock.owner()}, see /workers"
+            }
         if model_loaded:
-            # Clear existing data
-            collection.delete(where={})
-            
-            # Repopulate
-            await populate_character_database()
+            # The refresh can take a while, so run it in the background
+            if not await start_refresh():
+                return {
+                    "success": False,
+                    "message": "A database update is already running, see /ingestion-status"
+                }
             
             return {
                 "success": True,
-                "message": f"Database refreshed with {collection.count()} characters"
+                "message": f"Database refresh started from {collection.count()} characters, see /ingestion-status"
             }
         else:
             return {
@@ -489,5 +2085,34 @@ async def refresh_database():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def start_refresh() -> bool:
+    """Schedule a background refresh, unless an ingestion or refresh is already running
+
+    The lock is taken before the task is scheduled, so a second request
+    arriving in between sees it held instead of queueing another refresh.
+    """
+    if ingestion_lock.locked():
+        return False
+    await ingestion_lock.acquire()
+    asyncio.create_task(run_refresh())
+    return True
+
+async def run_refresh():
+    """Refresh the database, then release the ingestion lock ``start_refresh`` took"""
+    try:
+        await refresh_character_database()
+    except Exception as e:
+        print(f"Database refresh failed, keeping the current index: {e}")
+    finally:
+        ingestion_lock.release()
+
+# gunicorn imports the app once in its master (preload_app), so this runs before any worker is forked.
+# CUDA can't be shared across a fork and an ONNX Runtime session isn't fork-safe, so those load per worker
+if SERVE_PREFORK and INFERENCE_BACKEND == "torch" and device == "cpu":
+    preload_models()
+if SERVE_PREFORK:
+    # Generations are per server run, so readers only ever map snapshots this run's writer published
+    WorkerRegistry(WORKER_STATE_DIR).clear_generation()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -0,0 +1,114 @@
+import bisect
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+# Seconds, from a cached lookup up to a cold forward pass on CPU
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Dict[str, str]
+
+
+class Histogram:
+    """Fixed-bucket histogram in the Prometheus sense (``le`` is inclusive)
+
+    Not locked: callers that observe from several threads serialize access
+    themselves, as ``StageTimings`` does.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One slot per bucket plus the +Inf overflow
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @classmethod
+    def from_counts(cls, value_counts: Dict[float, int], buckets: Sequence[float]) -> "Histogram":
+        """Build from already tallied ``{value: occurrences}``"""
+        histogram = cls(buckets)
+        for value, occurrences in value_counts.items():
+            histogram.counts[bisect.bisect_left(histogram.buckets, value)] += occurrences
+            histogram.sum += value * occurrences
+        return histogram
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        return histogram
+
+
+class MetricsWriter:
+    """Builds a Prometheus text format (0.0.4) exposition"""
+
+    # Starlette appends the charset to text/* media types
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.lines: List[str] = []
+
+    def counter(self, name: str, help_text: str, samples: Union[float, Iterable[Tuple[Labels, float]]]):
+        self._write(name, "counter", help_text, samples)
+
+    def gauge(self, name: str, help_text: str, samples: Union[float, Iterable[Tuple[Labels, float]]]):
+        self._write(name, "gauge", help_text, samples)
+
+    def histogram(self, name: str, help_text: str, series: Iterable[Tuple[Labels, Histogram]]):
+        name = self.prefix + name
+        self._header(name, "histogram", help_text)
+        for labels, histogram in series:
+            cumulative = 0
+            for bound, count in zip(self.bucket_bounds(histogram), histogram.counts):
+                cumulative += count
+                self._sample(f"{name}_bucket", {**labels, "le": bound}, cumulative)
+            self._sample(f"{name}_sum", labels, histogram.sum)
+            self._sample(f"{name}_count", labels, cumulative)
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+    @staticmethod
+    def bucket_bounds(histogram: Histogram) -> List[str]:
+        return [format_value(bound) for bound in histogram.buckets] + ["+Inf"]
+
+    def _write(self, name: str, kind: str, help_text: str, samples):
+        name = self.prefix + name
+        self._header(name, kind, help_text)
+        if isinstance(samples, (int, float)):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self._sample(name, labels, value)
+
+    def _header(self, name: str, kind: str, help_text: str):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def _sample(self, name: str, labels: Optional[Labels], value: float):
+        if labels:
+            label_text = ",".join(f'{key}="{escape_label(str(label))}"' for key, label in labels.items())
+            name = f"{name}{{{label_text}}}"
+        self.lines.append(f"{name} {format_value(value)}")
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+import time
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+
+# Snapshot directory layout: a JSON manifest naming the current array files
+GRAPH_MANIFEST = 'graph.json'
+GRAPH_ARRAYS = ('ids', 'vectors', 'neighbors', 'similarities')
+
+
+class NeighborGraph:
+    """Top-k most similar characters for every stored character
+
+    Each character is represented by its primary (large image) vector. The
+    adjacency is array-backed: row ``i`` of ``neighbors`` holds the row
+    numbers of character ``i``'s ``k`` nearest characters, best first, with
+    their cosine similarities alongside (-1 / -inf pad short rows). Vectors are
+    kept (4 bytes per dimension per character) so characters can be linked in
+    or out incrementally: an add scores only the new rows against everything,
+    and a remove recomputes only the rows that pointed at removed characters.
+
+    Updates build new arrays and swap them in, so readers never lock.
+    A graph saved with ``save_snapshot`` is memory-mapped by ``from_snapshot``.
+    """
+
+    def __init__(self, k: int = 32, chunk_scores: int = 1 << 24):
+        self.k = max(1, k)
+        # Upper bound on the similarity block scored at once (64 MB of float32)
+        self.chunk_scores = max(1, chunk_scores)
+        self._lock = threading.Lock()
+        self._data = self._pack(np.empty(0, dtype=np.int64), None, [],
+                                np.empty((0, self.k), dtype=np.int32), np.empty((0, self.k), dtype=np.float32))
+        self._lookup = None
+        self.updates = 0
+        self.rows_scored = 0
+        self.last_update_ms = 0.0
+
+    @staticmethod
+    def _pack(ids, vectors, metadatas, neighbors, similarities):
+        return ids, vectors, metadatas, neighbors, similarities
+
+    @classmethod
+    def from_snapshot(cls, directory: str, key: dict, k: int = 32, **options) -> Optional["NeighborGraph"]:
+        """Map a graph written by ``save_snapshot`` with the same ``key`` and ``k``, or None
+
+        Pages are read lazily and shared with any other process mapping the
+        same files. Updates copy the arrays as usual.
+        """
+        manifest = read_graph_manifest(directory)
+        if not manifest or manifest.get('k') != k or any(manifest.get(name) != value for name, value in key.items()):
+            return None
+        try:
+            arrays = {name: np.load(os.path.join(directory, manifest['files'][name]), mmap_mode='r')
+                      for name in GRAPH_ARRAYS}
+        except OSError:
+            # A newer snapshot replaced the files after the manifest was read
+            return None
+        graph = cls(k, **options)
+        graph._data = graph._pack(arrays['ids'], arrays['vectors'], manifest['metadata'],
+                                  arrays['neighbors'], arrays['similarities'])
+        return graph
+
+    def save_snapshot(self, directory: str, key: dict):
+        """Write the arrays as ``.npy`` files and the metadata and ``key`` as a JSON manifest
+
+        ``key`` says what the graph was built from; ``from_snapshot`` only maps
+        a graph with the same key. Each snapshot gets new files and the manifest
+        is replaced last. Afterwards the graph maps the written files instead
+        of holding its own copy, unless it changed meanwhile. An empty graph is
+        not written.
+        """
+        data = self._data
+        if not len(data[0]):
+            return
+        os.makedirs(directory, exist_ok=True)
+        prefix = f"graph-{int(time.time() * 1000)}"
+        files = {}
+        for name, array in zip(GRAPH_ARRAYS, (data[0], data[1], data[3], data[4])):
+            files[name] = f"{prefix}-{name}.npy"
+            tmp_path = os.path.join(directory, files[name] + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, os.path.join(directory, files[name]))
+
+        manifest = {**key, 'k': self.k, 'files': files, 'created_at': time.time(), 'metadata': list(data[2])}
+        manifest_path = os.path.join(directory, GRAPH_MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        mapped = {name: np.load(os.path.join(directory, files[name]), mmap_mode='r') for name in GRAPH_ARRAYS}
+        with self._lock:
+            if self._data is data:
+                self._data = self._pack(mapped['ids'], mapped['vectors'], data[2], mapped['neighbors'], mapped['similarities'])
+
+        # Processes still mapping old files keep them alive until they let go
+        current = set(files.values())
+        for entry in os.listdir(directory):
+            if entry.startswith('graph-') and entry.endswith('.npy') and entry not in current:
+                os.remove(os.path.join(directory, entry))
+
+    def count(self) -> int:
+        return len(self._data[0])
+
+    def copy(self) -> "NeighborGraph":
+        """An independent graph sharing the current (immutable) arrays"""
+        graph = NeighborGraph(self.k, self.chunk_scores)
+        graph._data = self._data
+        return graph
+
+    def add(self, ids: Sequence[int], vectors, metadatas: Sequence[dict]):
+        """Link characters in; ids already present are replaced"""
+        if not len(ids):
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        ids = np.asarray(ids, dtype=np.int64)
+        started = time.perf_counter()
+
+        with self._lock:
+            # A replaced character's old similarities are stale everywhere
+            replaced = ids[np.isin(ids, self._data[0])]
+            if len(replaced):
+                self._remove_locked(replaced)
+            old_ids, old_vectors, old_metadatas, old_neighbors, old_similarities = self._data
+            n_old = len(old_ids)
+            all_vectors = vectors if old_vectors is None else np.concatenate([old_vectors, vectors])
+            new_rows = np.arange(n_old, n_old + len(ids))
+
+            # Existing rows only need the new characters as extra candidates
+            neighbors = np.empty((n_old, self.k), dtype=np.int32)
+            similarities = np.empty((n_old, self.k), dtype=np.float32)
+            step = self._chunk_rows(len(ids))
+            for start in range(0, n_old, step):
+                stop = min(start + step, n_old)
+                scores = old_vectors[start:stop] @ vectors.T
+                candidates = np.concatenate([old_neighbors[start:stop], np.broadcast_to(new_rows, scores.shape)], axis=1)
+                candidate_scores = np.concatenate([old_similarities[start:stop], scores], axis=1)
+                neighbors[start:stop], similarities[start:stop] = self._best(candidates, candidate_scores)
+
+            added_neighbors, added_similarities = self._score_rows(all_vectors, new_rows)
+            self._data = self._pack(
+                np.concatenate([old_ids, ids]),
+                all_vectors,
+                list(old_metadatas) + list(metadatas),
+                np.concatenate([neighbors, added_neighbors]),
+                np.concatenate([similarities, added_similarities]),
+            )
+            self._record(started)
+
+    def remove(self, ids: Iterable[int]):
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if not len(ids):
+            return
+        started = time.perf_counter()
+        with self._lock:
+            self._remove_locked(ids)
+            self._record(started)
+
+    def relabel(self, ids: Sequence[int], metadatas: Sequence[dict]):
+        """Replace the metadata of characters whose vector did not change"""
+        with self._lock:
+            data = self._data
+            updated = list(data[2])
+            for anilist_id, metadata in zip(ids, metadatas):
+                rows = self.rows_for([anilist_id], data)
+                if rows:
+                    updated[rows[0]] = metadata
+            self._data = self._pack(data[0], data[1], updated, data[3], data[4])
+
+    def _remove_locked(self, ids: np.ndarray):
+        old_ids, vectors, metadatas, neighbors, similarities = self._data
+        drop = np.isin(old_ids, ids)
+        if not drop.any():
+            return
+        keep = np.flatnonzero(~drop)
+        remap = np.full(len(old_ids) + 1, -1, dtype=np.int32)
+        remap[keep] = np.arange(len(keep), dtype=np.int32)
+        # -1 padding maps through the extra last slot and stays -1
+        neighbors = remap[neighbors[keep]]
+        similarities = similarities[keep]
+        vectors = vectors[keep]
+
+        # Rows that lost a neighbour are re-scored against what is left
+        lost = (neighbors < 0) & np.isfinite(similarities)
+        stale = np.flatnonzero(lost.any(axis=1))
+        if len(stale):
+            neighbors[stale], similarities[stale] = self._score_rows(vectors, stale)
+        self._data = self._pack(old_ids[keep], vectors, [metadatas[row] for row in keep], neighbors, similarities)
+
+    def _score_rows(self, vectors: np.ndarray, rows: np.ndarray):
+        """Exact top-k neighbours of ``rows`` among all ``vectors``"""
+        neighbors = np.empty((len(rows), self.k), dtype=np.int32)
+        similarities = np.empty((len(rows), self.k), dtype=np.float32)
+        all_rows = np.arange(len(vectors))
+        step = self._chunk_rows(len(vectors))
+        for start in range(0, len(rows), step):
+            chunk = rows[start:start + step]
+            scores = vectors[chunk] @ vectors.T
+            # Never a character's own neighbour
+            scores[np.arange(len(chunk)), chunk] = -np.inf
+            candidates = np.broadcast_to(all_rows, scores.shape)
+            neighbors[start:start + len(chunk)], similarities[start:start + len(chunk)] = self._best(candidates, scores)
+        self.rows_scored += len(rows)
+        return neighbors, similarities
+
+    def _chunk_rows(self, columns: int) -> int:
+        return max(1, self.chunk_scores // max(1, columns))
+
+    def _best(self, candidates: np.ndarray, scores: np.ndarray):
+        """Best ``k`` candidates per row, best first, padded with -1 / -inf"""
+        if scores.shape[1] > self.k:
+            part = np.argpartition(-scores, self.k - 1, axis=1)[:, :self.k]
+            candidates = np.take_along_axis(candidates, part, axis=1)
+            scores = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        candidates = np.where(np.isfinite(scores), candidates, -1)
+
+        pad = self.k - scores.shape[1]
+        if pad > 0:
+            candidates = np.pad(candidates, ((0, 0), (0, pad)), constant_values=-1)
+            scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+        return candidates, scores
+
+    def _record(self, started: float):
+        self.updates += 1
+        self.last_update_ms = (time.perf_counter() - started) * 1000
+
+    def rows_for(self, anilist_ids: Iterable[int], data=None) -> List[int]:
+        ids = (data or self._data)[0]
+        lookup = self._lookup
+        if lookup is None or lookup[0] is not ids:
+            lookup = self._lookup = (ids, {anilist_id: row for row, anilist_id in enumerate(ids.tolist())})
+        return [lookup[1][int(i)] for i in anilist_ids if int(i) in lookup[1]]
+
+    def neighbors_of(self, anilist_id: int) -> List[tuple]:
+        """(anilist_id, similarity) pairs, best first"""
+        data = self._data
+        ids, _, _, neighbors, similarities = data
+        rows = self.rows_for([anilist_id], data)
+        if not rows:
+            return []
+        return [(int(ids[n]), float(s)) for n, s in zip(neighbors[rows[0]], similarities[rows[0]]) if n >= 0]
+
+    def search(self, query: np.ndarray, shown_ids: Sequence[int], n_results: int,
+               exclude_ids: Optional[Sequence[int]] = None) -> dict:
+        """Rank the graph neighbours of ``shown_ids`` against ``query``
+
+        Candidates are the shown characters' neighbours, plus neighbours of
+        those when one hop doesn't yield ``n_results``. Only the candidates
+        are scored, so this is a few hundred dot products rather than a
+        search. Results use the same shape as the search backends.
+        """
+        data = self._data
+        ids, vectors, metadatas, neighbors, _ = data
+        shown = self.rows_for(shown_ids, data)
+        if not shown:
+            return {'ids': [[]], 'distances': [[]], 'metadatas': [[]]}
+        excluded = np.asarray(shown + self.rows_for(exclude_ids or [], data), dtype=np.int64)
+
+        frontier = np.asarray(shown, dtype=np.int64)
+        candidates = np.empty(0, dtype=np.int64)
+        for _ in range(2):
+            hop = np.unique(neighbors[frontier].ravel())
+            hop = hop[(hop >= 0) & ~np.isin(hop, excluded) & ~np.isin(hop, candidates)]
+            candidates = np.concatenate([candidates, hop])
+            if len(candidates) >= n_results or not len(hop):
+                break
+            frontier = hop
+
+        scores = vectors[candidates] @ np.asarray(query, dtype=np.float32).ravel()
+        order = np.argsort(-scores, kind='stable')[:n_results]
+        rows = candidates[order]
+        return {
+            'ids': [[str(ids[row]) for row in rows]],
+            'distances': [[float(1 - scores[i]) for i in order]],
+            'metadatas': [[metadatas[row] for row in rows]],
+        }
+
+    def stats(self) -> dict:
+        ids, vectors, _, neighbors, similarities = self._data
+        return {
+            "characters": len(ids),
+            "k": self.k,
+            "bytes": int((vectors.nbytes if vectors is not None else 0) + neighbors.nbytes + similarities.nbytes),
+            "updates": self.updates,
+            "rows_scored": self.rows_scored,
+            "last_update_ms": round(self.last_update_ms, 2),
+        }
+
+
+def read_graph_manifest(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, GRAPH_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,36 @@
+import os
+from typing import Optional
+
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxImageEncoder:
+    """CLIP vision tower and projection exported by ``export_onnx.py``
+
+    Takes the same (N, 3, H, W) float pixel batch as ``get_image_features``
+    and returns L2-normalized float32 embeddings. The session is safe to call
+    from several inference threads at once.
+    """
+
+    def __init__(self, path: str, threads: Optional[int] = None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, pixel_values) -> np.ndarray:
+        pixel_values = np.ascontiguousarray(pixel_values, dtype=np.float32)
+        (embeddings,) = self.session.run(None, {self.input_name: pixel_values})
+        return embeddings
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "file_bytes": os.path.getsize(self.path),
+            "threads": self.session.get_session_options().intra_op_num_threads,
+        }
@@ -0,0 +1,165 @@
+import io
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from metrics import Histogram
+
+# CLIP defaults, used when the processor config doesn't say otherwise
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class StageTimings:
+    """Running totals per pipeline stage; averages are per image
+
+    Each timed block is also observed into a per-stage duration histogram
+    (seconds per call, so a batched forward pass counts once).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._histograms = {}
+
+    @contextmanager
+    def time(self, stage: str, count: int = 1):
+        """Time a block that handled ``count`` images"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - started) * 1000, count)
+
+    def record(self, stage: str, ms: float, count: int = 1):
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += count
+            entry[1] += ms
+            entry[2] = ms
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(ms / 1000)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._histograms.clear()
+
+    def histograms(self) -> dict:
+        """Copies of the per-stage duration histograms"""
+        with self._lock:
+            return {stage: histogram.copy() for stage, histogram in self._histograms.items()}
+
+    def items(self) -> dict:
+        """Images handled per stage"""
+        with self._lock:
+            return {stage: entry[0] for stage, entry in self._stages.items()}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                stage: {
+                    "count": count,
+                    "total_ms": round(total, 2),
+                    "avg_ms": round(total / count, 3) if count else 0.0,
+                    "last_ms": round(last, 3),
+                }
+                for stage, (count, total, last) in self._stages.items()
+            }
+
+
+class ImageTooLargeError(ValueError):
+    """The image would decode to more than the allowed number of pixels"""
+
+
+def load_image(data: bytes, target_size: int = 224, max_pixels: int = 4096 * 4096) -> Image.Image:
+    """Decode image bytes to RGB, decoding no more pixels than CLIP needs
+
+    JPEGs are decoded with ``draft`` so libjpeg scales them down by 1/2, 1/4
+    or 1/8 in the DCT domain while keeping the short side >= ``target_size``.
+    Other formats can only be decoded at full size. Either way, an image that
+    would still decode to more than ``max_pixels`` raises ImageTooLargeError
+    before any pixel is decoded; only its header has been read.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    scale = target_size / max(1, min(width, height))
+    if image.format == 'JPEG' and scale < 1:
+        image.draft('RGB', (max(target_size, int(width * scale + 0.5)), max(target_size, int(height * scale + 0.5))))
+    # draft() updated the size to what will actually be decoded
+    if image.size[0] * image.size[1] > max_pixels:
+        raise ImageTooLargeError(f"Image of {width}x{height} pixels is over the {max_pixels} pixel limit")
+    return image.convert('RGB')
+
+
+class ImagePreprocessor:
+    """CLIP resize, center-crop and normalize into a reusable batch tensor
+
+    Each image is resized (shortest edge) and cropped with PIL, written into a
+    preallocated uint8 batch, and the whole batch is converted and normalized
+    in one vectorized step. Buffers are kept per thread and grown on demand,
+    so steady-state batches allocate nothing.
+    """
+
+    def __init__(self, size: int = 224, crop_size: int = 224, mean=CLIP_MEAN, std=CLIP_STD):
+        self.size = size
+        self.crop_size = crop_size
+        # Fold the 1/255 rescale into the normalization constants
+        self.offset = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1) * 255
+        self.scale = 1.0 / (torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1) * 255)
+        self._local = threading.local()
+
+    @classmethod
+    def from_processor(cls, processor) -> "ImagePreprocessor":
+        """Read sizes and normalization from a CLIPProcessor or CLIPImageProcessor"""
+        image_processor = getattr(processor, 'image_processor', processor)
+        size = getattr(image_processor, 'size', None) or {}
+        crop = getattr(image_processor, 'crop_size', None) or {}
+        return cls(
+            size=size.get('shortest_edge', 224) if isinstance(size, dict) else int(size),
+            crop_size=crop.get('height', 224) if isinstance(crop, dict) else int(crop),
+            mean=getattr(image_processor, 'image_mean', None) or CLIP_MEAN,
+            std=getattr(image_processor, 'image_std', None) or CLIP_STD,
+        )
+
+    def _buffers(self, batch_size: int):
+        pixels: Optional[np.ndarray] = getattr(self._local, 'pixels', None)
+        if pixels is None or len(pixels) < batch_size:
+            crop = self.crop_size
+            self._local.pixels = np.empty((batch_size, crop, crop, 3), dtype=np.uint8)
+            self._local.batch = torch.empty((batch_size, 3, crop, crop), dtype=torch.float32)
+        return self._local.pixels, self._local.batch
+
+    def resize_crop(self, image: Image.Image, out: np.ndarray):
+        # Same output size as the CLIP processor's shortest-edge resize
+        width, height = image.size
+        if width <= height:
+            new_width, new_height = self.size, int(self.size * height / width)
+        else:
+            new_width, new_height = int(self.size * width / height), self.size
+        scale_x, scale_y = new_width / width, new_height / height
+        left = (new_width - self.crop_size) // 2
+        top = (new_height - self.crop_size) // 2
+        # Resize straight to the crop window so no discarded pixels are produced
+        box = (left / scale_x, top / scale_y, (left + self.crop_size) / scale_x, (top + self.crop_size) / scale_y)
+        resized = image.resize((self.crop_size, self.crop_size), Image.BICUBIC, box=box)
+        out[...] = np.asarray(resized)
+
+    def __call__(self, images: List[Image.Image]) -> torch.Tensor:
+        """Return a normalized (N, 3, crop, crop) float tensor view for the batch"""
+        pixels, batch = self._buffers(len(images))
+        n = len(images)
+        for i, image in enumerate(images):
+            self.resize_crop(image, pixels[i])
+
+        out = batch[:n]
+        out.copy_(torch.from_numpy(pixels[:n]).permute(0, 3, 1, 2))
+        out.sub_(self.offset).mul_(self.scale)
+        return out
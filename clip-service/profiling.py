@@ -0,0 +1,213 @@
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Optional
+
+# Leaf functions of threads that are parked rather than working
+IDLE_FUNCTIONS = {"wait", "select", "poll", "_worker", "get", "accept", "sleep", "_wait_for_tstate_lock"}
+PROFILE_NAME = re.compile(r"^profile-[0-9]+-[0-9a-f]{8}\.zip$")
+
+
+class ProfileSession:
+    """Stack samples and torch traces collected while one request ran"""
+
+    def __init__(self, path: str, forced: bool):
+        self.id = uuid.uuid4().hex[:8]
+        self.path = path
+        self.forced = forced
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.samples = Counter()
+        self.torch_traces: List[bytes] = []
+
+
+class RequestProfiler:
+    """Sampling profiler for individual slow requests, plus torch traces
+
+    While any session is open a background thread samples the stacks of every
+    thread (event loop, decode pool and inference workers) every
+    ``interval_ms``, so work handed off to executors is captured too, and
+    ``torch_profile`` records the forward passes that run meanwhile. Finished
+    sessions slower than ``threshold_ms`` (or forced) are written as one zip
+    each into ``directory``, keeping only the newest ``max_files``.
+    """
+
+    def __init__(self, directory: str, threshold_ms: float = 500, interval_ms: float = 5,
+                 max_files: int = 50, torch_traces: bool = True):
+        self.directory = directory
+        self.threshold_ms = threshold_ms
+        self.interval = max(0.001, interval_ms / 1000)
+        self.max_files = max(1, max_files)
+        self.torch_traces = torch_traces
+        self.sessions: List[ProfileSession] = []
+        self.saved = 0
+        self.discarded = 0
+        self._lock = threading.Lock()
+        self._torch_lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, path: str, forced: bool = False) -> ProfileSession:
+        session = ProfileSession(path, forced)
+        with self._lock:
+            self.sessions.append(session)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._sampler.start()
+        return session
+
+    def finish(self, session: ProfileSession, status_code: int) -> Optional[str]:
+        """Close the session; returns the saved profile's name, or None if it was fast"""
+        elapsed_ms = (time.perf_counter() - session.started) * 1000
+        with self._lock:
+            self.sessions.remove(session)
+        if not session.forced and elapsed_ms < self.threshold_ms:
+            self.discarded += 1
+            return None
+
+        name = f"profile-{int(session.started_at * 1000)}-{session.id}.zip"
+        details = {
+            "path": session.path,
+            "status_code": status_code,
+            "latency_ms": round(elapsed_ms, 2),
+            "forced": session.forced,
+            "started_at": session.started_at,
+            "samples": sum(session.samples.values()),
+            "interval_ms": self.interval * 1000,
+            "torch_traces": len(session.torch_traces),
+        }
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("request.json", json.dumps(details, indent=2))
+            # Collapsed stacks, for flamegraph.pl or speedscope
+            archive.writestr("stacks.folded", "".join(f"{stack} {count}\n" for stack, count in session.samples.most_common()))
+            archive.writestr("summary.txt", summarize(session.samples, self.interval * 1000))
+            for i, trace in enumerate(session.torch_traces):
+                archive.writestr(f"torch-trace-{i}.json", trace)
+
+        # Write then rename, so a listing never sees half a file
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(path + ".tmp", path)
+        self.saved += 1
+        self._trim()
+        return name
+
+    def active(self) -> bool:
+        return bool(self.sessions)
+
+    @contextmanager
+    def torch_profile(self):
+        """Record a forward pass for every open session; one capture at a time"""
+        if not self.torch_traces or not self._torch_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            from torch.profiler import ProfilerActivity, profile
+
+            with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+                yield
+            trace_path = os.path.join(self.directory, f".trace-{uuid.uuid4().hex[:8]}.json")
+            prof.export_chrome_trace(trace_path)
+            with open(trace_path, "rb") as f:
+                trace = f.read()
+            os.remove(trace_path)
+            with self._lock:
+                for session in self.sessions:
+                    session.torch_traces.append(trace)
+        finally:
+            self._torch_lock.release()
+
+    def list(self) -> List[dict]:
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not PROFILE_NAME.match(name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with zipfile.ZipFile(path) as archive:
+                    details = json.loads(archive.read("request.json"))
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+                continue
+            profiles.append({"name": name, "size_bytes": os.path.getsize(path), **details})
+        return profiles
+
+    def file_path(self, name: str) -> Optional[str]:
+        """Path of a saved profile, or None for unknown (or unsafe) names"""
+        if not PROFILE_NAME.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "threshold_ms": self.threshold_ms,
+            "interval_ms": self.interval * 1000,
+            "max_files": self.max_files,
+            "active_sessions": len(self.sessions),
+            "saved": self.saved,
+            "discarded": self.discarded,
+        }
+
+    def _trim(self):
+        names = sorted(name for name in os.listdir(self.directory) if PROFILE_NAME.match(name))
+        for name in names[:-self.max_files]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _sample(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                sessions = list(self.sessions)
+                if not sessions:
+                    self._sampler = None
+                    return
+
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own or frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+
+            for session in sessions:
+                session.samples.update(stacks)
+
+
+def summarize(samples: Counter, interval_ms: float, top: int = 30) -> str:
+    """Top functions by self and inclusive sample time"""
+    own, inclusive = Counter(), Counter()
+    for stack, count in samples.items():
+        frames = stack.split(";")[1:]
+        if frames:
+            own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+
+    lines = [f"{sum(samples.values())} samples every {interval_ms:g}ms (idle threads excluded)", ""]
+    for title, counts in (("self", own), ("inclusive", inclusive)):
+        lines.append(f"Top {top} by {title} time:")
+        for frame, count in counts.most_common(top):
+            lines.append(f"{count * interval_ms:10.1f}ms  {frame}")
+        lines.append("")
+    return "\n".join(lines)
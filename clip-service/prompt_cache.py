@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+def prompt_key(prompt: str) -> str:
+    """Case and whitespace don't change what a query means"""
+    return " ".join(prompt.lower().split())
+
+
+class PromptEmbeddingCache:
+    """Text query embeddings: a precomputed table plus an LRU of recent prompts
+
+    The table holds prompts encoded ahead of time (character names and anime
+    titles, as they are ingested) and is never evicted. Any other prompt is
+    kept in the LRU once it has been encoded, up to ``max_entries``.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max(0, max_entries)
+        self._lock = threading.Lock()
+        self._precomputed: Dict[str, np.ndarray] = {}
+        self._recent: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.precomputed_hits = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, prompt: str) -> Optional[np.ndarray]:
+        key = prompt_key(prompt)
+        with self._lock:
+            embedding = self._precomputed.get(key)
+            if embedding is not None:
+                self.precomputed_hits += 1
+                return embedding
+            embedding = self._recent.get(key)
+            if embedding is not None:
+                self._recent.move_to_end(key)
+                self.hits += 1
+                return embedding
+            self.misses += 1
+            return None
+
+    def put(self, prompt: str, embedding: np.ndarray):
+        if not self.max_entries:
+            return
+        key = prompt_key(prompt)
+        with self._lock:
+            self._recent[key] = embedding
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.max_entries:
+                self._recent.popitem(last=False)
+                self.evictions += 1
+
+    def missing(self, prompts: Iterable[str]) -> List[str]:
+        """Prompts (deduplicated) not in the precomputed table yet"""
+        with self._lock:
+            return list(dict.fromkeys(
+                prompt for prompt in prompts if prompt and prompt_key(prompt) not in self._precomputed
+            ))
+
+    def precompute(self, prompts: Sequence[str], embeddings):
+        with self._lock:
+            for prompt, embedding in zip(prompts, embeddings):
+                key = prompt_key(prompt)
+                self._precomputed[key] = np.asarray(embedding, dtype=np.float32)
+                self._recent.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.precomputed_hits + self.hits + self.misses
+        return {
+            "precomputed": len(self._precomputed),
+            "entries": len(self._recent),
+            "max_entries": self.max_entries,
+            "precomputed_hits": self.precomputed_hits,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.precomputed_hits + self.hits) / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,84 @@
+import json
+from typing import Dict, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional; the standard library encoder gives the same output
+    orjson = None
+
+
+def dumps(value) -> bytes:
+    """Compact JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class CharacterRecord:
+    """One character's response JSON, encoded once up to its confidence value"""
+
+    __slots__ = ("id", "prefix")
+
+    def __init__(self, metadata: dict):
+        self.id = int(metadata["anilist_id"])
+        fields = dumps({
+            "id": self.id,
+            "name": metadata["name"],
+            "anime": metadata["anime"],
+            "description": metadata["description"],
+            "image_url": metadata["image_url"],
+        })
+        # '{"id":..,"image_url":".."' + ',"confidence":' — the caller closes it
+        self.prefix = fields[:-1] + b',"confidence":'
+
+    def encode(self, confidence: float) -> bytes:
+        return self.prefix + repr(float(confidence)).encode() + b"}"
+
+
+class CharacterRecordCache:
+    """Character records by anilist ID, valid until the catalog next changes"""
+
+    def __init__(self):
+        self._records: Dict[int, CharacterRecord] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, metadata: dict) -> CharacterRecord:
+        record = self._records.get(metadata["anilist_id"])
+        if record is None:
+            self.misses += 1
+            record = self._records[metadata["anilist_id"]] = CharacterRecord(metadata)
+        else:
+            self.hits += 1
+        return record
+
+    def discard(self, anilist_ids):
+        for anilist_id in anilist_ids:
+            self._records.pop(anilist_id, None)
+
+    def clear(self):
+        self._records.clear()
+
+    def stats(self) -> dict:
+        return {"records": len(self._records), "hits": self.hits, "misses": self.misses}
+
+
+def encode_analysis(matches: Sequence[Tuple[CharacterRecord, float]], **extra) -> bytes:
+    """A successful AnalysisResponse body from ranked (record, confidence) pairs
+
+    Gives the same JSON as the pydantic model, with each confidence spliced
+    into its cached record. The best match is the first suggestion, so its
+    bytes are reused. ``extra`` fields (e.g. a batch item's index) are appended.
+    """
+    suggestions = [record.encode(confidence) for record, confidence in matches]
+    parts = [
+        b'{"success":true,"character":',
+        suggestions[0] if suggestions else b"null",
+        b',"suggestions":[',
+        b",".join(suggestions),
+        b'],"error":null',
+    ]
+    for key, value in extra.items():
+        parts.append(b"," + dumps(key) + b":" + dumps(value))
+    parts.append(b"}")
+    return b"".join(parts)
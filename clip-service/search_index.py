@@ -0,0 +1,586 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Metadata fields held in memory and returned with search results
+METADATA_COLUMNS = ('anilist_id', 'name', 'anime', 'description', 'image_url')
+
+# How the scores of a character's vectors combine into one score
+AGGREGATIONS = ('max', 'mean')
+
+# Snapshot directory layout: a JSON manifest naming the current matrix file
+SNAPSHOT_MANIFEST = 'snapshot.json'
+
+
+class ChromaSearchBackend:
+    """Searches the Chroma collection directly
+
+    With several vectors per character, ``oversample`` times as many vectors
+    are fetched and then combined per character, so the aggregate is over the
+    vectors that made the candidate list rather than all of them.
+    """
+
+    name = "chroma"
+
+    def __init__(self, collection, aggregate: str = "max", oversample: int = 1):
+        self.collection = collection
+        self.aggregate = aggregate
+        self.oversample = max(1, oversample)
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def search(
+        self,
+        query_embeddings: np.ndarray,
+        n_results: int,
+        include_ids: Optional[Sequence[int]] = None,
+        exclude_ids: Optional[Sequence[int]] = None,
+    ) -> dict:
+        where = id_filter(include_ids, exclude_ids)
+        count = self.count()
+        if include_ids is not None:
+            n_results = min(n_results, len(set(include_ids)))
+        if min(n_results, count) == 0:
+            return empty_results(len(query_embeddings))
+        results = self.collection.query(
+            query_embeddings=np.asarray(query_embeddings, dtype=np.float32).tolist(),
+            n_results=min(n_results * self.oversample, count),
+            where=where
+        )
+        return aggregate_results(results, n_results, self.aggregate)
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "count": self.count(), "aggregate": self.aggregate,
+                "oversample": self.oversample}
+
+
+class ExactSearchIndex:
+    """Brute-force cosine search over a memory-resident embedding matrix
+
+    Embeddings are L2-normalized rows of a float32 (or float16) matrix, so a
+    query is one matrix-vector product followed by ``argpartition`` for the
+    top k. Metadata is held column-wise and only hydrated for returned rows.
+    Results use the same shape as ``collection.query`` (cosine distances).
+
+    A character may own several rows (reference images, text prompts). Their
+    scores are combined per ``anilist_id`` with ``aggregate`` ("max" or
+    "mean") from the same single matrix product, and each character is
+    returned at most once.
+    """
+
+    name = "numpy"
+
+    def __init__(self, dimension: int = 512, dtype: str = "float32", chunk_rows: int = 16384, aggregate: str = "max"):
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.aggregate = aggregate
+        self._lock = threading.Lock()
+        # Swapped as a whole so searches never see half of an update
+        self._data = self._empty()
+
+    def _empty(self) -> tuple:
+        columns = {column: np.empty(0, dtype=object) for column in METADATA_COLUMNS}
+        columns['anilist_id'] = np.empty(0, dtype=np.int64)
+        return self._pack(np.empty((0, self.dimension), dtype=self.dtype), np.empty(0, dtype=object), columns, {})
+
+    @staticmethod
+    def _pack(matrix: np.ndarray, row_ids: np.ndarray, columns: Dict[str, np.ndarray], derived: dict) -> tuple:
+        return (matrix, row_ids, columns, group_rows(columns['anilist_id']), derived)
+
+    def _derive(self, embeddings: np.ndarray) -> Dict[str, np.ndarray]:
+        """Per-row arrays kept in step with the matrix (normalized float32 rows in)"""
+        return {}
+
+    @classmethod
+    def from_collection(cls, collection, dtype: str = "float32", page_size: int = 5000, **options) -> "ExactSearchIndex":
+        """Load every embedding and its metadata from a Chroma collection"""
+        index = None
+        offset = 0
+        while True:
+            page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+            if not page['ids']:
+                break
+            embeddings = np.asarray(page['embeddings'], dtype=np.float32)
+            if index is None:
+                index = cls(dimension=embeddings.shape[1], dtype=dtype, **options)
+            index.add(page['ids'], embeddings, page['metadatas'])
+            offset += len(page['ids'])
+        return index or cls(dtype=dtype, **options)
+
+    @classmethod
+    def from_snapshot(cls, directory: str, manifest: Optional[dict] = None, **options) -> "ExactSearchIndex":
+        """Load an index written by ``save_snapshot``, memory-mapping the matrix
+
+        Pages are read lazily on first use and shared with any other process
+        mapping the same file. Adds and removes copy the matrix as usual.
+        """
+        manifest = manifest or read_snapshot_manifest(directory)
+        matrix = np.load(os.path.join(directory, manifest['embeddings']), mmap_mode='r')
+        index = cls(dimension=matrix.shape[1], dtype=str(matrix.dtype), **options)
+        columns = {column: _object_array(manifest['metadata'][column]) for column in METADATA_COLUMNS}
+        columns['anilist_id'] = np.asarray(manifest['metadata']['anilist_id'], dtype=np.int64)
+        index._data = index._pack(matrix, _object_array(manifest['ids']), columns, index._derive_all(matrix))
+        return index
+
+    def _derive_all(self, matrix: np.ndarray) -> Dict[str, np.ndarray]:
+        parts = [self._derive(np.asarray(matrix[start:start + self.chunk_rows], dtype=np.float32))
+                 for start in range(0, len(matrix), self.chunk_rows)]
+        if not parts or not parts[0]:
+            return {}
+        return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+    def save_snapshot(self, directory: str, source: Optional[str] = None):
+        """Write the matrix as ``.npy`` and the ids and metadata as a JSON manifest
+
+        Each snapshot gets a new matrix file and the manifest is replaced last,
+        so readers only ever see a complete snapshot. ``source`` records which
+        collection it was built from. Afterwards the index maps the written
+        file instead of holding its own copy, unless it changed meanwhile.
+        """
+        matrix, row_ids, columns = self._data[:3]
+        os.makedirs(directory, exist_ok=True)
+        filename = f"embeddings-{int(time.time() * 1000)}.npy"
+        tmp_path = os.path.join(directory, filename + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(matrix))
+        os.replace(tmp_path, os.path.join(directory, filename))
+
+        manifest = {
+            'source': source,
+            'count': len(row_ids),
+            'dtype': str(matrix.dtype),
+            'embeddings': filename,
+            'created_at': time.time(),
+            'ids': row_ids.tolist(),
+            'metadata': {column: values.tolist() for column, values in columns.items()},
+        }
+        manifest_path = os.path.join(directory, SNAPSHOT_MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        mapped = np.load(os.path.join(directory, filename), mmap_mode='r')
+        with self._lock:
+            if self._data[1] is row_ids:
+                self._data = (mapped,) + self._data[1:]
+
+        # Processes still mapping an old file keep it alive until they let go
+        for entry in os.listdir(directory):
+            if entry.startswith('embeddings-') and entry.endswith('.npy') and entry != filename:
+                os.remove(os.path.join(directory, entry))
+
+    def count(self) -> int:
+        return len(self._data[1])
+
+    def pages(self, page_size: int = 5000):
+        """Yield (ids, float32 embeddings, metadatas) pages of what is indexed, like ``collection.get``"""
+        matrix, row_ids, columns = self._data[:3]
+        for start in range(0, len(row_ids), page_size):
+            rows = np.arange(start, min(start + page_size, len(row_ids)))
+            yield row_ids[rows].tolist(), np.asarray(matrix[rows], dtype=np.float32), self._hydrate(columns, rows)
+
+    def add(self, ids: Sequence[str], embeddings, metadatas: Sequence[dict]):
+        """Append rows; ids already present are replaced"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        added_derived = self._derive(embeddings)
+        embeddings = embeddings.astype(self.dtype)
+
+        with self._lock:
+            matrix, row_ids, columns, _, derived = self._data
+            keep = ~np.isin(row_ids, np.asarray(ids, dtype=object))
+            new_ids = np.empty(len(ids), dtype=object)
+            new_ids[:] = list(ids)
+            new_columns = {}
+            for column, values in columns.items():
+                added = [metadata.get(column) for metadata in metadatas]
+                added = np.asarray(added, dtype=values.dtype) if values.dtype != object else _object_array(added)
+                new_columns[column] = np.concatenate([values[keep], added])
+            # Derived arrays only carry over if the existing rows have them too
+            if not len(row_ids):
+                new_derived = added_derived
+            elif added_derived.keys() <= derived.keys():
+                new_derived = {key: np.concatenate([derived[key][keep], values]) for key, values in added_derived.items()}
+            else:
+                new_derived = {}
+            self._data = self._pack(
+                np.concatenate([matrix[keep], embeddings]),
+                np.concatenate([row_ids[keep], new_ids]),
+                new_columns,
+                new_derived,
+            )
+
+    def remove(self, ids: Sequence[str]):
+        with self._lock:
+            matrix, row_ids, columns, _, derived = self._data
+            keep = ~np.isin(row_ids, np.asarray(ids, dtype=object))
+            self._data = self._pack(
+                matrix[keep], row_ids[keep], {c: v[keep] for c, v in columns.items()},
+                {key: values[keep] for key, values in derived.items()}
+            )
+
+    def scores(self, query_embeddings: np.ndarray, matrix: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cosine similarities between each query and every stored row"""
+        if matrix is None:
+            matrix = self._data[0]
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        # numpy has no BLAS path for float16, so upcast a slice at a time
+        out = np.empty((len(queries), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), self.chunk_rows):
+            block = matrix[start:start + self.chunk_rows].astype(np.float32)
+            out[:, start:start + len(block)] = queries @ block.T
+        return out
+
+    def search(
+        self,
+        query_embeddings: np.ndarray,
+        n_results: int,
+        include_ids: Optional[Sequence[int]] = None,
+        exclude_ids: Optional[Sequence[int]] = None,
+    ) -> dict:
+        """Top-k search, optionally restricted to or excluding anilist IDs
+
+        Filtered rows are masked before top-k, so ``include_ids`` always scores
+        exactly those characters and ``exclude_ids`` still returns k results.
+        ``n_results`` counts characters, not rows.
+        """
+        matrix, row_ids, columns, groups, _ = self._data
+        rows = None
+        if include_ids is not None:
+            rows = np.flatnonzero(np.isin(columns['anilist_id'], include_ids))
+        elif exclude_ids:
+            rows = np.flatnonzero(~np.isin(columns['anilist_id'], exclude_ids))
+        if rows is not None:
+            matrix = matrix[rows]
+            groups = group_rows(columns['anilist_id'][rows])
+
+        scores = self.scores(query_embeddings, matrix)
+        if groups is not None:
+            # One column per character, pointing at the character's first row
+            order, starts = groups
+            scores = aggregate_scores(scores[:, order], starts, self.aggregate)
+            representative = order[starts]
+        results = {'ids': [], 'distances': [], 'metadatas': []}
+        for row_scores in scores:
+            top = top_k(row_scores, n_results)
+            row_scores = row_scores[top]
+            if groups is not None:
+                top = representative[top]
+            if rows is not None:
+                top = rows[top]
+            results['ids'].append(row_ids[top].tolist())
+            results['distances'].append((1.0 - row_scores).tolist())
+            results['metadatas'].append(self._hydrate(columns, top))
+        return results
+
+    @staticmethod
+    def _hydrate(columns: Dict[str, np.ndarray], rows: np.ndarray) -> List[dict]:
+        picked = {column: values[rows].tolist() for column, values in columns.items()}
+        return [{column: picked[column][i] for column in picked} for i in range(len(rows))]
+
+    def stats(self) -> dict:
+        matrix, _, columns, groups, _ = self._data
+        return {
+            "backend": self.name,
+            "count": len(matrix),
+            "characters": len(groups[1]) if groups is not None else len(matrix),
+            "aggregate": self.aggregate,
+            "dtype": str(self.dtype),
+            "matrix_bytes": matrix.nbytes,
+            "mmap": isinstance(matrix, np.memmap),
+        }
+
+
+class Int8Codec:
+    """Per-row symmetric int8 codes: a quarter of float32, scored in upcast slices"""
+
+    name = "int8"
+
+    def needs_fit(self, count: int) -> bool:
+        return False
+
+    def fit(self, matrix: np.ndarray):
+        pass
+
+    def encode(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+        return {
+            'codes': np.round(vectors / scales[:, None]).astype(np.int8),
+            'scales': scales.astype(np.float32),
+        }
+
+    def scores(self, queries: np.ndarray, derived: Dict[str, np.ndarray], chunk_rows: int) -> np.ndarray:
+        codes = derived['codes']
+        out = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), chunk_rows):
+            block = codes[start:start + chunk_rows].astype(np.float32)
+            out[:, start:start + len(block)] = queries @ block.T
+        return out * derived['scales']
+
+    def stats(self) -> dict:
+        return {"compression": self.name}
+
+
+class PcaCodec:
+    """Projection onto the top ``dimension`` principal directions of the stored rows
+
+    The basis is fitted on a sample of rows (uncentered, so dot products are
+    preserved) and refitted whenever the index has doubled since the last fit.
+    Until there are enough rows to fit, nothing is encoded and searches are exact.
+    """
+
+    name = "pca"
+
+    def __init__(self, dimension: int = 64, sample_rows: int = 20000):
+        self.dimension = dimension
+        self.sample_rows = sample_rows
+        self.basis: Optional[np.ndarray] = None
+        self.fitted_rows = 0
+
+    def needs_fit(self, count: int) -> bool:
+        return count >= 2 * self.dimension and (self.basis is None or count >= 2 * self.fitted_rows)
+
+    def fit(self, matrix: np.ndarray):
+        step = max(1, len(matrix) // self.sample_rows)
+        sample = np.asarray(matrix[::step], dtype=np.float32)
+        _, _, vt = np.linalg.svd(sample, full_matrices=False)
+        self.basis = np.ascontiguousarray(vt[:self.dimension].T)
+        self.fitted_rows = len(matrix)
+
+    def encode(self, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        if self.basis is None:
+            return {}
+        return {'codes': vectors @ self.basis}
+
+    def scores(self, queries: np.ndarray, derived: Dict[str, np.ndarray], chunk_rows: int) -> np.ndarray:
+        return (queries @ self.basis) @ derived['codes'].T
+
+    def stats(self) -> dict:
+        return {"compression": self.name, "dimension": self.dimension, "fitted_rows": self.fitted_rows}
+
+
+class TwoStageSearchIndex(ExactSearchIndex):
+    """Compressed candidate pass followed by an exact rerank
+
+    Every row is scored against compact codes (``Int8Codec`` or ``PcaCodec``),
+    the best ``candidates`` rows are rescored against the full-precision matrix,
+    and characters are ranked from those. The full matrix is only read at the
+    candidate rows, so once it is mapped from a snapshot it mostly stays on disk.
+    Include filters and indexes smaller than ``candidates`` are searched exactly.
+    """
+
+    name = "two_stage"
+
+    def __init__(self, dimension: int = 512, dtype: str = "float32", chunk_rows: int = 16384,
+                 aggregate: str = "max", compression: str = "pca", compressed_dimension: int = 64,
+                 candidates: int = 200):
+        self.codec = Int8Codec() if compression == "int8" else PcaCodec(compressed_dimension)
+        self.candidates = candidates
+        super().__init__(dimension=dimension, dtype=dtype, chunk_rows=chunk_rows, aggregate=aggregate)
+
+    def _derive(self, embeddings: np.ndarray) -> Dict[str, np.ndarray]:
+        return self.codec.encode(embeddings)
+
+    def _derive_all(self, matrix: np.ndarray) -> Dict[str, np.ndarray]:
+        if self.codec.needs_fit(len(matrix)):
+            self.codec.fit(matrix)
+        return super()._derive_all(matrix)
+
+    def add(self, ids: Sequence[str], embeddings, metadatas: Sequence[dict]):
+        super().add(ids, embeddings, metadatas)
+        if self.codec.needs_fit(self.count()):
+            with self._lock:
+                matrix = self._data[0]
+                self._data = self._data[:4] + (self._derive_all(matrix),)
+
+    def search(
+        self,
+        query_embeddings: np.ndarray,
+        n_results: int,
+        include_ids: Optional[Sequence[int]] = None,
+        exclude_ids: Optional[Sequence[int]] = None,
+    ) -> dict:
+        matrix, row_ids, columns, _, derived = self._data
+        if include_ids is not None or not derived or len(matrix) <= self.candidates:
+            return super().search(query_embeddings, n_results, include_ids, exclude_ids)
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        approximate = self.codec.scores(queries, derived, self.chunk_rows)
+        if exclude_ids:
+            approximate[:, np.isin(columns['anilist_id'], exclude_ids)] = -np.inf
+
+        results = {'ids': [], 'distances': [], 'metadatas': []}
+        for query, row_scores in zip(queries, approximate):
+            candidates = top_k(row_scores, self.candidates)
+            # Sorted rows read the (possibly mapped) matrix front to back
+            candidates = np.sort(candidates[np.isfinite(row_scores[candidates])])
+            exact = self.scores(query, matrix[candidates])[0]
+            top, top_scores = rank_rows(exact, candidates, columns['anilist_id'], n_results, self.aggregate)
+            results['ids'].append(row_ids[top].tolist())
+            results['distances'].append((1.0 - top_scores).tolist())
+            results['metadatas'].append(self._hydrate(columns, top))
+        return results
+
+    def stats(self) -> dict:
+        derived = self._data[4]
+        return {
+            **super().stats(),
+            **self.codec.stats(),
+            "candidates": self.candidates,
+            "compressed_bytes": sum(values.nbytes for values in derived.values()),
+        }
+
+
+def rank_rows(scores: np.ndarray, rows: np.ndarray, anilist_ids: np.ndarray, k: int,
+              aggregate: str = "max") -> tuple:
+    """Best ``k`` characters among scored ``rows``, as (representative rows, scores)"""
+    groups = group_rows(anilist_ids[rows])
+    if groups is not None:
+        order, starts = groups
+        scores = aggregate_scores(scores[None, order], starts, aggregate)[0]
+        rows = rows[order[starts]]
+    top = top_k(scores, k)
+    return rows[top], scores[top]
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def group_rows(anilist_ids: np.ndarray) -> Optional[tuple]:
+    """``(order, starts)`` grouping rows by character, or None if no character has two rows
+
+    ``order`` sorts rows by anilist ID and ``starts`` marks where each
+    character's run begins, ready for ``ufunc.reduceat``.
+    """
+    if len(anilist_ids) < 2:
+        return None
+    order = np.argsort(anilist_ids, kind='stable')
+    sorted_ids = anilist_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    if len(starts) == len(anilist_ids):
+        return None
+    return order, starts
+
+
+def aggregate_scores(scores: np.ndarray, starts: np.ndarray, aggregate: str = "max") -> np.ndarray:
+    """Combine (queries, rows) scores sorted by character into (queries, characters)"""
+    if aggregate == "mean":
+        counts = np.diff(np.r_[starts, scores.shape[1]])
+        return np.add.reduceat(scores, starts, axis=1) / counts
+    return np.maximum.reduceat(scores, starts, axis=1)
+
+
+def aggregate_results(results: dict, n_results: int, aggregate: str = "max") -> dict:
+    """Collapse ``collection.query`` results to one entry per anilist ID
+
+    Results arrive best first, so with "max" the first vector seen for a
+    character is its score; with "mean" the distances seen are averaged.
+    """
+    out = {'ids': [], 'distances': [], 'metadatas': []}
+    for ids, distances, metadatas in zip(results['ids'], results['distances'], results['metadatas']):
+        seen = {}
+        for vector_id, distance, metadata in zip(ids, distances, metadatas):
+            entry = seen.get(metadata['anilist_id'])
+            if entry is None:
+                seen[metadata['anilist_id']] = [vector_id, [distance], metadata]
+            elif aggregate == "mean":
+                entry[1].append(distance)
+        merged = [(vector_id, sum(d) / len(d), metadata) for vector_id, d, metadata in seen.values()]
+        if aggregate == "mean":
+            merged.sort(key=lambda entry: entry[1])
+        merged = merged[:n_results]
+        out['ids'].append([entry[0] for entry in merged])
+        out['distances'].append([entry[1] for entry in merged])
+        out['metadatas'].append([entry[2] for entry in merged])
+    return out
+
+
+def id_filter(include_ids: Optional[Sequence[int]] = None, exclude_ids: Optional[Sequence[int]] = None) -> Optional[dict]:
+    """Chroma ``where`` clause restricting results by anilist ID"""
+    if include_ids is not None:
+        return {'anilist_id': {'$in': [int(i) for i in include_ids]}}
+    if exclude_ids:
+        return {'anilist_id': {'$nin': [int(i) for i in exclude_ids]}}
+    return None
+
+
+def empty_results(n_queries: int) -> dict:
+    return {'ids': [[] for _ in range(n_queries)], 'distances': [[] for _ in range(n_queries)],
+            'metadatas': [[] for _ in range(n_queries)]}
+
+
+def _object_array(values: list) -> np.ndarray:
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def read_snapshot_manifest(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, SNAPSHOT_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def create_search_backend(
+    kind: str,
+    collection,
+    dtype: str = "float32",
+    snapshot_dir: Optional[str] = None,
+    aggregate: str = "max",
+    vectors_per_character: int = 1,
+    write_snapshot: bool = True,
+    **two_stage_options,
+):
+    """Build the configured search backend over a collection
+
+    ``kind`` is "chroma", "numpy" or "two_stage" (``two_stage_options`` go to
+    ``TwoStageSearchIndex``). With ``snapshot_dir`` the in-memory indexes are
+    mapped from a snapshot of the same collection when one exists, and a fresh
+    snapshot is written when not (unless ``write_snapshot`` is off, for
+    processes that only read).
+    """
+    if aggregate not in AGGREGATIONS:
+        print(f"Unknown score aggregation {aggregate!r}, using max")
+        aggregate = "max"
+    if kind in ("numpy", "two_stage"):
+        index_class, options = ExactSearchIndex, {'aggregate': aggregate}
+        if kind == "two_stage":
+            index_class, options = TwoStageSearchIndex, {**options, **two_stage_options}
+        if snapshot_dir:
+            manifest = read_snapshot_manifest(snapshot_dir)
+            if (manifest and manifest['source'] == collection.name and manifest['dtype'] == dtype
+                    and manifest['count'] == collection.count()):
+                return index_class.from_snapshot(snapshot_dir, manifest, **options)
+        index = index_class.from_collection(collection, dtype=dtype, **options)
+        if snapshot_dir and write_snapshot:
+            index.save_snapshot(snapshot_dir, source=collection.name)
+        return index
+    if kind != "chroma":
+        print(f"Unknown search backend {kind!r}, using chroma")
+    return ChromaSearchBackend(collection, aggregate=aggregate, oversample=vectors_per_character)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from anime_index import UNKNOWN_ANIME, AnimeIndex
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def add(index, entries):
+    """entries: (anilist_id, anime, vector)"""
+    index.add([e[0] for e in entries], [e[2] for e in entries], [{'anime': e[1]} for e in entries])
+
+
+def test_centroids_are_normalized_means_of_characters():
+    index = AnimeIndex()
+    add(index, [(1, "A", unit(1, 0, 0)), (2, "A", unit(0, 1, 0)), (3, "B", unit(0, 0, 1))])
+    [results] = index.search(unit(1, 1, 0)[None, :], 5)
+    assert [r['title'] for r in results] == ["A", "B"]
+    assert results[0]['characters'] == 2
+    assert results[0]['confidence'] == pytest.approx(1.0, abs=1e-6)
+    assert results[1]['confidence'] == 0.0
+
+
+def test_unknown_anime_is_not_grouped():
+    index = AnimeIndex()
+    add(index, [(1, UNKNOWN_ANIME, unit(1, 0)), (2, "A", unit(0, 1))])
+    assert index.count() == 1
+    assert index.stats()['characters'] == 1
+
+
+def test_moves_and_removes_update_the_sums():
+    index = AnimeIndex()
+    add(index, [(1, "A", unit(1, 0)), (2, "A", unit(0, 1)), (3, "B", unit(1, 1))])
+    # Character 2 moves to B with a new vector, then A loses its last member
+    add(index, [(2, "B", unit(1, -1))])
+    index.remove([1])
+    assert index.count() == 1
+    [results] = index.search(unit(1, 0)[None, :], 5)
+    assert results == [{'title': "B", 'confidence': pytest.approx(1.0, abs=1e-6), 'characters': 2}]
+
+
+def test_title_embeddings_are_blended_in():
+    index = AnimeIndex(title_weight=0.5)
+    add(index, [(1, "A", unit(1, 0)), (2, "B", unit(0, 1))])
+    assert sorted(index.missing_titles()) == ["A", "B"]
+    index.set_titles(["A"], [unit(0, 1)])
+    assert index.missing_titles() == ["B"]
+
+    [results] = index.search(unit(1, 1)[None, :], 1)
+    # A's centroid now sits between its image and its title
+    assert results[0]['title'] == "A"
+    assert results[0]['confidence'] == pytest.approx(1.0, abs=1e-6)
+
+
+def test_fork_keeps_only_title_embeddings():
+    index = AnimeIndex(title_weight=0.3)
+    add(index, [(1, "A", unit(1, 0))])
+    index.set_titles(["A"], [unit(0, 1)])
+    fork = index.fork()
+    assert fork.count() == 0 and fork.stats()['title_vectors'] == 1
+    add(fork, [(5, "A", unit(1, 0))])
+    assert fork.missing_titles() == []
+
+
+def test_search_handles_many_queries_and_an_empty_index():
+    assert AnimeIndex().search(np.ones((2, 3), dtype=np.float32), 5) == [[], []]
+    index = AnimeIndex()
+    add(index, [(i, f"Show {i}", unit(*np.eye(4)[i])) for i in range(4)])
+    results = index.search(np.eye(4, dtype=np.float32)[:3], 2)
+    assert [r[0]['title'] for r in results] == ["Show 0", "Show 1", "Show 2"]
+    assert all(len(r) == 2 for r in results)
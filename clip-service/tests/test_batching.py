@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from batching import MicroBatcher, QueueFullError, SingleFlight
+
+
+def test_concurrent_submits_share_a_batch():
+    batches = []
+
+    def double(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(double, max_batch_size=4, max_wait_ms=50)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(6))), batcher.stats()
+        finally:
+            await batcher.stop()
+
+    results, stats = asyncio.run(main())
+    assert results == [0, 2, 4, 6, 8, 10]
+    assert batches == [[0, 1, 2, 3], [4, 5]]
+    assert stats["batches_run"] == 2 and stats["max_batch_seen"] == 4
+    assert stats["batch_size_counts"] == {2: 1, 4: 1}
+
+
+def test_full_queue_rejects_instead_of_waiting():
+    release = threading.Event()
+
+    def blocked(items):
+        release.wait(5)
+        return items
+
+    async def main():
+        executor = ThreadPoolExecutor(1)
+        batcher = MicroBatcher(blocked, max_batch_size=1, max_wait_ms=0, executor=executor, max_queue_size=2)
+        batcher.start()
+        running = asyncio.ensure_future(batcher.submit("running"))
+        # Let the worker take the first item into the (blocked) forward pass
+        while not batcher.in_flight:
+            await asyncio.sleep(0.01)
+        queued = [asyncio.ensure_future(batcher.submit(name)) for name in ("a", "b")]
+        await asyncio.sleep(0)
+        assert batcher.is_full()
+        with pytest.raises(QueueFullError):
+            await batcher.submit("rejected")
+        release.set()
+        results = await asyncio.gather(running, *queued)
+        await batcher.stop()
+        executor.shutdown()
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(main())
+    assert results == ["running", "a", "b"]
+    assert stats["rejected"] == 1
+    assert stats["queue_capacity"] == 2 and stats["queue_depth"] == 0
+
+
+def test_batch_errors_reach_every_caller():
+    def broken(items):
+        raise ValueError("forward pass failed")
+
+    async def main():
+        batcher = MicroBatcher(broken, max_batch_size=4, max_wait_ms=20)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+        await batcher.stop()
+        return results
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+
+def test_single_flight_coalesces_identical_calls():
+    started = []
+
+    async def main():
+        flights = SingleFlight()
+
+        async def work(key):
+            started.append(key)
+            await asyncio.sleep(0.05)
+            return key.upper()
+
+        results = await asyncio.gather(
+            *(flights.run("a", lambda: work("a")) for _ in range(5)),
+            flights.run("b", lambda: work("b")),
+        )
+        return results, flights.stats()
+
+    results, stats = asyncio.run(main())
+    assert results == ["A"] * 5 + ["B"]
+    assert started == ["a", "b"]
+    assert stats == {"in_flight": 0, "calls": 2, "coalesced": 4}
+
+
+def test_single_flight_survives_a_departing_caller():
+    async def main():
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.ensure_future(flights.run("key", work))
+        second = asyncio.ensure_future(flights.run("key", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert asyncio.run(main()) == ("done", True)
+
+
+def test_single_flight_shares_errors_then_forgets_the_key():
+    calls = []
+
+    async def main():
+        flights = SingleFlight()
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            return "ok"
+
+        failed = await asyncio.gather(flights.run("key", work), flights.run("key", work), return_exceptions=True)
+        return failed, await flights.run("key", work)
+
+    failed, retried = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in failed)
+    assert retried == "ok" and len(calls) == 2
@@ -0,0 +1,285 @@
+import asyncio
+import contextlib
+import json
+import time
+from email.utils import formatdate
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from crawler import AniListCrawler, CrawlCheckpoint, retry_after_seconds
+from fake_anilist import create_app
+
+
+@contextlib.asynccontextmanager
+async def fake_anilist(characters: int, middlewares=()):
+    """The fake AniList on a free port, with a session and its GraphQL URL"""
+    app = create_app(characters)
+    app.middlewares.extend(middlewares)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            yield session, f"http://127.0.0.1:{runner.addresses[0][1]}/graphql"
+    finally:
+        await runner.cleanup()
+
+
+def make_crawler(session, url, path, **options) -> AniListCrawler:
+    options = {'per_page': 50, 'requests_per_second': 0, 'save_interval': 0, **options}
+    return AniListCrawler(session, CrawlCheckpoint.load(str(path)), url=url, **options)
+
+
+async def crawl(crawler: AniListCrawler, limit=None) -> list:
+    """Store every character the crawler yields, stopping after ``limit``"""
+    ids = []
+    async for char in crawler.characters():
+        ids.append(char['id'])
+        crawler.mark_stored([char['id']])
+        if len(ids) == limit:
+            break
+    return ids
+
+
+def failing(statuses: list, headers=None):
+    """Middleware answering the first GraphQL requests with ``statuses`` before serving normally"""
+    statuses = list(statuses)
+    seen = []
+
+    @web.middleware
+    async def middleware(request, handler):
+        if request.path == '/graphql':
+            seen.append(request.path)
+            if statuses:
+                status = statuses.pop(0)
+                if status == 'stall':
+                    await asyncio.sleep(1)
+                else:
+                    return web.Response(status=status, headers=headers and headers(status))
+        return await handler(request)
+
+    middleware.seen = seen
+    return middleware
+
+
+def test_crawls_every_page_and_completes(tmp_path):
+    async def main():
+        async with fake_anilist(120) as (session, url):
+            crawler = make_crawler(session, url, tmp_path / "checkpoint.json")
+            ids = await crawl(crawler)
+            return ids, crawler
+
+    ids, crawler = asyncio.run(main())
+    assert ids == list(range(1, 121))
+    assert crawler.pages_fetched == 3
+
+    saved = CrawlCheckpoint.load(str(tmp_path / "checkpoint.json"))
+    assert saved.complete and saved.page_cap is None
+    assert saved.next_page == 4
+    assert saved.ingested_ids == set(range(1, 121))
+    assert saved.finished(None)
+
+
+def test_resumes_from_checkpoint(tmp_path):
+    path = tmp_path / "checkpoint.json"
+
+    async def main():
+        async with fake_anilist(120) as (session, url):
+            first = await crawl(make_crawler(session, url, path), limit=70)
+            interrupted = CrawlCheckpoint.load(str(path))
+            resumed = make_crawler(session, url, path)
+            return first, interrupted, resumed, await crawl(resumed)
+
+    first, interrupted, resumed, rest = asyncio.run(main())
+    assert first == list(range(1, 71))
+    # Page 2 was only partly stored, so the cursor stays on it
+    assert interrupted.next_page == 2 and not interrupted.complete
+    assert rest == list(range(71, 121))
+    assert resumed.skipped == 20
+    assert resumed.pages_fetched == 2
+    assert CrawlCheckpoint.load(str(path)).complete
+
+
+def test_unresolved_characters_hold_the_page_cursor(tmp_path):
+    path = tmp_path / "checkpoint.json"
+
+    async def main():
+        async with fake_anilist(100) as (session, url):
+            crawler = make_crawler(session, url, path)
+            async for char in crawler.characters():
+                # Character 10 is never reported back
+                if char['id'] == 20:
+                    crawler.mark_failed([20])
+                elif char['id'] != 10:
+                    crawler.mark_stored([char['id']])
+            return crawler.checkpoint
+
+    checkpoint = asyncio.run(main())
+    assert checkpoint.next_page == 1
+    assert not checkpoint.complete
+    assert 20 in checkpoint.failed_ids and 10 not in checkpoint.ingested_ids
+
+
+def test_failed_characters_are_retried_on_resume(tmp_path):
+    path = tmp_path / "checkpoint.json"
+
+    async def attempt(session, url, fail):
+        crawler = make_crawler(session, url, path)
+        seen = []
+        async for char in crawler.characters():
+            seen.append(char['id'])
+            if char['id'] in fail:
+                crawler.mark_failed([char['id']])
+            else:
+                crawler.mark_stored([char['id']])
+        return seen, CrawlCheckpoint.load(str(path))
+
+    async def main():
+        async with fake_anilist(120) as (session, url):
+            first = await attempt(session, url, {30, 75})
+            # 30 fails twice more and is given up on; 75 makes it on the second try
+            second = await attempt(session, url, {30})
+            third = await attempt(session, url, {30})
+            fourth = await attempt(session, url, set())
+            return first, second, third, fourth
+
+    first, second, third, fourth = asyncio.run(main())
+    assert first[0] == list(range(1, 121))
+    assert not first[1].finished(None) and first[1].failures == {30: (1, 1), 75: (1, 2)}
+    assert second[0] == [30, 75]
+    assert second[1].failures == {30: (2, 1)} and 75 in second[1].ingested_ids
+    assert third[0] == [30]
+    assert third[1].failed_ids == {30} and third[1].finished(None)
+    assert fourth[0] == []
+
+
+def test_legacy_failed_ids_are_retried(tmp_path):
+    path = tmp_path / "checkpoint.json"
+    path.write_text(json.dumps({'next_page': 3, 'complete': True, 'page_cap': None,
+                                'ingested_ids': [i for i in range(1, 101) if i != 7], 'failed_ids': [7]}))
+    checkpoint = CrawlCheckpoint.load(str(path))
+    assert checkpoint.failures == {7: (1, 1)} and checkpoint.resume_page() == 1
+    assert not checkpoint.finished(None)
+
+
+def test_checkpoint_writes_are_throttled_until_flushed(tmp_path):
+    path = tmp_path / "checkpoint.json"
+
+    async def main():
+        async with fake_anilist(120) as (session, url):
+            crawler = make_crawler(session, url, path, save_interval=60)
+            async for char in crawler.characters():
+                crawler.mark_stored([char['id']])
+                if char['id'] == 70:
+                    break
+            before = CrawlCheckpoint.load(str(path))
+            crawler.flush()
+            return before, CrawlCheckpoint.load(str(path))
+
+    before, after = asyncio.run(main())
+    # Only the write when page 1 was fetched went out, before anything was stored
+    assert before.ingested_ids == set() and before.next_page == 1
+    assert after.ingested_ids == set(range(1, 71)) and after.next_page == 2
+
+
+def test_retries_rate_limits_honouring_retry_after(tmp_path):
+    # One 429 gives a delay in seconds, the other an HTTP date already past
+    def headers(status):
+        return {'Retry-After': '0'} if status == 429 else {'Retry-After': formatdate(time.time() - 5, usegmt=True)}
+
+    throttle = failing([429, 503], headers)
+
+    async def main():
+        async with fake_anilist(60, [throttle]) as (session, url):
+            crawler = make_crawler(session, url, tmp_path / "checkpoint.json")
+            return await crawl(crawler), crawler
+
+    started = time.monotonic()
+    ids, crawler = asyncio.run(main())
+    assert ids == list(range(1, 61))
+    assert len(throttle.seen) == crawler.pages_fetched + 2
+    # Retry-After overrode the exponential backoff
+    assert time.monotonic() - started < 1
+    assert crawler.checkpoint.complete
+
+
+def test_retries_timeouts(tmp_path):
+    stall = failing(['stall'])
+
+    async def main():
+        async with fake_anilist(30, [stall]) as (session, url):
+            crawler = make_crawler(session, url, tmp_path / "checkpoint.json", request_timeout=0.2)
+            return await crawl(crawler)
+
+    assert asyncio.run(main()) == list(range(1, 31))
+    assert len(stall.seen) == 2
+
+
+def test_gives_up_after_max_retries(tmp_path):
+    async def main():
+        async with fake_anilist(30, [failing([500] * 10, lambda status: {'Retry-After': '0'})]) as (session, url):
+            await crawl(make_crawler(session, url, tmp_path / "checkpoint.json", max_retries=2))
+
+    with pytest.raises(RuntimeError, match="after 2 retries"):
+        asyncio.run(main())
+
+
+def test_client_errors_are_not_retried(tmp_path):
+    forbidden = failing([403])
+
+    async def main():
+        async with fake_anilist(30, [forbidden]) as (session, url):
+            await crawl(make_crawler(session, url, tmp_path / "checkpoint.json"))
+
+    with pytest.raises(RuntimeError, match="returned 403"):
+        asyncio.run(main())
+    assert len(forbidden.seen) == 1
+
+
+def test_page_cap_completes_until_raised(tmp_path):
+    path = tmp_path / "checkpoint.json"
+
+    async def main():
+        async with fake_anilist(200) as (session, url):
+            capped = await crawl(make_crawler(session, url, path, max_pages=2))
+            again = make_crawler(session, url, path, max_pages=2)
+            unchanged = await crawl(again)
+            raised = await crawl(make_crawler(session, url, path, max_pages=10))
+            return capped, again, unchanged, raised
+
+    capped, again, unchanged, raised = asyncio.run(main())
+    assert capped == list(range(1, 101))
+    assert unchanged == [] and again.pages_fetched == 0
+    assert raised == list(range(101, 201))
+    checkpoint = CrawlCheckpoint.load(str(path))
+    assert checkpoint.complete and checkpoint.page_cap is None
+
+
+def test_catalog_ignores_the_checkpoint(tmp_path):
+    path = tmp_path / "checkpoint.json"
+
+    async def main():
+        async with fake_anilist(80) as (session, url):
+            await crawl(make_crawler(session, url, path))
+            crawler = make_crawler(session, url, path)
+            return [char['id'] async for char in crawler.catalog()]
+
+    assert asyncio.run(main()) == list(range(1, 81))
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, 2.0),
+    ("7", 7.0),
+    ("1.5", 1.5),
+    ("-3", 0.0),
+    ("soon", 2.0),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0),
+])
+def test_retry_after_seconds(value, expected):
+    assert retry_after_seconds(value, 2.0) == expected
+
+
+def test_retry_after_http_date_in_the_future():
+    assert 8 < retry_after_seconds(formatdate(time.time() + 10, usegmt=True), 2.0) <= 10
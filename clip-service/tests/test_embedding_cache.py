@@ -0,0 +1,77 @@
+import asyncio
+import os
+import threading
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+def vector(value: float) -> np.ndarray:
+    return np.full(4, value, dtype=np.float32)
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = EmbeddingCache(max_bytes=3 * vector(0).nbytes)
+    for key in "abc":
+        cache.put(key, vector(ord(key)))
+    cache.get("a")
+    cache.put("d", vector(4))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("d") is not None
+    stats = cache.stats()
+    assert stats["entries"] == 3 and stats["evictions"] == 1
+    assert stats["hits"] == 3 and stats["misses"] == 1
+
+
+def test_expired_entries_are_misses():
+    cache = EmbeddingCache(ttl_seconds=-1)
+    cache.put("a", vector(1))
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_async_access_keeps_disk_io_off_the_loop(tmp_path, monkeypatch):
+    loop_thread = []
+    disk_threads = []
+    read_disk, write_disk = EmbeddingCache._read_disk, EmbeddingCache._write_disk
+
+    def tracked(method):
+        def wrapper(self, *args):
+            disk_threads.append(threading.current_thread())
+            return method(self, *args)
+        return wrapper
+
+    monkeypatch.setattr(EmbeddingCache, "_read_disk", tracked(read_disk))
+    monkeypatch.setattr(EmbeddingCache, "_write_disk", tracked(write_disk))
+
+    async def main():
+        loop_thread.append(threading.current_thread())
+        writer = EmbeddingCache(disk_dir=str(tmp_path))
+        writer.put_async("ab12", vector(7))
+        # Memory is updated straight away; the file lands in the background
+        assert np.array_equal(await writer.get_async("ab12"), vector(7))
+        path = os.path.join(str(tmp_path), "default", "ab", "ab12.npy")
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            await asyncio.sleep(0.01)
+
+        # A fresh cache (a restart, or another worker) finds it on disk
+        reader = EmbeddingCache(disk_dir=str(tmp_path))
+        found = await reader.get_async("ab12")
+        missing = await reader.get_async("ffff")
+        return found, missing, reader.stats(), await reader.get_async("ab12")
+
+    found, missing, stats, again = asyncio.run(main())
+    assert np.array_equal(found, vector(7)) and missing is None
+    assert stats["disk_hits"] == 1 and stats["misses"] == 1
+    assert np.array_equal(again, vector(7))
+    assert disk_threads and loop_thread[0] not in disk_threads
+
+
+def test_disk_entries_are_kept_apart_per_namespace(tmp_path):
+    torch_cache = EmbeddingCache(disk_dir=str(tmp_path), namespace="torch-1")
+    torch_cache.put("ab12", vector(1))
+    assert EmbeddingCache(disk_dir=str(tmp_path), namespace="onnx-2").get("ab12") is None
+    assert np.array_equal(EmbeddingCache(disk_dir=str(tmp_path), namespace="torch-1").get("ab12"), vector(1))
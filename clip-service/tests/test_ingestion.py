@@ -0,0 +1,112 @@
+import asyncio
+import contextlib
+import io
+from collections import Counter
+
+import aiohttp
+import numpy as np
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from ingestion import IngestionPipeline
+
+
+def png(value: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 4), (value, value, value)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@contextlib.asynccontextmanager
+async def image_server():
+    """Serves /<n>.png as a grey square and 404s /missing.png, counting requests"""
+    requests = Counter()
+
+    async def handler(request):
+        name = request.match_info['name']
+        requests[name] += 1
+        if name == 'missing':
+            return web.Response(status=404)
+        return web.Response(body=png(int(name)), content_type='image/png')
+
+    app = web.Application()
+    app.router.add_get('/{name}.png', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            yield session, f"http://127.0.0.1:{runner.addresses[0][1]}", requests
+    finally:
+        await runner.cleanup()
+
+
+def encode(images):
+    return np.array([[image.getpixel((0, 0))[0], 1.0] for image in images], dtype=np.float32)
+
+
+def run_pipeline(names, **options):
+    stored = {}
+    failed = []
+
+    def store(ids, embeddings, metadatas):
+        stored.update(zip(ids, zip(embeddings, metadatas)))
+
+    async def main():
+        async with image_server() as (session, base, requests):
+            pipeline = IngestionPipeline(
+                session, encode, store, concurrency=4, requests_per_second=0,
+                encode_batch_size=2, store_chunk_size=3,
+                on_failed=lambda items: failed.extend(item['id'] for item in items), **options
+            )
+            items = [{'id': f"item{i}", 'image_url': f"{base}/{name}.png", 'metadata': {}}
+                     for i, name in enumerate(names)]
+            await pipeline.run(items)
+            return pipeline.progress, requests
+
+    progress, requests = asyncio.run(main())
+    return stored, failed, progress, requests
+
+
+def test_shared_urls_are_fetched_and_encoded_once():
+    names = ['10', '20', '10', '10', '30', '20']
+    stored, failed, progress, requests = run_pipeline(names)
+    assert requests == {'10': 1, '20': 1, '30': 1}
+    assert progress.encoded == 3 and progress.reused == 3
+    assert not failed and len(stored) == 6
+    for i, name in enumerate(names):
+        embedding, metadata = stored[f"item{i}"]
+        assert embedding[0] == int(name)
+        assert metadata['content_hash'] == stored[f"item{names.index(name)}"][1]['content_hash']
+
+
+def test_failed_fetch_lets_the_next_item_retry():
+    stored, failed, progress, requests = run_pipeline(['missing', 'missing', '10'])
+    assert requests['missing'] == 2
+    assert sorted(failed) == ['item0', 'item1']
+    assert list(stored) == ['item2']
+
+
+def test_sharing_can_be_turned_off():
+    stored, failed, progress, requests = run_pipeline(['10', '10'], shared_urls=0)
+    assert requests == {'10': 2}
+    assert progress.reused == 0 and len(stored) == 2
+
+
+def test_store_failure_ends_the_run():
+    def broken_store(ids, embeddings, metadatas):
+        raise OSError("disk full")
+
+    async def main():
+        async with image_server() as (session, base, _):
+            pipeline = IngestionPipeline(session, encode, broken_store, concurrency=2,
+                                         requests_per_second=0, encode_batch_size=1, store_chunk_size=1)
+            items = [{'id': f"item{i}", 'image_url': f"{base}/{i}.png", 'metadata': {}} for i in range(50)]
+            with pytest.raises(OSError, match="disk full"):
+                await asyncio.wait_for(pipeline.run(items), timeout=10)
+            return pipeline.progress
+
+    progress = asyncio.run(main())
+    assert progress.state == "failed" and progress.error == "disk full"
+    assert progress.stored == 0
@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import pytest
+
+from neighbor_graph import NeighborGraph
+
+
+def normalized(rng, rows, dimension=16):
+    vectors = rng.standard_normal((rows, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def metadatas(ids):
+    return [{'anilist_id': int(i), 'name': f"Character {i}"} for i in ids]
+
+
+def expected_neighbors(ids, vectors, k):
+    """{anilist_id: [neighbour ids, best first]} by brute force"""
+    scores = vectors @ vectors.T
+    np.fill_diagonal(scores, -np.inf)
+    return {
+        int(ids[row]): [int(ids[col]) for col in np.argsort(-scores[row], kind='stable')[:min(k, len(ids) - 1)]]
+        for row in range(len(ids))
+    }
+
+
+def assert_matches_brute_force(graph, ids, vectors):
+    expected = expected_neighbors(ids, vectors, graph.k)
+    for anilist_id, neighbors in expected.items():
+        assert [n for n, _ in graph.neighbors_of(anilist_id)] == neighbors
+
+
+def test_add_in_steps_matches_brute_force():
+    rng = np.random.default_rng(0)
+    ids = np.arange(100, 160)
+    vectors = normalized(rng, len(ids))
+    # A tiny chunk budget exercises the chunked scoring paths too
+    graph = NeighborGraph(k=5, chunk_scores=64)
+    for start in range(0, len(ids), 17):
+        graph.add(ids[start:start + 17], vectors[start:start + 17], metadatas(ids[start:start + 17]))
+    assert graph.count() == len(ids)
+    assert_matches_brute_force(graph, ids, vectors)
+
+
+def test_replace_and_remove_relink_only_what_changed():
+    rng = np.random.default_rng(1)
+    ids = np.arange(40)
+    vectors = normalized(rng, len(ids))
+    graph = NeighborGraph(k=4)
+    graph.add(ids, vectors, metadatas(ids))
+
+    vectors[3] = normalized(rng, 1)[0]
+    graph.add(ids[3:4], vectors[3:4], metadatas(ids[3:4]))
+    keep = ~np.isin(ids, [5, 11, 12])
+    graph.remove([5, 11, 12])
+    assert graph.count() == 37
+    assert_matches_brute_force(graph, ids[keep], vectors[keep])
+
+
+def test_short_rows_are_padded():
+    rng = np.random.default_rng(2)
+    graph = NeighborGraph(k=8)
+    graph.add([1, 2, 3], normalized(rng, 3), metadatas([1, 2, 3]))
+    assert len(graph.neighbors_of(1)) == 2
+    assert graph.neighbors_of(99) == []
+
+
+def test_search_ranks_neighbours_of_shown_characters():
+    rng = np.random.default_rng(3)
+    ids = np.arange(1, 81)
+    vectors = normalized(rng, len(ids))
+    graph = NeighborGraph(k=6)
+    graph.add(ids, vectors, metadatas(ids))
+
+    shown = [1, 2]
+    query = vectors[0]
+    results = graph.search(query, shown, 5, exclude_ids=[int(graph.neighbors_of(1)[0][0])])
+    returned = [int(i) for i in results['ids'][0]]
+    assert len(returned) == 5
+    assert not set(returned) & set(shown)
+    assert graph.neighbors_of(1)[0][0] not in returned
+    # Every candidate is a one- or two-hop neighbour, ranked against the query
+    assert results['distances'][0] == sorted(results['distances'][0])
+    for anilist_id, distance in zip(returned, results['distances'][0]):
+        assert 1 - distance == pytest.approx(float(vectors[anilist_id - 1] @ query), abs=1e-5)
+    assert results['metadatas'][0][0]['anilist_id'] == returned[0]
+
+
+def test_search_without_shown_characters_is_empty():
+    graph = NeighborGraph(k=3)
+    assert graph.search(np.ones(4, dtype=np.float32), [7], 5)['ids'] == [[]]
+
+
+def test_copy_is_independent_and_relabel_keeps_vectors():
+    rng = np.random.default_rng(4)
+    ids = np.arange(10)
+    graph = NeighborGraph(k=3)
+    graph.add(ids, normalized(rng, 10), metadatas(ids))
+    before = graph.neighbors_of(0)
+
+    copy = graph.copy()
+    copy.remove([int(before[0][0])])
+    copy.relabel([1], [{'anilist_id': 1, 'name': "Renamed"}])
+    assert graph.count() == 10 and copy.count() == 9
+    assert graph.neighbors_of(0) == before
+
+    _, _, labels, _, _ = copy._data
+    assert labels[copy.rows_for([1])[0]]['name'] == "Renamed"
+    assert graph._data[2][1]['name'] == "Character 1"
+
+
+def test_snapshot_round_trip_maps_matching_key(tmp_path):
+    rng = np.random.default_rng(5)
+    ids = np.arange(1, 41)
+    vectors = normalized(rng, 40)
+    graph = NeighborGraph(k=4)
+    graph.add(ids, vectors, metadatas(ids))
+    key = {'source': "anime_characters", 'count': 40, 'dtype': "float32"}
+    graph.save_snapshot(str(tmp_path), key)
+    # The saved graph now maps its own files
+    assert isinstance(graph._data[3], np.memmap)
+
+    loaded = NeighborGraph.from_snapshot(str(tmp_path), key, k=4)
+    assert isinstance(loaded._data[1], np.memmap)
+    assert_matches_brute_force(loaded, ids, vectors)
+    assert loaded._data[2][0] == {'anilist_id': 1, 'name': "Character 1"}
+
+    assert NeighborGraph.from_snapshot(str(tmp_path), {**key, 'count': 41}, k=4) is None
+    assert NeighborGraph.from_snapshot(str(tmp_path), key, k=8) is None
+    assert NeighborGraph.from_snapshot(str(tmp_path / "missing"), key, k=4) is None
+
+    # A mapped graph still takes updates, and a new snapshot replaces the old files
+    more = normalized(rng, 5)
+    loaded.add(np.arange(41, 46), more, metadatas(range(41, 46)))
+    loaded.remove([3])
+    kept = ids != 3
+    assert_matches_brute_force(loaded, np.concatenate([ids[kept], np.arange(41, 46)]), np.concatenate([vectors[kept], more]))
+    loaded.save_snapshot(str(tmp_path), {**key, 'count': 44})
+    assert len([entry for entry in os.listdir(tmp_path) if entry.endswith('.npy')]) == 4
+
+
+def test_empty_graph_is_not_saved(tmp_path):
+    NeighborGraph(k=4).save_snapshot(str(tmp_path), {'source': "empty"})
+    assert not os.listdir(tmp_path)
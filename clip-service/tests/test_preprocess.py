@@ -0,0 +1,32 @@
+import io
+
+import pytest
+from PIL import Image
+
+from preprocess import ImageTooLargeError, load_image
+
+
+def encoded(size, format):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 40, 90)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def test_large_jpegs_are_drafted_under_the_limit():
+    # 3.2M pixels in the file, but libjpeg decodes it at 1/4 scale
+    image = load_image(encoded((2000, 1600), 'JPEG'), max_pixels=600 * 600)
+    assert image.mode == 'RGB' and image.size == (500, 400)
+
+
+@pytest.mark.parametrize("format", ['PNG', 'WEBP'])
+def test_oversized_images_are_refused_before_decoding(format, monkeypatch):
+    data = encoded((1200, 1000), format)
+    # Converting is what decodes the pixels, so it must never be reached
+    monkeypatch.setattr(Image.Image, 'convert', lambda *args, **kwargs: pytest.fail("image was decoded"))
+    with pytest.raises(ImageTooLargeError, match="1200x1000"):
+        load_image(data, max_pixels=1000 * 1000)
+
+
+def test_images_within_the_limit_decode_to_rgb():
+    image = load_image(encoded((640, 480), 'PNG'), max_pixels=640 * 480)
+    assert image.mode == 'RGB' and image.size == (640, 480)
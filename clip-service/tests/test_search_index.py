@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+from search_index import (
+    ExactSearchIndex,
+    TwoStageSearchIndex,
+    aggregate_results,
+    aggregate_scores,
+    group_rows,
+)
+
+
+def normalized(rng, rows, dimension=16):
+    vectors = rng.standard_normal((rows, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def character_rows(anilist_ids):
+    """Row ids and metadatas for vectors owned by ``anilist_ids`` (several rows per character allowed)"""
+    ids, metadatas = [], []
+    for row, anilist_id in enumerate(anilist_ids):
+        ids.append(f"{anilist_id}:{row}")
+        metadatas.append({'anilist_id': anilist_id, 'name': f"Character {anilist_id}", 'anime': "Show",
+                          'description': "", 'image_url': f"https://img/{anilist_id}"})
+    return ids, metadatas
+
+
+def brute_force(vectors, anilist_ids, query, aggregate):
+    """{anilist_id: aggregated score}"""
+    scores = vectors @ query
+    per_character = {}
+    for anilist_id, score in zip(anilist_ids, scores):
+        per_character.setdefault(anilist_id, []).append(score)
+    combine = max if aggregate == "max" else (lambda values: sum(values) / len(values))
+    return {anilist_id: combine(values) for anilist_id, values in per_character.items()}
+
+
+def test_group_rows_is_none_when_every_character_has_one_row():
+    assert group_rows(np.array([5, 3, 9])) is None
+    assert group_rows(np.array([4])) is None
+
+
+def test_group_rows_orders_rows_by_character():
+    order, starts = group_rows(np.array([7, 3, 7, 1, 3, 7]))
+    assert np.array_equal(np.array([7, 3, 7, 1, 3, 7])[order], [1, 3, 3, 7, 7, 7])
+    assert starts.tolist() == [0, 1, 3]
+    # Stable, so a character's rows keep their insertion order
+    assert order.tolist() == [3, 1, 4, 0, 2, 5]
+
+
+@pytest.mark.parametrize("aggregate", ["max", "mean"])
+def test_aggregate_scores_matches_a_loop(aggregate):
+    rng = np.random.default_rng(0)
+    anilist_ids = np.array([2, 1, 2, 3, 1, 2])
+    scores = rng.standard_normal((3, len(anilist_ids))).astype(np.float32)
+    order, starts = group_rows(anilist_ids)
+    combined = aggregate_scores(scores[:, order], starts, aggregate)
+    for query in range(3):
+        for column, anilist_id in enumerate([1, 2, 3]):
+            values = scores[query, anilist_ids == anilist_id]
+            expected = values.max() if aggregate == "max" else values.mean()
+            assert combined[query, column] == pytest.approx(expected, rel=1e-6)
+
+
+@pytest.mark.parametrize("aggregate", ["max", "mean"])
+def test_exact_search_ranks_characters_by_aggregated_score(aggregate):
+    rng = np.random.default_rng(1)
+    anilist_ids = [i // 3 for i in range(60)] + list(range(100, 120))
+    vectors = normalized(rng, len(anilist_ids))
+    ids, metadatas = character_rows(anilist_ids)
+    index = ExactSearchIndex(dimension=16, aggregate=aggregate)
+    index.add(ids, vectors, metadatas)
+
+    query = normalized(rng, 1)[0]
+    results = index.search(query[None, :], 10)
+    expected = brute_force(vectors, anilist_ids, query, aggregate)
+    best = sorted(expected, key=lambda anilist_id: -expected[anilist_id])[:10]
+
+    returned = [metadata['anilist_id'] for metadata in results['metadatas'][0]]
+    assert returned == best
+    assert len(set(returned)) == len(returned)
+    for anilist_id, distance in zip(returned, results['distances'][0]):
+        assert 1 - distance == pytest.approx(expected[anilist_id], abs=1e-5)
+
+
+def test_exact_search_filters_before_top_k():
+    rng = np.random.default_rng(2)
+    anilist_ids = [i // 2 for i in range(40)]
+    vectors = normalized(rng, len(anilist_ids))
+    ids, metadatas = character_rows(anilist_ids)
+    index = ExactSearchIndex(dimension=16)
+    index.add(ids, vectors, metadatas)
+    query = vectors[:1]
+
+    top = [m['anilist_id'] for m in index.search(query, 5)['metadatas'][0]]
+    assert top[0] == 0
+    excluded = [m['anilist_id'] for m in index.search(query, 5, exclude_ids=top)['metadatas'][0]]
+    assert len(excluded) == 5 and not set(excluded) & set(top)
+    included = [m['anilist_id'] for m in index.search(query, 10, include_ids=[3, 7, 11])['metadatas'][0]]
+    assert sorted(included) == [3, 7, 11]
+
+
+def test_add_replaces_and_remove_drops_rows():
+    rng = np.random.default_rng(3)
+    ids, metadatas = character_rows([1, 2, 3])
+    index = ExactSearchIndex(dimension=16)
+    index.add(ids, normalized(rng, 3), metadatas)
+    replacement = normalized(rng, 1)
+    index.add(ids[:1], replacement, metadatas[:1])
+    assert index.count() == 3
+    assert index.search(replacement, 1)['ids'][0] == [ids[0]]
+    index.remove(ids[1:])
+    assert index.count() == 1
+
+
+def test_snapshot_round_trip_maps_the_matrix(tmp_path):
+    rng = np.random.default_rng(4)
+    anilist_ids = [i // 2 for i in range(30)]
+    vectors = normalized(rng, len(anilist_ids))
+    ids, metadatas = character_rows(anilist_ids)
+    index = ExactSearchIndex(dimension=16)
+    index.add(ids, vectors, metadatas)
+    index.save_snapshot(str(tmp_path), source="collection")
+
+    loaded = ExactSearchIndex.from_snapshot(str(tmp_path))
+    assert loaded.stats()["mmap"]
+    query = vectors[5:6]
+    assert loaded.search(query, 5) == index.search(query, 5)
+
+
+def test_two_stage_agrees_with_exact_search():
+    rng = np.random.default_rng(5)
+    anilist_ids = list(range(600))
+    vectors = normalized(rng, len(anilist_ids), dimension=32)
+    ids, metadatas = character_rows(anilist_ids)
+    exact = ExactSearchIndex(dimension=32)
+    exact.add(ids, vectors, metadatas)
+    for compression in ("int8", "pca"):
+        approximate = TwoStageSearchIndex(dimension=32, compression=compression, compressed_dimension=32, candidates=100)
+        approximate.add(ids, vectors, metadatas)
+        for query in vectors[:5]:
+            assert approximate.search(query[None, :], 3)['ids'] == exact.search(query[None, :], 3)['ids']
+
+
+def test_aggregate_results_keeps_one_entry_per_character():
+    results = {
+        'ids': [["1", "1:cover0", "2", "2:name"]],
+        'distances': [[0.1, 0.3, 0.2, 0.6]],
+        'metadatas': [[{'anilist_id': 1}, {'anilist_id': 1}, {'anilist_id': 2}, {'anilist_id': 2}]],
+    }
+    assert aggregate_results(results, 5, "max")['ids'] == [["1", "2"]]
+    mean = aggregate_results(results, 5, "mean")
+    assert mean['ids'] == [["1", "2"]]
+    assert mean['distances'][0] == pytest.approx([0.2, 0.4])
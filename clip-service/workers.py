@@ -0,0 +1,202 @@
+import fcntl
+import json
+import os
+import time
+from typing import List, Optional
+
+WORKER_FILE_PREFIX = "worker-"
+
+
+class WriterLock:
+    """Non-blocking exclusive file lock electing the one worker that writes
+
+    The holder keeps the lock for the life of its process and the OS drops it
+    when the process exits, so another worker can take over by calling
+    ``acquire`` again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        f = open(self.path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def owner(self) -> Optional[int]:
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+
+class RequestCounter:
+    """Finished HTTP requests in this process, counted by ``CountRequests``"""
+
+    def __init__(self):
+        self.count = 0
+
+
+class CountRequests:
+    """Pure ASGI middleware, so counting adds no per-request task or body copy"""
+
+    def __init__(self, app, counter: RequestCounter):
+        self.app = app
+        self.counter = counter
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+        if scope["type"] == "http":
+            self.counter.count += 1
+
+
+def process_memory(pid: Optional[int] = None) -> dict:
+    """Memory of a process in MB
+
+    ``rss`` counts shared pages in full for every process mapping them, so it
+    overstates what pre-forked workers cost; ``pss`` splits each shared page
+    between its sharers and sums to the real total. Linux only, else just rss.
+    """
+    path = f"/proc/{pid or 'self'}/smaps_rollup"
+    fields = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        import resource
+        # ru_maxrss is the peak, in kB on Linux
+        return {"rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    shared = fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    private = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    return {
+        "rss_mb": round(fields.get("Rss", 0) / 1024, 1),
+        "pss_mb": round(fields.get("Pss", 0) / 1024, 1),
+        "shared_mb": round(shared / 1024, 1),
+        "private_mb": round(private / 1024, 1),
+    }
+
+
+class WorkerRegistry:
+    """Worker coordination through a directory shared by all workers
+
+    Each worker periodically writes its own stats file, which ``/workers``
+    aggregates. The writer publishes a new generation after every ingestion
+    or refresh, which readers poll to know when to reload, and readers leave
+    a request file for refreshes they can't run themselves.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.pid = os.getpid()
+        self.started_at = time.time()
+        self._last_report = (time.monotonic(), 0)
+        os.makedirs(directory, exist_ok=True)
+
+    def report(self, requests: int, **details) -> dict:
+        """Write this worker's stats; throughput is measured since the previous report"""
+        now = time.monotonic()
+        last_time, last_requests = self._last_report
+        self._last_report = (now, requests)
+        stats = {
+            "pid": self.pid,
+            "started_at": self.started_at,
+            "reported_at": time.time(),
+            "requests": requests,
+            "requests_per_second": round((requests - last_requests) / max(now - last_time, 1e-9), 2),
+            **process_memory(),
+            **details,
+        }
+        self._write(f"{WORKER_FILE_PREFIX}{self.pid}.json", json.dumps(stats))
+        return stats
+
+    def workers(self) -> List[dict]:
+        """Stats of every live worker; files left by exited workers are removed"""
+        workers = []
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(WORKER_FILE_PREFIX) and name.endswith(".json")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not pid_alive(stats["pid"]):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            workers.append(stats)
+        return workers
+
+    def behind(self, generation: str) -> List[int]:
+        """Pids of the other live workers that haven't reported ``generation`` yet"""
+        return [worker["pid"] for worker in self.workers()
+                if worker["pid"] != self.pid and worker.get("generation") != generation]
+
+    def publish(self) -> str:
+        generation = str(time.time_ns())
+        self._write("generation", generation)
+        return generation
+
+    def clear_generation(self):
+        """Forget the last published generation, so readers wait for the next one"""
+        try:
+            os.remove(os.path.join(self.directory, "generation"))
+        except OSError:
+            pass
+
+    def generation(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, "generation")) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def request_refresh(self):
+        self._write("refresh-requested", str(self.pid))
+
+    def take_refresh_request(self) -> bool:
+        try:
+            os.remove(os.path.join(self.directory, "refresh-requested"))
+            return True
+        except OSError:
+            return False
+
+    def _write(self, name: str, content: str):
+        # Write then rename, so readers never see half a file
+        path = os.path.join(self.directory, name)
+        with open(f"{path}.{self.pid}.tmp", "w") as f:
+            f.write(content)
+        os.replace(f"{path}.{self.pid}.tmp", path)
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True